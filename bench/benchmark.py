@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# Benchmark
+#
+# Runs 'DattoCheck.run' against the fake Datto API (bench/fake_api.py)
+# and reports end-to-end wall time, API request counts, peak memory and
+# report-build time for each fleet size.
+#
+#   python bench/benchmark.py --devices 10 1000 10000
+#   python bench/benchmark.py --archive DIR     (a fleet recorded with
+#                                                'main.py --record DIR')
+#
+# The fake API and each benchmark run get their own process, so peak
+# memory is the run's alone. 'config.py' is used if present, otherwise
+# 'config-mk.py'; the API URIs, credentials, email and cache settings
+# are always overridden, and nothing is emailed.
+
+# Import: standard
+import importlib.util
+import json
+import logging
+import multiprocessing
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+from argparse import ArgumentParser
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+BENCH = Path(__file__).resolve().parent
+
+
+def serve(conn, devices, max_agents, failure_rate, latency, error_rate, seed, archive=None, compress=True):
+    """Fake API process: build the fleet (or load a recorded one) and
+    serve it, sending back the port and the fleet's capture time"""
+
+    sys.path.insert(0, str(BENCH))
+    from fake_api import Fleet, FakeApiServer
+
+    fleet = Fleet.from_archive(archive) if archive else Fleet(devices, max_agents, failure_rate, seed)
+    fleet.xml()
+    server = FakeApiServer(('127.0.0.1', 0), fleet, latency, error_rate, seed=seed, compress=compress)
+    conn.send((server.server_port, fleet.captured))
+    conn.close()
+    server.serve_forever()
+
+
+def load_config(port, cache_dir, overrides):
+    """Import the program's config (config.py, else config-mk.py) and
+    point it at the fake API"""
+
+    sys.path.insert(0, str(ROOT))
+    try:
+        import config
+    except ImportError:
+        spec = importlib.util.spec_from_file_location('config', ROOT / 'config-mk.py')
+        config = importlib.util.module_from_spec(spec)
+        sys.modules['config'] = config
+        spec.loader.exec_module(config)
+
+    base = 'http://127.0.0.1:{}'.format(port)
+    config.API_BASE_URI = base + '/v1/bcdr/device'
+    config.XML_API_BASE_URI = base + '/xml'
+    config.AUTH_USER = 'bench'
+    config.AUTH_PASS = 'bench'
+    config.AUTH_XML = 'bench'
+    config.EMAIL_TO = []
+    config.CACHE_DIR = Path(cache_dir)
+    config.STATE_FILE = Path(cache_dir) / 'state.json'
+    config.TELEMETRY_FILE = Path(cache_dir) / 'telemetry.json'
+    config.TELEMETRY_PROM_FILE = None
+    for name, value in overrides.items():
+        setattr(config, name, value)
+    return config
+
+
+def api_stats(port, method='GET'):
+    "Request counts from the fake API ('DELETE' resets them)"
+
+    request = urllib.request.Request('http://127.0.0.1:{}/_stats'.format(port), method=method)
+    with urllib.request.urlopen(request) as response:
+        body = response.read()
+    return json.loads(body) if body else {}
+
+
+def run_once(queue, port, options):
+    """Benchmark process: run the checks once (twice for 'warm' runs,
+    measuring the second) and put the measurements on the queue"""
+
+    # the program's log output is not benchmarked
+    logging.getLogger("Datto Check").addHandler(logging.NullHandler())
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        load_config(port, cache_dir, options['config'])
+
+        from datto import DattoCheck
+        from mail import Email
+
+        datto_check = DattoCheck(options['unprotected'], options['workers'], options['cache'],
+                                 options['incremental'], options['batch'], now=options['now'])
+        if options['warm']:
+            datto_check.run(report=False)
+        api_stats(port, 'DELETE')
+
+        if options['tracemalloc']:
+            tracemalloc.start()
+        start = time.perf_counter()
+        datto_check.run(report=False)
+        wall_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        report = Email().build_html_report(datto_check.results.results)
+        report_time = time.perf_counter() - start
+
+        measurements = {
+            'wall_time': wall_time,
+            'report_time': report_time,
+            'report_bytes': len(report.encode()),
+            'errors': datto_check.results.count(),
+            'devices': datto_check.devices,
+            'phases': datto_check.telemetry.summary()['phases'],
+            'requests': api_stats(port),
+            # kilobytes on Linux, bytes on macOS
+            'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                       * (1 if sys.platform == 'darwin' else 1024),
+        }
+        if options['tracemalloc']:
+            measurements['traced_peak'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        datto_check.close()
+    queue.put(measurements)
+
+
+def benchmark(devices, args, options):
+    "Benchmark one fleet size; returns a list of measurements, one per repeat"
+
+    context = multiprocessing.get_context('spawn')
+    parent, child = context.Pipe()
+    server = context.Process(target=serve, daemon=True,
+                             args=(child, devices, args.max_agents, args.failure_rate,
+                                   args.latency, args.error_rate, args.seed, args.archive,
+                                   not args.no_gzip))
+    server.start()
+    port, captured = parent.recv()
+    # a recorded fleet is checked as of its capture time
+    options = dict(options, now=captured)
+
+    runs = []
+    try:
+        for _ in range(args.repeat):
+            queue = context.Queue()
+            process = context.Process(target=run_once, args=(queue, port, options))
+            process.start()
+            runs.append(queue.get())
+            process.join()
+    finally:
+        server.terminate()
+        server.join()
+    return runs
+
+
+def mib(size):
+    return '{:.1f} MiB'.format(size / 1024 / 1024)
+
+
+def print_summary(devices, runs, out=sys.stdout):
+    "Print the best of the repeated runs for a fleet size"
+
+    best = min(runs, key=lambda run: run['wall_time'])
+    requests = best['requests']
+    total = sum(endpoint['requests'] for endpoint in requests.values())
+    if isinstance(devices, str):
+        # a recorded fleet
+        devices = '{} ({} devices)'.format(devices, best['devices'])
+    else:
+        devices = '{} devices'.format(devices)
+    print('{} (best of {})'.format(devices, len(runs)), file=out)
+    print('  wall time:    {:.3f} s'.format(best['wall_time']), file=out)
+    print('  report build: {:.3f} s ({})'.format(best['report_time'], mib(best['report_bytes'])), file=out)
+    print('  peak memory:  {} max RSS'.format(mib(best['max_rss'])), end='', file=out)
+    if 'traced_peak' in best:
+        print(', {} traced'.format(mib(best['traced_peak'])), end='', file=out)
+    print(file=out)
+    print('  requests:     {}'.format(total), file=out)
+    for endpoint, stats in sorted(requests.items()):
+        print('    {:<8} {requests:>6} ({errors} errors, {not_modified} not modified, {size})'.format(
+            endpoint, size=mib(stats['bytes']), **stats), file=out)
+    print('  errors found: {}'.format(best['errors']), file=out)
+
+
+def main():
+    """Main"""
+
+    parser = ArgumentParser(description='Benchmark DattoCheck.run against a local fake Datto API')
+    parser.add_argument('--devices', type=int, nargs='+', default=[10, 1000],
+                        help='fleet sizes to benchmark (default: 10 1000)')
+    parser.add_argument('--max-agents', type=int, default=4, help='max agents per device')
+    parser.add_argument('--failure-rate', type=float, default=0.1,
+                        help='chance of each kind of device/agent failure')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to each API response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of API requests that fail')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-gzip', action='store_true', help='the fake API never compresses responses')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per fleet size; the best is reported')
+    parser.add_argument('-w', '--workers', type=int, default=8)
+    parser.add_argument('-u', '--unprotected-volumes', action='store_true')
+    parser.add_argument('-b', '--batch', action='store_true')
+    parser.add_argument('-i', '--incremental', action='store_true')
+    parser.add_argument('--cache', action='store_true', help='use the API response cache')
+    parser.add_argument('--warm', action='store_true',
+                        help='measure a second run (warm cache/state/XML index)')
+    parser.add_argument('--rate-limit', type=float, default=1000000,
+                        help='config.API_RATE_LIMIT for the run (default: unlimited)')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='also report the traced Python allocation peak (slows the run)')
+    parser.add_argument('--archive', help="benchmark the fleet recorded in this 'main.py --record' \
+                        directory instead (--devices, --max-agents, --failure-rate are ignored)")
+    parser.add_argument('--json', help='also write all measurements to this JSON file')
+    args = parser.parse_args()
+    if args.archive:
+        args.devices = [args.archive]
+
+    options = {
+        'unprotected': args.unprotected_volumes,
+        'workers': args.workers,
+        'cache': args.cache,
+        'incremental': args.incremental,
+        'batch': args.batch,
+        'warm': args.warm,
+        'tracemalloc': args.tracemalloc,
+        'config': {'MAX_WORKERS': args.workers,
+                   'API_RATE_LIMIT': args.rate_limit,
+                   'API_RATE_BURST': max(1, int(min(args.rate_limit, 1000000))),
+                   'API_BACKOFF': 0.1,
+                   'CHECKPOINT_MAX_AGE': 0},
+    }
+
+    results = {}
+    for devices in args.devices:
+        runs = benchmark(devices, args, options)
+        results[devices] = runs
+        print_summary(devices, runs)
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({'arguments': vars(args), 'results': results}, json_file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# Fake Datto API
+#
+# Local stand-in for the Datto REST and XML APIs, serving a synthetic
+# fleet for benchmarks:
+#   /v1/bcdr/device?_page=N          device listing pages
+#   /v1/bcdr/device/{serial}/asset   asset details
+#   /xml/{key}                       XML status feed
+#   /_stats                          request counts (GET), reset (DELETE)
+#
+# The fleet is synthetic, or recorded from a real fleet with
+# 'main.py --record DIR' (--archive DIR).
+
+# Import: standard
+import gzip
+import hashlib
+import json
+import random
+import threading
+import time
+import zipfile
+from argparse import ArgumentParser
+from datetime import datetime, timedelta, timezone
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+API_PATH = '/v1/bcdr/device'
+XML_PATH = '/xml'
+
+
+class Fleet():
+    """Synthetic fleet of Datto appliances and agents
+
+    devices - number of appliances
+    max_agents - agents per appliance are picked from 0..max_agents
+    failure_rate - chance of each failure (offline appliance, low disk,
+                   failed backup, late off-site, failed screenshot, ...)
+    seed - random seed; the same arguments always build the same fleet
+    """
+
+    def __init__(self, devices=10, max_agents=4, failure_rate=0.1, seed=1):
+        rand = random.Random(seed)
+        now = time.time()
+        self.devices = []
+        self.assets = {}
+        for i in range(devices):
+            serial = 'FAKE{:06d}'.format(i)
+            offline = rand.random() < failure_rate
+            checkin = datetime.now(timezone.utc) - timedelta(minutes=90 if offline else 2)
+            used = rand.randint(100, 5000)
+            available = rand.randint(1, 200) if rand.random() < failure_rate else rand.randint(1000, 9000)
+            self.devices.append({
+                'name': 'appliance-{:06d}'.format(rand.randrange(devices * 10)),
+                'hidden': rand.random() < 0.02,
+                'activeTickets': rand.randint(1, 3) if rand.random() < failure_rate else 0,
+                'lastSeenDate': checkin.strftime('%Y-%m-%dT%H:%M:%S+00:00'),
+                'localStorageUsed': {'size': used, 'units': 'GiB'},
+                'localStorageAvailable': {'size': available, 'units': 'GiB'},
+                'serialNumber': serial,
+            })
+
+            agents = []
+            for j in range(rand.randint(0, max_agents)):
+                failed = rand.random() < failure_rate
+                screenshot_ok = rand.random() >= failure_rate
+                agents.append({
+                    'name': 'agent-{}'.format(j),
+                    'localIp': '10.0.{}.{}'.format(i % 256, j),
+                    'os': 'Windows Server 2019',
+                    'unprotectedVolumeNames': ['E:'] if rand.random() < failure_rate else [],
+                    'agentVersion': '2.0.0',
+                    'isPaused': rand.random() < 0.02,
+                    'isArchived': rand.random() < 0.02,
+                    'latestOffsite': None if rand.random() < failure_rate / 2 else
+                                     now - rand.choice([3600, 3600 * 24 * 4, 3600 * 24 * 10]
+                                                       if rand.random() < failure_rate else [3600]),
+                    'lastSnapshot': now - (3600 * rand.choice([20, 24 * 9]) if failed else 600),
+                    'lastScreenshotAttempt': now - rand.choice([3600, 3600 * 24 * 3, 3600 * 24 * 9]
+                                                              if rand.random() < failure_rate else [3600]),
+                    'lastScreenshotAttemptStatus': screenshot_ok,
+                    'lastScreenshotUrl': 'https://device.dattobackup.com/sirisReporting/images/latest/{}-{}.png'.format(serial, j),
+                    'fqdn': 'agent-{}.example.com'.format(j),
+                    'type': 'agent' if rand.random() < 0.9 else 'share',
+                    'backups': [] if rand.random() < 0.02 else [{
+                        'backup': {'status': 'failed' if failed else 'success',
+                                   'errorMessage': 'Backup failed' if failed else None},
+                        'localVerification': {'errors': [{'errorType': 'screenshot',
+                                                          'errorMessage': 'Verification failed'}]
+                                              if rand.random() < failure_rate / 2 else []},
+                    }] * rand.randint(1, 5),
+                })
+            self.assets[serial] = agents
+        self._xml = None
+        self.captured = None
+
+    @classmethod
+    def from_archive(cls, directory):
+        """Fleet recorded with 'main.py --record DIR'; 'captured' is the
+        capture time (check it as of then, as the listing's checkin
+        times are those of the capture)"""
+
+        fleet = cls(devices=0)
+        directory = Path(directory)
+        with open(directory / 'index.json') as index_file:
+            index = json.load(index_file)
+        fleet.captured = datetime.fromisoformat(index['captured'])
+        pages = []
+        with zipfile.ZipFile(directory / 'responses.zip') as archive:
+            for key, entry in index['responses'].items():
+                body = archive.read(entry['member'])
+                if key == 'xml':
+                    fleet._xml = body
+                elif key.startswith('rest?'):
+                    pages.append((int(parse_qs(key[len('rest?'):])['_page'][0]), json.loads(body)['items']))
+                elif key.endswith('/asset'):
+                    fleet.assets[key.split('/')[-2]] = json.loads(body)
+        for _, items in sorted(pages, key=lambda page: page[0]):
+            fleet.devices.extend(items)
+        return fleet
+
+    def page(self, page, per_page):
+        "Returns a device listing page"
+
+        total_pages = max(1, -(-len(self.devices) // per_page))
+        items = self.devices[(page - 1) * per_page:page * per_page]
+        return {'pagination': {'page': page, 'perPage': per_page,
+                               'totalPages': total_pages, 'count': len(self.devices)},
+                'items': items}
+
+    def xml(self):
+        "Returns the XML status feed (built once)"
+
+        if self._xml is None:
+            parts = ['<?xml version="1.0" encoding="UTF-8"?><Devices>']
+            for device in self.devices:
+                parts.append('<Device><Hostname>{}</Hostname><BackupVolumes>'.format(escape(device['name'])))
+                for agent in self.assets.get(device['serialNumber'], []):
+                    parts.append('<BackupVolume><Volume>{0}</Volume>'
+                                 '<ScreenshotImagePath>https://device.dattobackup.com/sirisReporting/images/latest/{1}.png</ScreenshotImagePath>'
+                                 '<ScreenshotError>Screenshot failed\u000c for {0}</ScreenshotError>'
+                                 '</BackupVolume>'.format(escape(agent['name']), device['serialNumber']))
+                parts.append('</BackupVolumes></Device>')
+            parts.append('</Devices>')
+            self._xml = ''.join(parts).encode()
+        return self._xml
+
+
+class FakeApiServer(ThreadingHTTPServer):
+    """HTTP server for a Fleet
+
+    latency - seconds added to every response
+    error_rate - chance of a request failing with HTTP 500 (or 429
+                 with 'Retry-After', for one in four failures)
+    per_page - devices per listing page
+    compress - gzip responses for clients that accept it
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, fleet, latency=0.0, error_rate=0.0, per_page=100, seed=1, compress=True):
+        super().__init__(address, FakeApiHandler)
+        self.fleet = fleet
+        self.compress = compress
+        self.latency = latency
+        self.error_rate = error_rate
+        self.per_page = per_page
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def count(self, endpoint, status, size):
+        with self.lock:
+            stats = self.stats.setdefault(endpoint, {'requests': 0, 'errors': 0, 'not_modified': 0, 'bytes': 0})
+            stats['requests'] += 1
+            stats['bytes'] += size
+            if status >= 400:
+                stats['errors'] += 1
+            elif status == 304:
+                stats['not_modified'] += 1
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    "Request handler for FakeApiServer"
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes: without TCP_NODELAY,
+    # each keep-alive response would wait on the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body=b'', content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_DELETE(self):
+        with self.server.lock:
+            self.server.stats = {}
+        self.send(204)
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        if url.path == '/_stats':
+            with server.lock:
+                self.send(200, json.dumps(server.stats).encode())
+            return
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if url.path.startswith(XML_PATH + '/'):
+            endpoint, body, content_type = 'xml', server.fleet.xml(), 'text/xml'
+        elif url.path == API_PATH:
+            query = parse_qs(url.query)
+            page = int(query.get('_page', ['1'])[0])
+            per_page = int(query.get('_perPage', [server.per_page])[0])
+            endpoint, body, content_type = 'devices', json.dumps(server.fleet.page(page, per_page)).encode(), 'application/json'
+        elif url.path.startswith(API_PATH + '/') and url.path.endswith('/asset'):
+            serial = url.path.split('/')[-2]
+            if serial not in server.fleet.assets:
+                server.count('asset', 404, 0)
+                self.send(404, json.dumps({'code': 404, 'message': 'Not Found'}).encode())
+                return
+            endpoint, body, content_type = 'asset', json.dumps(server.fleet.assets[serial]).encode(), 'application/json'
+        else:
+            self.send(404)
+            return
+
+        with server.lock:
+            fail = server.random.random() < server.error_rate
+            throttle = fail and server.random.random() < 0.25
+        if fail:
+            server.count(endpoint, 429 if throttle else 500, 0)
+            if throttle:
+                self.send(429, b'{"code": 429, "message": "Too Many Requests"}', headers={'Retry-After': '1'})
+            else:
+                self.send(500, b'<html>Internal Server Error</html>', 'text/html')
+            return
+
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            server.count(endpoint, 304, 0)
+            self.send(304, headers={'ETag': etag})
+            return
+        headers = {'ETag': etag}
+        if server.compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, 6)
+            headers['Content-Encoding'] = 'gzip'
+        server.count(endpoint, 200, len(body))
+        self.send(200, body, content_type, headers)
+
+
+def main():
+    """Main - serve a fake fleet until interrupted"""
+
+    parser = ArgumentParser(description='Serve a synthetic fleet through a fake Datto REST & XML API')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--devices', type=int, default=10)
+    parser.add_argument('--max-agents', type=int, default=4)
+    parser.add_argument('--failure-rate', type=float, default=0.1)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to each response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests that fail')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--archive', help="serve the fleet recorded in this 'main.py --record' directory")
+    parser.add_argument('--no-gzip', action='store_true', help='never compress responses')
+    args = parser.parse_args()
+
+    if args.archive:
+        fleet = Fleet.from_archive(args.archive)
+        print('Fleet captured {}'.format(fleet.captured.isoformat()))
+    else:
+        fleet = Fleet(args.devices, args.max_agents, args.failure_rate, args.seed)
+    server = FakeApiServer(('127.0.0.1', args.port), fleet, args.latency, args.error_rate, seed=args.seed,
+                           compress=not args.no_gzip)
+    print('Serving {} devices on http://127.0.0.1:{}{}'.format(len(fleet.devices), server.server_port, API_PATH))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# SMTP Sink
+#
+# Local debugging SMTP server: accepts every message and prints a summary
+# (or saves each message to a directory), so email delivery can be tested
+# without a real mail server. Point the program at it with:
+#   EMAIL_MX = 'localhost'; EMAIL_PORT = 1025; EMAIL_SSL = False; EMAIL_PW = ''
+
+# Import: standard
+import socketserver
+import threading
+from argparse import ArgumentParser
+from email import message_from_bytes
+from pathlib import Path
+
+
+class SmtpSinkHandler(socketserver.StreamRequestHandler):
+    "One SMTP session (no STARTTLS or AUTH)"
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        server.count('connections')
+        self.reply('220 smtp-sink ready')
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip()
+            verb = command[:4].upper()
+
+            if verb in ('MAIL', 'RCPT', 'DATA') and server.should_fail():
+                self.reply('451 temporary failure (injected)')
+            elif verb in ('EHLO', 'HELO'):
+                self.reply('250 smtp-sink')
+            elif verb == 'MAIL':
+                sender, recipients = command[10:].strip(), []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command[8:].strip())
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line in (b'.\r\n', b'.\n'):
+                        break
+                    data.append(line[1:] if line.startswith(b'..') else line)
+                server.received(sender, recipients, b''.join(data))
+                self.reply('250 OK: queued')
+            elif verb in ('RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    """Debugging SMTP server
+
+    directory - save each message there as a .eml file (print a summary otherwise)
+    fail - reply '451' to this many MAIL/RCPT/DATA commands first, to
+           test retries of transient failures
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, directory=None, fail=0):
+        super().__init__(address, SmtpSinkHandler)
+        self.directory = Path(directory) if directory else None
+        self.fail = fail
+        self.lock = threading.Lock()
+        self.stats = {'connections': 0, 'messages': 0}
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def should_fail(self):
+        with self.lock:
+            if self.fail > 0:
+                self.fail -= 1
+                return True
+        return False
+
+    def received(self, sender, recipients, data):
+        self.count('messages')
+        message = message_from_bytes(data)
+        print('Message {} from {} to {}: {}'.format(self.stats['messages'], sender,
+                                                    ', '.join(recipients), message['Subject']))
+        if self.directory:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            path = self.directory / 'message-{:04d}.eml'.format(self.stats['messages'])
+            path.write_bytes(data)
+
+
+def main():
+    """Main - accept messages until interrupted"""
+
+    parser = ArgumentParser(description='Local debugging SMTP server')
+    parser.add_argument('--port', type=int, default=1025)
+    parser.add_argument('--directory', help='save messages here as .eml files')
+    parser.add_argument('--fail', type=int, default=0,
+                        help='reply 451 to this many MAIL/RCPT/DATA commands first')
+    args = parser.parse_args()
+
+    server = SmtpSink(('127.0.0.1', args.port), args.directory, args.fail)
+    print('SMTP sink listening on 127.0.0.1:{}'.format(server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print('{connections} connections, {messages} messages'.format(**server.stats))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# Startup
+#
+# Import-time budget check: imports 'main' (and everything it imports at
+# startup) in a fresh interpreter under '-X importtime', reports the
+# slowest modules and fails if the total is over budget.
+#
+#   python bench/startup.py --budget-ms 50
+#
+# 'config.py' is used if present, otherwise 'config-mk.py'.
+
+# Import: standard
+import subprocess
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# run in the child interpreter: load the config (as bench/benchmark.py
+# does), then import the module being timed
+IMPORT_MAIN = '''
+import importlib.util, sys
+sys.path.insert(0, {root!r})
+try:
+    import config
+except ImportError:
+    spec = importlib.util.spec_from_file_location('config', {config_mk!r})
+    config = importlib.util.module_from_spec(spec)
+    sys.modules['config'] = config
+    spec.loader.exec_module(config)
+import main
+'''
+
+
+def import_times(module='main'):
+    """Import 'module' in a fresh interpreter with -X importtime
+
+    Returns a list of (self microseconds, cumulative microseconds, module name)"""
+
+    code = IMPORT_MAIN.format(root=str(ROOT), config_mk=str(ROOT / 'config-mk.py'))
+    if module != 'main':
+        code = code.replace('import main', 'import ' + module)
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                             stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = []
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times.append((int(self_us), int(cumulative_us), name.strip()))
+    return times
+
+
+def main():
+    """Main"""
+
+    parser = ArgumentParser(description="Check the import time of main.py against a budget")
+    parser.add_argument('--budget-ms', type=float, default=50.0,
+                        help="fail if importing 'main' takes longer (default: 50)")
+    parser.add_argument('--module', default='main', help="module to import (default: main)")
+    parser.add_argument('--top', type=int, default=15, help='list this many of the slowest imports')
+    parser.add_argument('--repeat', type=int, default=5, help='imports to run; the fastest counts')
+    args = parser.parse_args()
+
+    best = None
+    for _ in range(args.repeat):
+        times = import_times(args.module)
+        total = next(cumulative for _, cumulative, name in times if name == args.module)
+        if best is None or total < best[0]:
+            best = (total, times)
+    total, times = best
+
+    # skip the interpreter's own startup imports (site, encodings, ...)
+    names = [name for _, _, name in times]
+    start = names.index('config') if 'config' in names else 0
+    print('Slowest imports (cumulative):')
+    for self_us, cumulative_us, name in sorted(times[start:], key=lambda t: -t[1])[:args.top]:
+        print('  {:>8.1f} ms  {:>8.1f} ms self  {}'.format(cumulative_us / 1000, self_us / 1000, name))
+
+    for heavy in ('requests', 'smtplib', 'xml.etree.ElementTree', 'sqlite3', 'numpy', 'multiprocessing'):
+        if heavy in names:
+            print('  note: {} is imported at startup'.format(heavy))
+
+    print("import {}: {:.1f} ms (budget {:.1f} ms)".format(args.module, total / 1000, args.budget_ms))
+    if total / 1000 > args.budget_ms:
+        print('OVER BUDGET')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
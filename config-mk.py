@@ -17,6 +17,16 @@ AUTH_USER = ''
 AUTH_PASS = ''
 AUTH_XML  = ''
 
+# Multiple partner accounts (optional); each is checked in its own process.
+# When set, the AUTH_* account above is only used in daemon mode. Every
+# entry needs 'name', 'auth_user', 'auth_pass' & 'auth_xml'; 'email_to',
+# 'email_cc', 'api_rate_limit' & 'api_rate_burst' override the defaults.
+TENANTS = [
+    # {'name': 'Partner A', 'auth_user': '', 'auth_pass': '', 'auth_xml': ''},
+]
+TENANT_REPORT = 'merged'                 # 'merged' - one report for all accounts
+                                         # 'separate' - one report per account
+
 # Email configs
 EMAIL_FROM  = ''
 EMAIL_TO    = []
@@ -26,6 +36,18 @@ EMAIL_PW    = ''
 EMAIL_MX    = ''
 EMAIL_PORT  = 25
 EMAIL_SSL   = True
+EMAIL_TIMEOUT = 30                       # SMTP timeout; seconds
+EMAIL_RETRIES = 3                        # tries per message (dropped connections, 4xx replies)
+EMAIL_DEBUG = False                      # print the SMTP conversation
+
+# Extra reports for recipient groups, sent over the same SMTP connection.
+# Each group gets the errors for the appliances matching its 'appliances'
+# patterns (shell-style; all if not set), limited to its 'categories' if
+# set; groups with nothing to report get no email unless 'send_empty'.
+EMAIL_GROUPS = [
+    # {'name': 'ACME Corp', 'email_to': ['it@acme.example'], 'appliances': ['ACME-*']},
+    # {'name': 'NOC', 'email_to': ['noc@example.com'], 'categories': ['critical']},
+]
 
 
 # Error/Alert threshold settings
@@ -36,19 +58,117 @@ LAST_OFFSITE_THRESHOLD = 60 * 60 * 72    # last successful off-site; 72 hrs
 LAST_SCREENSHOT_THRESHOLD = 60 * 60 * 48 # last screenshot taken; 48 hrs
 ACTIONABLE_THRESHOLD = 60 * 60 * 24 * 7  # actionable alerts; 7 days
 
-# Log file location
-if os.name != 'nt':
-    if os.access('/var/log', os.W_OK):
-        # default
-        LOG_DIR = Path("/var/log")
-    elif os.access(os.getcwd(), os.W_OK):
-        # fallback
-        LOG_DIR = Path(os.getcwd())
+# Screenshot source for failed screenshots
+#   'xml'  - look up screenshot URL & error in the XML API (downloaded on first failure)
+#   'rest' - use the agent's lastScreenshotUrl; only fall back to the XML API when missing
+SCREENSHOT_SOURCE = 'xml'
+
+# Failed-screenshot thumbnails in the email report. When embedded, the images
+# are downloaded (cached in CACHE_DIR/screenshots) and attached to the email
+# instead of being loaded from Datto by the mail client.
+SCREENSHOT_EMBED = False
+SCREENSHOT_WORKERS = 4                   # concurrent downloads
+SCREENSHOT_TIMEOUT = (5, 15)             # connect, read timeouts; seconds
+SCREENSHOT_CACHE_TTL = 60 * 60           # seconds to serve without revalidating
+SCREENSHOT_CACHE_MAX_BYTES = 64 * 1024 * 1024   # evict least recently used past this
+
+# Concurrency
+MAX_WORKERS = 8                          # concurrent asset detail requests
+
+# Batched agent checks (-b); uses numpy when installed
+BATCH_CHECKS = False
+BATCH_SIZE = 10000                       # agents per batch
+
+# API request scheduling
+API_RATE_LIMIT = 10                      # average requests per second
+API_RATE_BURST = 20                      # max burst of requests
+API_RETRIES = 4                          # tries per request (429, 5xx, network errors)
+API_BACKOFF = 1.0                        # initial retry backoff; seconds, doubling
+API_MAX_RETRY_AFTER = 60                 # longest 'Retry-After' waited for; seconds
+
+# HTTP transport (REST & XML API)
+HTTP_POOL_SIZE = None                    # keep-alive connections per host; None: 2 x MAX_WORKERS
+HTTP_TIMEOUT = (10, 60)                  # connect, read timeouts; seconds
+HTTP_COMPRESSION = True                  # ask for gzip compressed responses
+
+# On-disk API response cache (disable per run with --no-cache)
+CACHE_DIR = Path.home() / '.cache' / 'datto_check'
+CACHE_MAX_BYTES = 256 * 1024 * 1024      # evict least recently used past this
+CACHE_TTL = {                            # seconds to serve without revalidating
+    'devices': 60 * 2,
+    'asset': 60 * 5,
+    'xml': 60 * 15,
+}
+
+# Checkpoint of fetched API data; a failed run started less than this long
+# ago is resumed instead of starting over (0 disables). Keep it short:
+# resumed device pages carry their original checkin times.
+CHECKPOINT_MAX_AGE = 60 * 10
+
+# Incremental runs (-i); saved agent data is refetched once older than this
+STATE_FILE = CACHE_DIR / 'state.json'
+INCREMENTAL_MAX_AGE = 60 * 60 * 6
+
+# Metrics history (local storage, backup & off-site times), appended to by
+# every run; None disables it and the disk-fill forecast
+METRICS_FILE = CACHE_DIR / 'metrics.sqlite'
+METRICS_RAW_DAYS = 7                     # then downsampled to hourly averages
+METRICS_HOURLY_DAYS = 90                 # then downsampled to daily averages
+METRICS_MAX_DAYS = 400                   # then dropped
+
+# Disk-fill forecast: flag appliances whose local storage is projected to
+# exceed STORAGE_PCT_THRESHOLD within FORECAST_DAYS days (0 disables)
+FORECAST_DAYS = 14
+FORECAST_WINDOW_DAYS = 30                # history the projection is fitted to
+FORECAST_MIN_SAMPLES = 6                 # fewer samples than this: no projection
+
+# Circuit breakers: an appliance whose asset details fail on BREAKER_FAILURES
+# runs in a row is not queried for BREAKER_COOLDOWN seconds (doubling with
+# each further failure, up to BREAKER_MAX_COOLDOWN); None disables them
+BREAKER_FILE = CACHE_DIR / 'breakers.json'
+BREAKER_FAILURES = 3
+BREAKER_COOLDOWN = 60 * 60               # 1 hour
+BREAKER_MAX_COOLDOWN = 60 * 60 * 24      # 1 day
+
+# Runs with --deadline: time kept back for building & sending the report
+DEADLINE_RESERVE = 60 * 2                # seconds
+
+# Daemon mode (-d)
+DAEMON_DEVICE_INTERVAL = 60 * 5          # device checks; 5 minutes
+DAEMON_AGENT_INTERVAL = 60 * 60          # full device & agent checks; 1 hour
+DAEMON_REPORT_TIMES = ['08:00']          # email report; local time, HH:MM
+
+# Run telemetry (phase times, API request stats), written after every run
+TELEMETRY_FILE = CACHE_DIR / 'telemetry.json'   # JSON summary
+TELEMETRY_PROM_FILE = None               # Prometheus textfile collector file, e.g.
+                                         # '/var/lib/node_exporter/textfile/datto_check.prom'
+
+# Log file location; worked out on first use (see __getattr__ below).
+# Set LOG_DIR / LOG_FILE here to override.
+def _log_dir():
+    if os.name != 'nt':
+        if os.access('/var/log', os.W_OK):
+            # default
+            return Path("/var/log")
+        elif os.access(os.getcwd(), os.W_OK):
+            # fallback
+            return Path(os.getcwd())
+        else:
+            # last resort
+            return Path('/tmp')
     else:
-        # last resort
-        LOG_DIR = Path('/tmp')
-else:
-    # for Windows, use current directory
-    LOG_DIR = Path(os.getcwd())
+        # for Windows, use current directory
+        return Path(os.getcwd())
+
 
-LOG_FILE = (LOG_DIR / 'datto_check.log')
+def __getattr__(name):
+    "Settings resolved lazily, so importing the config has no side effects"
+
+    if name == 'LOG_DIR':
+        value = _log_dir()
+    elif name == 'LOG_FILE':
+        value = (globals().get('LOG_DIR') or __getattr__('LOG_DIR')) / 'datto_check.log'
+    else:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    globals()[name] = value
+    return value
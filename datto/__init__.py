@@ -8,5 +8,14 @@ datto.py:
 class Datto() - session & communication with the API
 class DattoCheck() - operational functions to run the checks"""
 
-from .datto import DattoCheck
-from .api import Api
+
+# DattoCheck and Api are loaded on first use, so importing a single
+# submodule (datto.results, datto.shards, ...) stays cheap
+_exports = {'DattoCheck': 'datto.datto', 'Api': 'datto.api'}
+
+
+def __getattr__(name):
+    if name in _exports:
+        import importlib
+        return getattr(importlib.import_module(_exports[name]), name)
+    raise AttributeError("module 'datto' has no attribute {!r}".format(name))
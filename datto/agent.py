@@ -16,24 +16,33 @@ logger = logging.getLogger("Datto Check")
 
 
 class Agent(Base):
-    "Datto Agent"
+    """Datto Agent
 
-    def __init__(self, api, agent, device, results, include_unprotected):
+    Only the fields read by the checks are kept; the raw asset record
+    (and its backup history) is not referenced once constructed."""
+
+    __slots__ = ('device_name', 'name', 'unprotected_volumes', 'is_paused',
+                 'is_archived', 'latest_offsite', 'last_snapshot',
+                 'last_screenshot_attempt', 'last_screenshot_status',
+                 'last_screenshot_url', 'type', 'has_local_backups',
+                 'last_backup_status', 'last_backup_error',
+                 'verification_errors', 'backup_failure')
+
+    # asset details fields read by the checks (see slim())
+    FIELDS = ('name', 'unprotectedVolumeNames', 'isPaused', 'isArchived',
+              'latestOffsite', 'lastSnapshot', 'lastScreenshotAttempt',
+              'lastScreenshotAttemptStatus', 'lastScreenshotUrl', 'type')
+
+    def __init__(self, agent, device_name):
         "Constructor"
         super()
-        self.include_unprotected = include_unprotected
-        self.api = api
-        self.results = results
         self.backup_failure = False
-        self.device = device
+        self.device_name = device_name
 
         # agent-specific properties
         self.has_local_backups = True
         self.name = agent['name']
-        self.local_ip = agent['localIp']
-        self.os = agent['os']
         self.unprotected_volumes = agent['unprotectedVolumeNames']
-        self.agent_version = agent['agentVersion']
         self.is_paused = agent['isPaused']
         self.is_archived = agent['isArchived']
         self.latest_offsite = agent['latestOffsite']
@@ -41,31 +50,52 @@ class Agent(Base):
         self.last_screenshot_attempt = agent['lastScreenshotAttempt']
         self.last_screenshot_status = agent['lastScreenshotAttemptStatus']
         self.last_screenshot_url = agent['lastScreenshotUrl']
-        self.fqdn = agent['fqdn']
-        self.backups = agent['backups']
         self.type = agent['type']
         try:
-            self.last_backup = self.backups[0]
-            self.last_backup_status = self.last_backup['backup']['status']
-            self.last_backup_error = self.last_backup['backup']['errorMessage']
-            self.verification_errors = self.last_backup['localVerification']['errors']
+            last_backup = agent['backups'][0]
+            self.last_backup_status = last_backup['backup']['status']
+            self.last_backup_error = last_backup['backup']['errorMessage']
+            self.verification_errors = last_backup['localVerification']['errors']
         except IndexError:
+            self.has_local_backups = False
+            self.last_backup_status = None
+            self.last_backup_error = None
+            self.verification_errors = None
+
+    @classmethod
+    def slim(cls, agent):
+        """Reduce an asset details agent record to the fields read by the
+        checks; of the backup history, only the last backup is kept"""
+
+        slim = {field: agent[field] for field in cls.FIELDS}
+        slim['backups'] = []
+        if agent['backups']:
+            last_backup = agent['backups'][0]
+            slim['backups'].append({
+                'backup': {'status': last_backup['backup']['status'],
+                           'errorMessage': last_backup['backup']['errorMessage']},
+                'localVerification': {'errors': last_backup['localVerification']['errors']}})
+        return slim
+
+    def check_local_backups(self, results):
+        "Report agents with no local backups"
+
+        if not self.has_local_backups:
             error_text = 'Agent does not seem to have any backups'
             logger.debug(' ' * 8 + '%s', error_text)
-            self.results.append_error(['informational', self.device.name, self.name, error_text])
-            self.has_local_backups = False
+            results.append_error(['informational', self.device_name, self.name, error_text])
 
     def is_inactive(self):
         """Check agent paused and archive status to determine
         whether or not the agent is active."""
         return (self.is_archived or self.is_paused)
 
-    def check_last_backup_time(self):
+    def check_last_backup_time(self, results, now=None):
         """Check if the most recent backup was more
         than LAST_BACKUP_THRESHOLD"""
 
         last_backup_time = datetime.fromtimestamp(self.last_snapshot, timezone.utc)
-        now = datetime.now(timezone.utc)
+        now = now or datetime.now(timezone.utc)
         time_diff = (now - last_backup_time).total_seconds()
 
         if time_diff > config.LAST_BACKUP_THRESHOLD and self.last_backup_status != 'success':
@@ -81,26 +111,26 @@ class Agent(Base):
             self.backup_failure = True
 
             error_data = ['backup_error',
-                          self.device.name,
+                          self.device_name,
                           self.name,
                           '{}'.format(last_snapshot_time),
                           backup_error]
 
             if time_diff > config.ACTIONABLE_THRESHOLD and self.last_snapshot:
-                self.results.append_error(error_data, color='red')
+                results.append_error(error_data, color='red')
             else:
-                self.results.append_error(error_data)
+                results.append_error(error_data)
             logger.debug(' ' * 8 + 'Last scheduled backup at %s has failed (%s)',
                          last_snapshot_time, backup_error)
 
-    def check_last_offsite_time(self):
+    def check_last_offsite_time(self, results, now=None):
         "Check if latest off-site point exceeds LAST_OFFSITE_THRESHOLD"
 
-        now = datetime.now(timezone.utc)
+        now = now or datetime.now(timezone.utc)
 
         if not self.latest_offsite:
             error_text = 'No off-site backup points exist'
-            self.results.append_error(['informational', self.device.name, self.name, error_text])
+            results.append_error(['informational', self.device_name, self.name, error_text])
             logger.debug(' ' * 8 + '%s', error_text)
         elif not self.backup_failure:
             last_offsite = datetime.fromtimestamp(self.latest_offsite, timezone.utc)
@@ -108,19 +138,19 @@ class Agent(Base):
             if time_diff > config.LAST_OFFSITE_THRESHOLD:
                 error_text = 'Last off-site: {} ago'.format(self.display_time(time_diff))
                 if time_diff > config.ACTIONABLE_THRESHOLD:
-                    self.results.append_error(['offsite_error',
-                                               self.device.name,
-                                               self.name,
-                                               error_text],
-                                              'red')
+                    results.append_error(['offsite_error',
+                                          self.device_name,
+                                          self.name,
+                                          error_text],
+                                         'red')
                 else:
-                    self.results.append_error(['offsite_error', self.device.name, self.name, error_text])
+                    results.append_error(['offsite_error', self.device_name, self.name, error_text])
                 logger.debug(' ' * 8 + '%s', error_text)
 
-    def check_last_screenshot_time(self):
+    def check_last_screenshot_time(self, results, now=None):
         "Check if time of latest screenshot exceeds LAST_SCREENSHOT_THRESHOLD"
 
-        now = datetime.now(timezone.utc)
+        now = now or datetime.now(timezone.utc)
         if self.type == 'agent' and self.last_screenshot_attempt and not self.backup_failure:
             last_screenshot = datetime.fromtimestamp(self.last_screenshot_attempt,
                                                      timezone.utc)
@@ -128,52 +158,56 @@ class Agent(Base):
             if time_diff > config.LAST_SCREENSHOT_THRESHOLD:
                 error_text = 'Last screenshot was {} ago.'.format(self.display_time(time_diff))
                 if time_diff > config.ACTIONABLE_THRESHOLD:
-                    self.results.append_error(['screenshot_error', self.device.name,
-                                      self.name, error_text, '', 'red'])
+                    results.append_error(['screenshot_error', self.device_name,
+                                      self.name, error_text], 'red')
                 else:
-                    self.results.append_error(['screenshot_error', self.device.name,
+                    results.append_error(['screenshot_error', self.device_name,
                                       self.name, error_text])
                 logger.debug(' ' * 8 + '%s', error_text)
 
-    def check_last_screenshot_status(self):
+    def check_last_screenshot_status(self, api, results):
         "Check status of last screenshot attempt"
 
         if not self.backup_failure and self.type == 'agent' and not self.last_screenshot_status:
             error_text = 'Last screenshot attempt failed!'
-            screenshot = self.api.get_agent_screenshot(self.device.name, self.name)
-
-            self.results.append_error(['screenshot_error',
-                                       self.device.name,
-                                       self.name,
-                                       screenshot])
+            screenshot = api.get_screenshot(self.device_name,
+                                                 self.name,
+                                                 self.last_screenshot_url)
+
+            error_data = ['screenshot_error', self.device_name, self.name, error_text]
+            if screenshot:
+                error_data.extend(screenshot)
+            results.append_error(error_data)
             logger.debug(' ' * 8 + '%s', error_text)
 
-    def check_local_verification(self):
+    def check_local_verification(self, results):
         "Check local verification and report any errors"
 
-        if not self.backup_failure and self.type == 'agent' and self.backups and self.verification_errors:
+        if not self.backup_failure and self.type == 'agent' and self.has_local_backups and self.verification_errors:
             for error in self.verification_errors:
                 error_text = 'Local Verification Failure!\n{}\n{}'.format(error['errorType'],error['errorMessage'])
-                self.results.append_error(['verification_error', self.device.name, self.name, error['errorType'], error['errorMessage']])
+                results.append_error(['verification_error', self.device_name, self.name, error['errorType'], error['errorMessage']])
                 logger.debug(' ' * 8 + '%s', error_text)
 
-    def check_unprotected_volumes(self):
+    def check_unprotected_volumes(self, results):
         "Report any unprotected volumes if arg set to true"
 
         if self.unprotected_volumes:
             error_text = 'Unprotected Volumes: {0}'.format(escape(','.join(self.unprotected_volumes)))
-            self.results.append_error(['informational', self.device.name, self.name, error_text])
+            results.append_error(['informational', self.device_name, self.name, error_text])
             logger.debug(' ' * 8 + '%s', error_text)
 
-    def run_agent_checks(self):
-        "Perform agent checks"
+    def run_agent_checks(self, api, results, include_unprotected, now=None):
+        """Perform agent checks
+
+        now - the run's current time (defaults to the time of each check)"""
 
         if self.has_local_backups:
-            self.check_last_backup_time()
-            self.check_last_offsite_time()
-            self.check_last_screenshot_time()
-            self.check_last_screenshot_status()
-            self.check_local_verification()
-
-            if self.include_unprotected:
-                self.check_unprotected_volumes()
+            self.check_last_backup_time(results, now)
+            self.check_last_offsite_time(results, now)
+            self.check_last_screenshot_time(results, now)
+            self.check_last_screenshot_status(api, results)
+            self.check_local_verification(results)
+
+            if include_unprotected:
+                self.check_unprotected_volumes(results)
@@ -5,17 +5,29 @@ handles communication with the Datto API.
 """
 
 # Imports: Standard
+import hashlib
+import itertools
+import json
 import logging
-import sys
-import traceback
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
 from urllib.parse import urlparse
-from html import escape
-from xml.etree import ElementTree as ET
-import requests
-from retry import retry
+
+# requests, sqlite3 and xml.etree are imported where they are first
+# used, so runs that never need them start faster
 
 # Import: local
 import config
+from datto.agent import Agent
+from datto.checkpoint import Checkpoint
+from datto.files import cache_dir, temp_path
+
+from datto.jsonstream import iter_array
+from datto.telemetry import Telemetry
 
 # global logger
 logger = logging.getLogger("Datto Check")
@@ -26,123 +38,811 @@ class DattoApiError(Exception):
     pass
 
 
+class DeadlineExceeded(DattoApiError):
+    """Raised when a request cannot be made before the run deadline."""
+    pass
+
+
+class RequestScheduler():
+    """Central scheduler for Datto API requests
+
+    - token bucket: on average at most 'rate' requests per second, with
+      bursts of up to 'burst' requests
+    - adaptive concurrency: the number of requests in flight is halved on
+      a 429 or 5xx response and raised by one after a full window of
+      healthy responses, up to 'max_concurrency'
+    - 'Retry-After' on a 429/503 response pauses all requests until it
+      passes; a request asked to wait longer than 'max_retry_after'
+      seconds fails instead
+    - failed requests are retried up to 'tries' times with exponential
+      backoff ('backoff' seconds, doubling) and full jitter
+    - with a 'deadline' set (time.monotonic() value), no request is sent
+      or retried after it, and timeouts are cut short to end by it
+    """
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, rate, burst, max_concurrency, tries=4, backoff=1.0, max_backoff=60,
+                 telemetry=None, max_retry_after=None):
+        """Constructor - request attempts are recorded in 'telemetry' (datto.telemetry);
+        'max_retry_after' defaults to 'max_backoff'"""
+
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.tries = tries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after or max_backoff
+        self.telemetry = telemetry or Telemetry()
+
+        self.cond = threading.Condition()
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.limit = max_concurrency
+        self.in_flight = 0
+        self.healthy = 0
+        self.paused_until = 0
+        self.deadline = None
+
+    def _remaining(self, url):
+        "Seconds left before the deadline (None without one); raises DeadlineExceeded once it has passed"
+
+        if self.deadline is None:
+            return None
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded('Run deadline reached: {}'.format(urlparse(url).path))
+        return remaining
+
+    def _acquire(self, url):
+        """Block until a token and a concurrency slot are available; returns
+        the seconds left before the deadline (None without one). Raises
+        DeadlineExceeded if the deadline passes while waiting."""
+
+        with self.cond:
+            while True:
+                remaining = self._remaining(url)
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.in_flight >= self.limit:
+                    wait = None
+                elif self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return remaining
+                if remaining is not None:
+                    wait = remaining if wait is None else min(wait, remaining)
+                self.cond.wait(wait)
+
+    def _release(self, healthy, retry_after=None):
+        """Release a concurrency slot and adapt the concurrency limit.
+
+        healthy - True/False for a good/throttled response, None to leave
+                  the limit alone (connection errors)"""
+
+        with self.cond:
+            self.in_flight -= 1
+            if healthy:
+                self.healthy += 1
+                if self.healthy >= self.limit and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self.healthy = 0
+                    logger.debug('API concurrency raised to %s', self.limit)
+            elif healthy is False:
+                self.healthy = 0
+                if self.limit > 1:
+                    self.limit = max(1, self.limit // 2)
+                    logger.debug('API concurrency lowered to %s', self.limit)
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            self.cond.notify_all()
+
+    @staticmethod
+    def parse_retry_after(value):
+        "Returns the 'Retry-After' header value (seconds or HTTP date) in seconds"
+
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        from email.utils import parsedate_to_datetime
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def request(self, session, url, endpoint=None, **kwargs):
+        """GET a URL with the given requests session, subject to the rate
+        limit, retrying throttled, failed and 5xx requests. Attempts are
+        recorded in the telemetry under 'endpoint'.
+
+        Returns the response; raises DattoApiError once out of retries."""
+
+        import requests
+
+        timeout = kwargs.get('timeout')
+        for attempt in range(1, self.tries + 1):
+            retry_after = None
+            remaining = self._acquire(url)
+            if remaining is not None and timeout is not None:
+                kwargs['timeout'] = tuple(min(value, remaining) for value in timeout) \
+                    if isinstance(timeout, tuple) else min(timeout, remaining)
+            start = time.perf_counter()
+            try:
+                response = session.get(url, **kwargs)
+            except requests.RequestException as e:
+                self._release(None)
+                self.telemetry.request(endpoint, time.perf_counter() - start, failed=True)
+                error = e
+            else:
+                failed = response.status_code >= 400
+                self.telemetry.request(endpoint, time.perf_counter() - start, failed)
+                if response.status_code not in self.RETRY_STATUS:
+                    self._release(True)
+                    return response
+                retry_after = self.parse_retry_after(response.headers.get('Retry-After'))
+                error = 'HTTP {}'.format(response.status_code)
+                response.close()
+                if retry_after is not None and retry_after > self.max_retry_after:
+                    # a long pause would stall every other request with it
+                    self._release(False)
+                    raise DattoApiError('Request failed: {} ({}, Retry-After {:.0f}s is over {}s)'.format(
+                        urlparse(url).path, error, retry_after, self.max_retry_after))
+                self._release(False, retry_after)
+
+            if attempt == self.tries:
+                raise DattoApiError('Request failed after {} tries: {} ({})'.format(
+                    attempt, urlparse(url).path, error))
+            if retry_after is None:
+                retry_after = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+            remaining = self._remaining(url)
+            if remaining is not None and retry_after >= remaining:
+                raise DeadlineExceeded('Run deadline reached: {} ({})'.format(urlparse(url).path, error))
+            logger.warning('API request failed (%s); retrying in %.1f seconds', error, retry_after)
+            self.telemetry.retry(endpoint)
+            time.sleep(retry_after)
+
+
+class Transport():
+    """HTTP transport shared by the REST and XML API clients
+
+    One requests session for both, with a pool of keep-alive connections
+    per host (config.HTTP_POOL_SIZE; by default twice config.MAX_WORKERS,
+    as listing pages and asset details are fetched at the same time),
+    connect/read timeouts (config.HTTP_TIMEOUT) and gzip compressed
+    responses (config.HTTP_COMPRESSION), decompressed as they stream in.
+    Requests go through the RequestScheduler (rate limit & retries). For
+    each response body read, the bytes received (before and after
+    decompression) and the time taken are recorded in the telemetry.
+    """
+
+    def __init__(self, scheduler, telemetry, pool_size=None, timeout=None, compression=None):
+        "Constructor"
+
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.scheduler = scheduler
+        self.telemetry = telemetry
+        pool_size = pool_size or getattr(config, 'HTTP_POOL_SIZE', None) or 2 * getattr(config, 'MAX_WORKERS', 8)
+        self.timeout = timeout or getattr(config, 'HTTP_TIMEOUT', (10, 60))
+        if compression is None:
+            compression = getattr(config, 'HTTP_COMPRESSION', True)
+
+        self.session = requests.Session()
+        self.session.headers['Accept-Encoding'] = 'gzip' if compression else 'identity'
+        # one pool per host (REST & XML API); connections are kept alive
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, url, endpoint, **kwargs):
+        """Send a GET request through the scheduler; returns the response,
+        whose body is read with iter_body()"""
+
+        return self.scheduler.request(self.session, url, endpoint, stream=True,
+                                      timeout=self.timeout, **kwargs)
+
+    def iter_body(self, response, endpoint, chunk_size=64 * 1024):
+        """Generator: the response body, decompressed, as it arrives
+
+        Raises DattoApiError if the connection fails or times out."""
+
+        import requests
+
+        start = time.perf_counter()
+        size = 0
+        try:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                size += len(chunk)
+                yield chunk
+        except requests.RequestException as e:
+            raise DattoApiError('Reading the API response failed: {} ({})'.format(urlparse(response.url).path, e))
+        # bytes read from the connection, before decompression
+        wire_size = response.raw.tell() if hasattr(response.raw, 'tell') else size
+        self.telemetry.received(endpoint, size, wire_size)
+        self.telemetry.transfer(endpoint, time.perf_counter() - start)
+
+    def close(self):
+        "Close the session and its connections"
+
+        self.session.close()
+
+
+class ResponseCache():
+    """On-disk HTTP response cache
+
+    An SQLite index maps each URL to the 'ETag' and 'Last-Modified'
+    headers used to revalidate its response. The bodies are stored as
+    files beside it, written and read back in chunks, so a large body
+    (the XML feed) is never held in memory to be cached. Least recently
+    used entries are evicted once the bodies grow past 'max_bytes'.
+    """
+
+    def __init__(self, directory, max_bytes):
+        "Constructor - open (or create) the cache index"
+
+        import sqlite3
+
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.directory / 'index.sqlite'), check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS responses (
+                                   url TEXT PRIMARY KEY,
+                                   etag TEXT,
+                                   last_modified TEXT,
+                                   fetched REAL,
+                                   accessed REAL,
+                                   size INTEGER)''')
+
+    def body_path(self, url):
+        "Returns the path of the body file for a URL"
+
+        return self.directory / (hashlib.sha1(url.encode()).hexdigest() + '.body')
+
+    def get(self, url):
+        """Returns the cached entry for a URL as a dict, with its body file
+        open for reading ('body'), or None (also if the file has gone)"""
+
+        with self.lock, self.db:
+            row = self.db.execute('''SELECT etag, last_modified, fetched
+                                     FROM responses WHERE url = ?''', (url,)).fetchone()
+            if row is None:
+                return None
+            try:
+                body = open(self.body_path(url), 'rb')
+            except OSError:
+                return None
+            self.db.execute('UPDATE responses SET accessed = ? WHERE url = ?',
+                            (time.time(), url))
+        return {'body': body, 'etag': row[0], 'last_modified': row[1], 'fetched': row[2]}
+
+    def writer(self, url):
+        "Returns a file to write a response body for 'url' into, for put()"
+
+        return open(temp_path(self.body_path(url)), 'wb')
+
+    def put(self, url, body_file, etag=None, last_modified=None):
+        """Store a response body written to a writer() file, then evict old
+        entries if over the size limit"""
+
+        body_file.close()
+        size = os.path.getsize(body_file.name)
+        now = time.time()
+        with self.lock, self.db:
+            os.replace(body_file.name, self.body_path(url))
+            self.db.execute('''INSERT OR REPLACE INTO responses
+                               (url, etag, last_modified, fetched, accessed, size)
+                               VALUES (?, ?, ?, ?, ?, ?)''',
+                            (url, etag, last_modified, now, now, size))
+            self._evict()
+
+    def discard(self, body_file):
+        "Remove a writer() file whose body is not to be stored"
+
+        body_file.close()
+        Path(body_file.name).unlink(missing_ok=True)
+
+    def touch(self, url):
+        "Mark an entry as freshly fetched (after a '304 Not Modified')"
+
+        with self.lock, self.db:
+            self.db.execute('UPDATE responses SET fetched = ? WHERE url = ?',
+                            (time.time(), url))
+
+    def _evict(self):
+        "Remove least recently used entries until the cache fits in max_bytes"
+
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self.db.execute('SELECT url, size FROM responses ORDER BY accessed').fetchall()
+        for url, size in rows:
+            if total <= self.max_bytes:
+                break
+            self.db.execute('DELETE FROM responses WHERE url = ?', (url,))
+            self.body_path(url).unlink(missing_ok=True)
+            total -= size
+            logger.debug('Evicted %s from response cache', url)
+
+    def close(self):
+        "Close the cache index"
+
+        with self.lock:
+            self.db.close()
+
+
+class ResponseWriter():
+    """Saves a response body from the network as it is read: into the
+    response cache (only '200 OK' bodies) and into the archive being
+    recorded. Nothing is saved unless commit() is called."""
+
+    def __init__(self, url, response, endpoint, cache=None, cache_key=None, archive=None):
+        "Constructor"
+
+        self.url = url
+        self.response = response
+        self.endpoint = endpoint
+        self.cache = cache if response.status_code == 200 else None
+        self.cache_key = cache_key
+        self.cache_file = self.cache.writer(cache_key) if self.cache else None
+        self.archive = archive
+        # the archive stores whole bodies; only kept when recording
+        self.received = [] if archive else None
+
+    def write(self, chunk):
+        "Add a chunk of the body"
+
+        if self.cache_file:
+            self.cache_file.write(chunk)
+        if self.received is not None:
+            self.received.append(chunk)
+
+    def commit(self):
+        "Save the body read"
+
+        if self.archive:
+            self.archive.put(self.url, self.endpoint, self.response.status_code, b''.join(self.received))
+        if self.cache_file:
+            self.cache.put(self.cache_key,
+                           self.cache_file,
+                           self.response.headers.get('ETag'),
+                           self.response.headers.get('Last-Modified'))
+            self.cache_file = None
+
+    def close(self):
+        "Drop the body, unless it was saved"
+
+        if self.cache_file:
+            self.cache.discard(self.cache_file)
+            self.cache_file = None
+
+
 class Api():
     """Datto API
 
     Handles the communication with the Datto API.
     """
 
-    def __init__(self):
-        '''Constructor - initialize Python Requests Session and get XML API data'''
-
+    def __init__(self, use_cache=True, tenant=None, archive=None):
+        '''Constructor - initialize Python Requests Session
+
+        XML API data is only downloaded when a screenshot lookup needs it.
+        Responses are served from the on-disk cache (config.CACHE_DIR)
+        unless 'use_cache' is False.
+
+        tenant - partner account settings (an entry of config.TENANTS);
+                 defaults to the config.AUTH_* account
+        archive - datto.archive.ApiArchive: record every response read
+                  into it or, when not recording, answer every request
+                  from it (no request is sent)'''
+
+        tenant = tenant or {}
+        self.auth_user = tenant.get('auth_user', config.AUTH_USER)
+        self.auth_xml = tenant.get('auth_xml', config.AUTH_XML)
+
+        self.auth = (self.auth_user, tenant.get('auth_pass', config.AUTH_PASS))
+
+        self.telemetry = Telemetry()
+        self.scheduler = RequestScheduler(tenant.get('api_rate_limit', getattr(config, 'API_RATE_LIMIT', 10)),
+                                          tenant.get('api_rate_burst', getattr(config, 'API_RATE_BURST', 20)),
+                                          getattr(config, 'MAX_WORKERS', 8),
+                                          getattr(config, 'API_RETRIES', 4),
+                                          getattr(config, 'API_BACKOFF', 1.0),
+                                          telemetry=self.telemetry,
+                                          max_retry_after=getattr(config, 'API_MAX_RETRY_AFTER', 60))
         logger.info('Creating new Python requests session with the API endpoint.')
-        self.session = requests.Session()
-        self.session.auth = (config.AUTH_USER, config.AUTH_PASS)
-        self.session.headers.update({"Content-Type": "application/json"})
+        self.transport = Transport(self.scheduler, self.telemetry)
+
+        self.cache_dir = cache_dir()
+        self.archive = archive
+        self.replaying = archive is not None and not archive.recording
+        self.checkpoint = None
+        self.cache = None
+        self.cache_ttl = getattr(config, 'CACHE_TTL', {})
+        if use_cache:
+            self.cache = ResponseCache(self.cache_dir / 'responses',
+                                       getattr(config, 'CACHE_MAX_BYTES', 256 * 1024 * 1024))
+            # responses used to be cached in a single SQLite file
+            (self.cache_dir / 'responses.sqlite').unlink(missing_ok=True)
+
+        self._screenshot_index = None
+        self._screenshot_lock = threading.Lock()
+
+    @property
+    def screenshot_index(self):
+        """Screenshot index from the XML API; the feed is fetched on first use"""
+
+        with self._screenshot_lock:
+            if self._screenshot_index is None:
+                try:
+                    with self.telemetry.phase('xml'):
+                        self._screenshot_index = self.get_xml_api_data(self.auth_xml)
+                except DattoApiError as e:
+                    logger.error('Screenshot lookups unavailable: %s', e)
+                    self._screenshot_index = {}
+        return self._screenshot_index
+
+    def reset_screenshot_index(self):
+        "Drop the screenshot index, so the next lookup fetches the XML feed again"
+
+        with self._screenshot_lock:
+            self._screenshot_index = None
+
+    def open_checkpoint(self):
+        """Start (or resume) checkpointing fetched device pages and asset
+        details; disabled when config.CHECKPOINT_MAX_AGE is 0"""
+
+        max_age = getattr(config, 'CHECKPOINT_MAX_AGE', 60 * 10)
+        # a checkpoint would hide responses from the archive being recorded
+        if max_age and not self.archive:
+            account = hashlib.sha1(self.auth_user.encode()).hexdigest()[:12]
+            self.checkpoint = Checkpoint(self.cache_dir / 'checkpoint' / account, max_age)
+
+    def close_checkpoint(self, complete):
+        "Stop checkpointing; the checkpoint is only kept if the run did not complete"
+
+        if self.checkpoint and complete:
+            self.checkpoint.clear()
+        self.checkpoint = None
+
+    def _cache_key(self, url):
+        "Cache key for a URL; includes the API user, as REST URLs are shared between accounts"
+
+        return self.auth_user + ' ' + url
+
+    def _cached_get(self, url, endpoint, headers, auth=None):
+        """GET a URL, answering from the response cache where possible.
+
+        Entries younger than the endpoint's TTL (config.CACHE_TTL) are
+        served without a request; older entries are revalidated with
+        'If-None-Match'/'If-Modified-Since'.
+
+        When replaying an archive, every request is answered from it.
+
+        headers/auth - of the request (the REST API's credentials are only
+                       sent to the REST API)
+
+        Returns (body, None) when the cache or archive answered, 'body'
+        being an iterable of chunks; otherwise (None, response): callers
+        read the response with transport.iter_body() and save the bodies
+        they accept through a ResponseWriter (see response_writer())."""
+
+        if self.replaying:
+            body = self.archive.get(url)
+            if body is None:
+                raise DattoApiError('No recorded response for {}'.format(self.archive.key(url)))
+            return [body], None
+
+        cached = self.cache.get(self._cache_key(url)) if self.cache else None
+        headers = dict(headers)
+        if cached:
+            if time.time() - cached['fetched'] < self.cache_ttl.get(endpoint, 0):
+                logger.debug('Cache hit: %s', url)
+                self.telemetry.cache(endpoint)
+                return self._cached_body(url, endpoint, cached['body']), None
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
 
-        self.xml_api_root = self.get_xml_api_data(config.AUTH_XML)
+        try:
+            response = self.transport.get(url, endpoint, headers=headers, auth=auth)
+        except DattoApiError:
+            if cached:
+                cached['body'].close()
+            raise
+        if cached and response.status_code == 304:
+            logger.debug('Cache revalidated: %s', url)
+            self.telemetry.cache(endpoint, revalidated=True)
+            response.close()
+            self.cache.touch(self._cache_key(url))
+            return self._cached_body(url, endpoint, cached['body']), None
+        if cached:
+            cached['body'].close()
+        return None, response
+
+    def _cached_body(self, url, endpoint, body_file, chunk_size=64 * 1024):
+        """Returns the chunks of a cached body (an open file, closed once
+        read); it is also put into the archive being recorded"""
+
+        if self.archive:
+            with body_file:
+                body = body_file.read()
+            self.archive.put(url, endpoint, 200, body)
+            return [body]
+
+        def chunks():
+            with body_file:
+                yield from iter(lambda: body_file.read(chunk_size), b'')
+
+        return chunks()
+
+    def response_writer(self, url, response, endpoint):
+        """Returns a ResponseWriter for a response read from the network,
+        or None if it is neither cached nor recorded (or there is no
+        response: the cache or archive answered)"""
+
+        if response is None or not (self.cache or self.archive):
+            return None
+        return ResponseWriter(url, response, endpoint, self.cache, self._cache_key(url), self.archive)
+
+    def _iter_json(self, url, endpoint, key=None, members=None, digest=None):
+        """Generator: GET a JSON array from the REST API through the response
+        cache, decoding it incrementally and yielding each element as soon
+        as it is complete.
+
+        key/members - the array is the 'key' member of a JSON object; the
+                      other members are decoded into 'members' (see
+                      jsonstream.iter_array)
+        digest - hashlib object updated with the raw response body
+
+        Raises DattoApiError for API error responses (containing 'code',
+        never cached) and invalid JSON."""
+
+        body, response = self._cached_get(url, endpoint, {'Content-Type': 'application/json'}, self.auth)
+        writer = self.response_writer(url, response, endpoint)
+        members = members if members is not None else {}
+
+        def chunks():
+            for chunk in (body if body is not None else self.transport.iter_body(response, endpoint)):
+                if writer:
+                    writer.write(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+                yield chunk
+
+        raw = chunks()
+        try:
+            stream = raw
+            if key is None:
+                # an array is expected; an object is an API error response
+                first = next(stream, b'')
+                stream = itertools.chain([first], stream)
+                if first.lstrip()[:1] == b'{':
+                    error = json.loads(b''.join(stream))
+                    raise DattoApiError('API error ({}) for {}: {}'.format(
+                        error.get('code'), urlparse(url).path, error.get('message', '')))
+            yield from iter_array(stream, key, members)
+            # read anything after the array, so the whole body is kept
+            for _ in raw:
+                pass
+            if 'code' in members:
+                raise DattoApiError('API error ({}) for {}: {}'.format(
+                    members['code'], urlparse(url).path, members.get('message', '')))
+            if writer:
+                writer.commit()
+        except ValueError:
+            raise DattoApiError('Non-JSON response from API (HTTP {}): {}'.format(
+                response.status_code if response is not None else 'cached', urlparse(url).path))
+        finally:
+            if writer:
+                writer.close()
+            if response is not None:
+                response.close()
 
     def get_xml_api_data(self, xml_key):
         """Retrieve and parse data from XML API
-        Returns xml ElementTree of Datto XML content"""
+
+        The XML is streamed through an incremental parser and indexed as it
+        arrives; each 'Device' element is discarded once it has been read.
+
+        Returns dict of (hostname, volume) -> (screenshot uri, screenshot error)"""
+
+        from xml.etree import ElementTree as ET
 
         logger.info('Retrieving Datto XML API data.')
-        xml_request = requests.Session()
-        xml_request.headers.update({"Content-Type": "text/xml"})
         url = config.XML_API_BASE_URI + '/' + xml_key
-        api_xml_data = xml_request.get(url).text.replace(u"\u000C", "")
-        xml_request.close()
+        body, response = self._cached_get(url, 'xml', {'Content-Type': 'text/xml'})
+        chunks = body if body is not None else self.transport.iter_body(response, 'xml')
+        # the body goes to the cache as it is read, not kept in memory
+        writer = self.response_writer(url, response, 'xml')
+        parser = ET.XMLPullParser(events=('start', 'end'))
+        index = {}
+        state = {'depth': 0, 'root': None}
         try:
-            xml_parsed = ET.fromstring(api_xml_data)
-            return xml_parsed
+            for chunk in chunks:
+                if writer:
+                    writer.write(chunk)
+                parser.feed(chunk.replace(b"\x0c", b""))
+                self._index_xml_events(parser, index, state)
+            parser.close()
+            self._index_xml_events(parser, index, state)
+            logger.debug('Indexed %s backup volumes from XML API.', len(index))
+            if writer:
+                writer.commit()
+            return index
         except ET.ParseError as exception:
-            logger.fatal("Failure parsing XML from Datto API!")
-            trace = traceback.format_exc().replace('\n', '<br>')
-            email_body = "<h1>A fatal error occurred:</h1>"
-            email_body += "<h2>Failed to parse XML from Datto API</h2>"
-            email_body += '<h3>{0}</h3><br><pre>{1}</pre>'.format(str(exception), trace)
-            # TODO: send an email!
-            sys.exit(-1)
-
-    @retry(DattoApiError, tries=3, delay=3, logger=logger)
-    def get_devices(self):
-        "Query API assets target to return all Datto Assets"
-
-        devices = []
+            logger.error("Failure parsing XML from Datto API!")
+            raise DattoApiError('Failed to parse XML from Datto API: {}'.format(exception))
+        finally:
+            if writer:
+                writer.close()
+            if response is not None:
+                response.close()
+
+    def _index_xml_events(self, parser, index, state):
+        """Consume pending parser events, adding the screenshot info of each
+        completed top-level 'Device' element to the index"""
+
+        for event, element in parser.read_events():
+            if event == 'start':
+                if state['root'] is None:
+                    state['root'] = element
+                state['depth'] += 1
+                continue
+
+            state['depth'] -= 1
+            if state['depth'] != 1 or element.tag != 'Device':
+                continue
+
+            hostname = element.findtext('Hostname')
+            for backup_volume in element.iterfind('BackupVolumes/BackupVolume'):
+                uri = backup_volume.findtext('ScreenshotImagePath')
+
+                # check to see if the old API is being used; correct if so
+                if uri and 'partners.dattobackup.com' in uri:
+                    uri = self.rebuild_screenshot_url(uri)
+
+                error = backup_volume.findtext('ScreenshotError')
+                if not error:
+                    error = "[error message not available]"
+
+                # first match wins, as with a top-down search of the document
+                index.setdefault((hostname, backup_volume.findtext('Volume')), (uri, error))
+
+            # drop the parsed device so memory stays flat
+            state['root'].clear()
+
+    def get_devices_page(self, page):
+        "Query API assets target for a single page of Datto Assets"
+
+        if self.checkpoint:
+            assets = self.checkpoint.get('pages', page)
+            if assets is not None:
+                logger.debug("Devices page %s loaded from checkpoint.", page)
+                return assets
+
+        logger.debug("Querying API for devices page %s.", page)
+        members = {}
+        with self.telemetry.phase('device_listing'):
+            try:
+                items = list(self._iter_json(config.API_BASE_URI + '?_page=' + str(page), 'devices',
+                                             'items', members))
+            except DeadlineExceeded:
+                raise
+            except DattoApiError as e:
+                raise DattoApiError('Error querying Datto API for devices page {}: {}'.format(page, e)) from e
+        assets = dict(members, items=items)
+        if self.checkpoint:
+            self.checkpoint.put('pages', page, assets)
+        return assets
+
+    def iter_devices(self, workers=None):
+        """Generator: yield Datto Assets as each page of the device listing arrives.
+
+        Page 1 is read first to learn the total page count; the remaining
+        pages are then fetched concurrently (up to 'workers' at a time,
+        defaults to config.MAX_WORKERS); no more pages are requested than
+        are being fetched, so at most 'workers' pages wait in memory for
+        the consumer. Devices are yielded in the order their pages arrive,
+        not sorted. Pages that fail are retried once more after the rest
+        have been read."""
+
         logger.info('Gathering devices info from API')
-        assets = self.session.get(config.API_BASE_URI + '?_page=1').json()
-        if 'code' in assets:
+        try:
+            assets = self.get_devices_page(1)
+        except DattoApiError:
             logger.fatal('Cannot retrieve devices from API endpoint')
-            sys.exit(-1)
-        devices.extend(assets['items'])
+            raise
         total_pages = assets['pagination']['totalPages']
         device_count = assets['pagination']['count']
         logger.debug('API returned %s devices', device_count)
+        yield from assets['items']
 
-        # new request for each page; extend additional 'items' to devices list
+        # remaining pages in parallel; yield each page's 'items' as it lands
+        failed = []
         if total_pages > 1:
-            for page in range(2, total_pages+1):
-                logger.debug("Querying API for additional devices.")
-                assets = self.session.get(config.API_BASE_URI + '?_page=' + str(page)).json()
-                if 'code' in assets:
-                    raise DattoApiError('Error querying Datto API for additional devices')
-                devices.extend(assets['items'])
-
-        # let's sort this thing!
-        devices = sorted(devices, key=lambda i: i['name'].upper())
-        return devices
-
-    @retry(DattoApiError, tries=3, delay=4, logger=logger)
-    def get_asset_details(self, serial_number):
-        """
-        With a device serial number (argument), query the API with it
-        to retrieve JSON data with the asset info for that device.
-
-        Returns JSON data (dictionary) for the device with the given serial number
-        """
+            workers = workers or getattr(config, 'MAX_WORKERS', 8)
+            pages = iter(range(2, total_pages+1))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(self.get_devices_page, page): page
+                           for page in itertools.islice(pages, workers)}
+                while futures:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        page = futures.pop(future)
+                        for next_page in itertools.islice(pages, 1):
+                            futures[executor.submit(self.get_devices_page, next_page)] = next_page
+                        try:
+                            items = future.result()['items']
+                        except DattoApiError as e:
+                            logger.warning('Devices page %s failed (%s); retrying after the remaining pages',
+                                           page, e)
+                            failed.append(page)
+                            continue
+                        yield from items
+
+        # second pass; only the pages that failed are requested again
+        for page in sorted(failed):
+            yield from self.get_devices_page(page)['items']
+
+    def get_agent_data(self, serial_number):
+        """Agent data for a device: each agent record of the asset details
+        is decoded from the streamed response and reduced to the fields the
+        agent checks read (Agent.slim) as it arrives, so a device's full
+        asset details (with their backup history) are never held in memory.
+
+        Returns (list of agent data, sha256 hex digest of the response)"""
+
+        if self.checkpoint:
+            agent_data = self.checkpoint.get('agents', serial_number)
+            if agent_data is not None:
+                logger.debug(" " * 8 + "Agent data loaded from checkpoint.")
+                return agent_data['agents'], agent_data['hash']
 
         logger.debug(" " * 8 + "Querying API for device asset details.")
-        asset_data = self.session.get(config.API_BASE_URI + '/' + serial_number + '/asset').json()
-
-        if 'code' in asset_data:
-            raise DattoApiError(f'    Failed to get asset details from API')
-
-        return asset_data
-
-    def get_agent_screenshot(self, device, agent):
-        """Search the XML API output for a screenshot URL for the device & agent.
-
-        Returns:  the screenshot as an HTML element
+        digest = hashlib.sha256()
+        with self.telemetry.phase('asset_fetch'):
+            url = config.API_BASE_URI + '/' + serial_number + '/asset'
+            try:
+                agents = [Agent.slim(agent) for agent in self._iter_json(url, 'asset', digest=digest)]
+            except DeadlineExceeded:
+                # not an API failure; the device is skipped, not retried
+                raise
+            except DattoApiError as e:
+                raise DattoApiError('Failed to get asset details from API: {}'.format(e)) from e
+
+        if self.checkpoint:
+            self.checkpoint.put('agents', serial_number, {'agents': agents, 'hash': digest.hexdigest()})
+        return agents, digest.hexdigest()
+
+    def get_screenshot(self, device, agent, screenshot_url=None):
+        """Get the screenshot URL for the device & agent.
+
+        With config.SCREENSHOT_SOURCE set to 'rest', the agent's REST
+        'lastScreenshotUrl' (screenshot_url) is used; the XML API is only
+        fetched when it is missing. Otherwise, the URL is looked up in the
+        XML API index.
+
+        Returns:  (screenshot uri, screenshot error), or None if not found
         """
 
         logger.debug(" " * 8 + "Retrieving agent screenshot")
-        # Find 'Device' elements.  If it matches, find the target agent and get screenshot URI.
-        for xml_device in self.xml_api_root.findall('Device'):
-
-            # Iterate through devices to find the target device
-            xml_hostname = xml_device.find('Hostname')
-            if xml_hostname.text == device:
-
-                # Iterate through device agents to find target agent
-                backup_volumes = xml_device.find('BackupVolumes')
-                for backup_volume in backup_volumes.findall('BackupVolume'):
-                    xml_agent_name = backup_volume.find('Volume')
-
-                    # If agent name matches, get screenshot URI and return
-                    if xml_agent_name.text == agent:
-                        uri = backup_volume.find('ScreenshotImagePath').text
-
-                        # check to see if the old API is being used; correct if so
-                        if 'partners.dattobackup.com' in uri:
-                            uri = self.rebuild_screenshot_url(uri)
-
-                        if backup_volume.find('ScreenshotError').text:
-                            error = escape(backup_volume.find('ScreenshotError').text)
-                        else:
-                            error = "[error message not available]"
-                        screenshot = f'<a href="{uri}"><img src="{uri}" alt="" width="160" title="{error}"></img></a>'
-                        return screenshot
-        return(-1)
+        if getattr(config, 'SCREENSHOT_SOURCE', 'xml') == 'rest' and screenshot_url:
+            return (screenshot_url, "[error message not available]")
+        return self.screenshot_index.get((device, agent))
 
     def rebuild_screenshot_url(self, url):
         '''Rebuild the URL using the new images URL'''
@@ -154,6 +854,8 @@ class Api():
         return new_url
 
     def session_close(self):
-        """Close the "requests" session"""
+        """Close the "requests" session and the response cache"""
 
-        return self.session.close()
+        if self.cache:
+            self.cache.close()
+        self.transport.close()
@@ -0,0 +1,110 @@
+# Archive
+#
+# Record & replay of Datto API traffic: '--record DIR' saves every API
+# response the checks read into a compressed, indexed archive, and
+# '--replay DIR' runs the checks from it without the network.
+
+# Import: standard
+import json
+import logging
+import threading
+import zipfile
+from datetime import datetime, timezone
+from pathlib import Path
+
+# Import: local
+import config
+from datto.files import atomic_write
+
+logger = logging.getLogger("Datto Check")
+
+
+class ArchiveError(Exception):
+    """Raised when an archive cannot be read or written."""
+    pass
+
+
+class ApiArchive():
+    """Recorded Datto API responses
+
+    DIR/responses.zip holds the response bodies (deflate compressed);
+    DIR/index.json maps each request (see key()) to its zip member, with
+    the endpoint, the HTTP status and the time the capture started. A
+    request read more than once while recording keeps its last response.
+
+    record - create the archive (replacing any archive in 'directory');
+             otherwise open it for replay
+    """
+
+    def __init__(self, directory, record=False):
+        "Constructor - open (or create) the archive"
+
+        self.directory = Path(directory)
+        self.recording = record
+        self.lock = threading.Lock()
+        if record:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            # the index is written last; without it, the archive is incomplete
+            (self.directory / 'index.json').unlink(missing_ok=True)
+            self.captured = datetime.now(timezone.utc)
+            self.responses = {}
+            self.zip = zipfile.ZipFile(self.directory / 'responses.zip', 'w', zipfile.ZIP_DEFLATED)
+            logger.info('Recording API responses to %s', self.directory)
+            return
+
+        try:
+            with open(self.directory / 'index.json') as index_file:
+                index = json.load(index_file)
+            self.captured = datetime.fromisoformat(index['captured'])
+            self.responses = index['responses']
+            self.zip = zipfile.ZipFile(self.directory / 'responses.zip')
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            raise ArchiveError('Unable to open API archive {}: {}'.format(self.directory, e))
+        logger.info('Replaying %s API responses captured %s from %s',
+                    len(self.responses), self.captured.isoformat(), self.directory)
+
+    @staticmethod
+    def key(url):
+        """Archive key for a request URL: relative to the configured API
+        base URIs, so an archive replays against any config. The XML API
+        key is left out; it is a credential."""
+
+        if url.startswith(config.XML_API_BASE_URI + '/'):
+            return 'xml'
+        if url.startswith(config.API_BASE_URI):
+            return 'rest' + url[len(config.API_BASE_URI):]
+        return url
+
+    def put(self, url, endpoint, status, body):
+        "Record a response body"
+
+        key = self.key(url)
+        with self.lock:
+            member = 'responses/{:06d}'.format(len(self.zip.filelist))
+            self.zip.writestr(member, body)
+            self.responses[key] = {'member': member, 'endpoint': endpoint,
+                                   'status': status, 'size': len(body)}
+
+    def get(self, url):
+        "Returns the recorded response body for a URL, or None"
+
+        entry = self.responses.get(self.key(url))
+        if entry is None:
+            return None
+        with self.lock:
+            return self.zip.read(entry['member'])
+
+    def close(self):
+        "Close the archive; a recording is only complete once closed"
+
+        with self.lock:
+            if self.zip is None:
+                return
+            self.zip.close()
+            self.zip = None
+            if not self.recording:
+                return
+            atomic_write(self.directory / 'index.json',
+                         json.dumps({'captured': self.captured.isoformat(),
+                                     'responses': self.responses}, indent=1))
+        logger.info('Recorded %s API responses to %s', len(self.responses), self.directory)
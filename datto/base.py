@@ -2,6 +2,8 @@
 class Base():
     """Base methods for various classes"""
 
+    __slots__ = ()
+
     def __init__(self):
         pass
 
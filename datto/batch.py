@@ -0,0 +1,123 @@
+# Batch
+#
+# Batched threshold evaluation for agent checks. Agents are collected
+# into columnar arrays and every time-based threshold is evaluated in
+# one pass against the run's single 'now'; only agents that may fail a
+# check are then run through the regular per-agent checks, so the
+# findings are identical to checking every agent one at a time.
+#
+# Uses numpy when it is installed, plain Python lists otherwise.
+
+# Import: standard
+import logging
+import math
+
+# Import: optional
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Import: local
+import config
+
+logger = logging.getLogger("Datto Check")
+
+# Timestamps are compared with this much slack (seconds) when picking
+# agents to check, so float rounding can never hide a failing agent;
+# the per-agent checks make the exact comparison.
+SLACK = 1.0
+
+
+def _timestamp(value):
+    "Epoch timestamp column value; missing timestamps become NaN"
+
+    return float(value) if value else math.nan
+
+
+class BatchChecker():
+    """Collects agents and evaluates their checks in batches
+
+    Agents are added in report order with add(); flush() evaluates the
+    batch and appends findings to the results. A batch is flushed
+    automatically once it holds 'batch_size' agents.
+    """
+
+    def __init__(self, api, results, include_unprotected, now, batch_size=None):
+        "Constructor - now is the run's timezone aware current time"
+
+        self.api = api
+        self.results = results
+        self.include_unprotected = include_unprotected
+        self.now = now
+        self.batch_size = batch_size or getattr(config, 'BATCH_SIZE', 10000)
+        self.agents = []
+
+    def add(self, agent):
+        "Queue an agent for checking"
+
+        self.agents.append(agent)
+        if len(self.agents) >= self.batch_size:
+            self.flush()
+
+    def candidates(self):
+        """Returns the indexes of queued agents that may fail a check
+
+        Every threshold is evaluated over whole columns; an agent is a
+        candidate if it has no local backups, or is active and any of
+        its checks could raise a finding."""
+
+        agents = self.agents
+        now = self.now.timestamp()
+
+        # columns
+        snapshot = [_timestamp(agent.last_snapshot) for agent in agents]
+        offsite = [_timestamp(agent.latest_offsite) for agent in agents]
+        screenshot = [_timestamp(agent.last_screenshot_attempt) for agent in agents]
+        no_backups = [not agent.has_local_backups for agent in agents]
+        active = [not agent.is_inactive() for agent in agents]
+        backup_failed = [agent.last_backup_status != 'success' for agent in agents]
+        is_agent = [agent.type == 'agent' for agent in agents]
+        other_errors = [bool((agent.type == 'agent'
+                              and (not agent.last_screenshot_status or agent.verification_errors))
+                             or (self.include_unprotected and agent.unprotected_volumes))
+                        for agent in agents]
+
+        backup_limit = now - config.LAST_BACKUP_THRESHOLD + SLACK
+        offsite_limit = now - config.LAST_OFFSITE_THRESHOLD + SLACK
+        screenshot_limit = now - config.LAST_SCREENSHOT_THRESHOLD + SLACK
+
+        if numpy is not None:
+            snapshot = numpy.array(snapshot)
+            offsite = numpy.array(offsite)
+            screenshot = numpy.array(screenshot)
+            backup = numpy.array(backup_failed) & ~(snapshot >= backup_limit)
+            offsite_late = ~(offsite >= offsite_limit)
+            screenshot_late = numpy.array(is_agent) & (screenshot < screenshot_limit)
+            check = (backup | offsite_late | screenshot_late | numpy.array(other_errors))
+            failing = numpy.array(no_backups) | (numpy.array(active) & check)
+            return numpy.flatnonzero(failing).tolist()
+
+        # NaN compares False, so missing timestamps count as late (as above)
+        return [i for i in range(len(agents))
+                if no_backups[i]
+                or (active[i]
+                    and ((backup_failed[i] and not snapshot[i] >= backup_limit)
+                         or not offsite[i] >= offsite_limit
+                         or (is_agent[i] and screenshot[i] < screenshot_limit)
+                         or other_errors[i]))]
+
+    def flush(self):
+        "Evaluate the queued agents and append their findings to the results"
+
+        if not self.agents:
+            return
+        failing = self.candidates()
+        logger.debug('Batch checked %s agents; %s may have errors', len(self.agents), len(failing))
+        for i in failing:
+            agent = self.agents[i]
+            agent.check_local_backups(self.results)
+            if agent.is_inactive():
+                continue
+            agent.run_agent_checks(self.api, self.results, self.include_unprotected, self.now)
+        self.agents = []
@@ -0,0 +1,92 @@
+# Breakers
+#
+# Per-device circuit breakers for the asset details requests, saved
+# between runs: appliances whose asset details keep failing are left
+# alone for a while instead of being retried on every run.
+
+# Import: standard
+import json
+import logging
+import time
+from pathlib import Path
+
+# Import: local
+import config
+from datto.files import atomic_write
+
+logger = logging.getLogger("Datto Check")
+
+
+class CircuitBreakers():
+    """Per-device circuit breakers, saved between runs
+
+    Each device entry holds its number of consecutive failed asset
+    details fetches, the time until which its breaker is open, the time
+    its agents were last checked, and whether the last run with a
+    deadline skipped it. After config.BREAKER_FAILURES
+    failures in a row, a device's breaker opens for
+    config.BREAKER_COOLDOWN seconds, doubling with each further failure
+    up to config.BREAKER_MAX_COOLDOWN; its asset details are not
+    requested while it is open. Once it closes again, one success
+    resets it.
+    """
+
+    def __init__(self, path, failures=None, cooldown=None, max_cooldown=None):
+        """Constructor - load any saved breakers
+
+        path - breakers file (JSON)
+        failures, cooldown, max_cooldown - default to the config.BREAKER_*
+                                           settings"""
+
+        self.path = Path(path)
+        self.failures = failures or getattr(config, 'BREAKER_FAILURES', 3)
+        self.cooldown = cooldown or getattr(config, 'BREAKER_COOLDOWN', 60 * 60)
+        self.max_cooldown = max_cooldown or getattr(config, 'BREAKER_MAX_COOLDOWN', 60 * 60 * 24)
+        self.devices = {}
+        try:
+            with open(self.path) as breakers_file:
+                self.devices = json.load(breakers_file)['devices']
+            logger.debug('Loaded circuit breakers for %s devices', len(self.devices))
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError) as e:
+            logger.error('Ignoring unreadable circuit breakers file %s: %s', self.path, e)
+
+    def entry(self, serial):
+        "Returns the saved entry for a device (a new, closed one if none)"
+
+        return self.devices.get(serial) or {'failures': 0, 'open_until': 0, 'checked': 0, 'skipped': False}
+
+    def open_until(self, serial):
+        "Returns the time until which a device's breaker is open, or None if closed"
+
+        open_until = self.entry(serial)['open_until']
+        return open_until if open_until > time.time() else None
+
+    def success(self, serial):
+        "Record agent data fetched (or reused) for a device; closes its breaker"
+
+        self.devices[serial] = {'failures': 0, 'open_until': 0, 'checked': time.time(), 'skipped': False}
+
+    def skipped(self, serial):
+        "Record a device left unchecked by a run deadline"
+
+        self.devices[serial] = dict(self.entry(serial), skipped=True)
+
+    def failure(self, serial):
+        "Record a failed asset details fetch; returns True if the breaker opened"
+
+        entry = dict(self.entry(serial))
+        entry['failures'] += 1
+        opened = entry['failures'] >= self.failures
+        if opened:
+            cooldown = self.cooldown * 2 ** min(entry['failures'] - self.failures, 16)
+            entry['open_until'] = time.time() + min(cooldown, self.max_cooldown)
+        self.devices[serial] = entry
+        return opened
+
+    def save(self):
+        """Write the breakers to the breakers file"""
+
+        atomic_write(self.path, json.dumps({'devices': self.devices}))
+        logger.debug('Saved circuit breakers for %s devices', len(self.devices))
@@ -0,0 +1,74 @@
+# Checkpoint
+#
+# Saves each device listing page and asset details payload as it is
+# fetched, so a run that fails part way can resume from where it
+# stopped instead of downloading everything again.
+
+# Import: standard
+import json
+import logging
+import shutil
+import time
+from pathlib import Path
+
+# Import: local
+from datto.files import atomic_write
+
+logger = logging.getLogger("Datto Check")
+
+
+class Checkpoint():
+    """On-disk checkpoint of the API data fetched by a run
+
+    A checkpoint left behind by a failed run is resumed if it was
+    started less than 'max_age' seconds ago; otherwise it is discarded.
+    The checkpoint is removed once a run completes.
+    """
+
+    def __init__(self, directory, max_age):
+        "Constructor - resume or start a checkpoint in 'directory'"
+
+        self.directory = Path(directory)
+        meta_path = self.directory / 'meta.json'
+        try:
+            with open(meta_path) as meta_file:
+                started = json.load(meta_file)['started']
+        except (OSError, ValueError, KeyError):
+            started = None
+
+        if started and time.time() - started < max_age:
+            logger.info('Resuming from checkpoint started at %s',
+                        time.strftime('%H:%M:%S', time.localtime(started)))
+            return
+
+        self.clear()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._write(meta_path, {'started': time.time()})
+
+    def _path(self, kind, key):
+        return self.directory / kind / '{}.json'.format(key)
+
+    @staticmethod
+    def _write(path, data):
+        "Write JSON atomically, so a crash never leaves a partial file"
+
+        atomic_write(path, json.dumps(data))
+
+    def get(self, kind, key):
+        "Returns checkpointed data (e.g. kind 'pages', key 3), or None"
+
+        try:
+            with open(self._path(kind, key)) as data_file:
+                return json.load(data_file)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, kind, key, data):
+        "Checkpoint fetched data"
+
+        self._write(self._path(kind, key), data)
+
+    def clear(self):
+        "Remove the checkpoint"
+
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,137 @@
+# Daemon
+#
+# Long-running "watch" mode: keeps a single DattoCheck (and its warm API
+# session) alive and runs the checks on a schedule instead of once.
+
+# Import: standard
+import logging
+import signal
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Import: local
+import config
+from mail import EmailError
+from datto.api import DattoApiError
+from datto.results import Results
+
+logger = logging.getLogger("Datto Check")
+
+
+class Daemon():
+    """Scheduler for the Datto checks
+
+    - device checks every 'device_interval' seconds; appliances that go
+      offline between reports are alerted on straight away
+    - full device & agent checks every 'agent_interval' seconds
+    - the email report (of the latest full checks) at each of the
+      'report_times' ('HH:MM', local time)
+    """
+
+    def __init__(self, datto_check, device_interval=None, agent_interval=None, report_times=None):
+        "Constructor - intervals and report times default to the config.DAEMON_* settings"
+
+        self.datto_check = datto_check
+        self.device_interval = device_interval or getattr(config, 'DAEMON_DEVICE_INTERVAL', 60 * 5)
+        self.agent_interval = agent_interval or getattr(config, 'DAEMON_AGENT_INTERVAL', 60 * 60)
+        self.report_times = report_times or getattr(config, 'DAEMON_REPORT_TIMES', ['08:00'])
+        self.stop_event = threading.Event()
+        self.offline = None
+        self.latest = None
+
+    def stop(self, *args):
+        "Stop the daemon after the current check (also the SIGTERM/SIGINT handler)"
+
+        logger.info('Stopping Datto check daemon')
+        self.stop_event.set()
+
+    def next_report(self, now):
+        "Returns the next report time after 'now' (datetime)"
+
+        times = []
+        for report_time in self.report_times:
+            hour, minute = (int(value) for value in report_time.split(':'))
+            at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+            if at <= now:
+                at += timedelta(days=1)
+            times.append(at)
+        return min(times)
+
+    def check(self, agent_checks):
+        "Run one round of checks; failures are logged and the daemon carries on"
+
+        try:
+            # a round never resumes an earlier round's checkpoint: its
+            # listing pages would hide appliances gone offline since
+            self.datto_check.run(agent_checks=agent_checks, report=False, checkpoint=False)
+        except DattoApiError as e:
+            logger.error('Datto check failed: %s', e)
+            return
+        except Exception:
+            # e.g. an unexpected API payload or an unwritable state file;
+            # only this round is lost
+            logger.exception('Datto check failed')
+            return
+        if agent_checks:
+            self.latest = self.datto_check.results
+        self.alert_offline(self.datto_check.offline)
+
+    def alert_offline(self, offline):
+        """Email an alert for appliances that have gone offline since the last check.
+        Appliances already offline at startup are left to the report."""
+
+        newly_offline = offline - self.offline if self.offline is not None else set()
+        self.offline = set(offline)
+        if not newly_offline:
+            return
+
+        logger.warning('Appliances offline: %s', ', '.join(sorted(newly_offline)))
+        alert = Results()
+        for appliance in sorted(newly_offline):
+            for category, error in self.datto_check.results.for_device(appliance):
+                if category == 'critical' and error.error_type == 'Appliance Offline':
+                    alert.append_record(category, error)
+        d = datetime.today()
+        self.send_report(alert, 'Datto Appliance Offline: {}'.format(d.strftime('%m/%d/%Y %H:%M')))
+
+    def send_report(self, results, subject=None):
+        "Email a report; failures are logged and the daemon carries on"
+
+        try:
+            self.datto_check.send_report(results, subject)
+        except EmailError as e:
+            logger.error('Sending the report failed: %s', e)
+        except Exception:
+            logger.exception('Sending the report failed')
+
+    def run(self):
+        "Run the checks on schedule until stopped"
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        logger.info('Starting Datto check daemon (devices every %ss, agents every %ss, reports at %s)',
+                    self.device_interval, self.agent_interval, ', '.join(self.report_times))
+
+        next_device = next_agent = time.monotonic()
+        next_report = self.next_report(datetime.now())
+        while not self.stop_event.is_set():
+            now = time.monotonic()
+            if now >= next_agent:
+                self.check(agent_checks=True)
+                next_agent = now + self.agent_interval
+                next_device = now + self.device_interval
+            elif now >= next_device:
+                self.check(agent_checks=False)
+                next_device = now + self.device_interval
+
+            if datetime.now() >= next_report:
+                if self.latest:
+                    self.send_report(self.latest)
+                next_report = self.next_report(datetime.now())
+
+            wait = min(next_agent, next_device) - time.monotonic()
+            wait = min(wait, (next_report - datetime.now()).total_seconds())
+            self.stop_event.wait(max(wait, 0))
+
+        self.datto_check.close()
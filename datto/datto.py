@@ -4,14 +4,26 @@
 
 # Import: standard
 import logging
-from datetime import datetime
+import re
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime, timezone
+from pathlib import Path
 
 # Import: local
 import config
 from mail import Email
-from datto.api import Api
+from report import write_report
+from datto.api import Api, DattoApiError, DeadlineExceeded
+from datto.breakers import CircuitBreakers
 from datto.device import Device
+from datto.files import cache_dir
+
+from datto.metrics import MetricsStore
 from datto.agent import Agent
+from datto.results import Results
+from datto.shards import in_shard
+from datto.state import State
 
 logger = logging.getLogger("Datto Check")
 
@@ -19,112 +31,472 @@ logger = logging.getLogger("Datto Check")
 class DattoCheck():
     "Handles the main functions of the script."
 
-    def __init__(self, include_unprotected):
-        """Constructor"""
+    def __init__(self, include_unprotected, workers=None, use_cache=True, incremental=False,
+                 batch=False, tenant=None, shard=None, sinks=None, archive=None, now=None):
+        """Constructor
+
+        workers - max number of concurrent asset detail requests
+                  (defaults to config.MAX_WORKERS)
+        use_cache - serve API responses from the on-disk response cache
+        incremental - reuse saved agent data for devices that have not
+                      changed since the last run (see datto.state)
+        batch - evaluate agent checks in batches (see datto.batch)
+        tenant - partner account to check (an entry of config.TENANTS);
+                 defaults to the config.AUTH_* account
+        shard - (i, N): only check the devices in shard i of N (see datto.shards)
+        sinks - result sinks, given each finding as soon as it is found
+                (see datto.results.Results)
+        archive - record the API responses into, or replay them from, a
+                  datto.archive.ApiArchive
+        now - run the checks as of this time (a timezone aware datetime,
+              e.g. the capture time of a replayed archive) instead of
+              the time of the run"""
 
-        self.api = Api()
+        self.tenant = tenant
+        self.shard = shard
+        self.api = Api(use_cache, tenant, archive)
+        self.pinned_now = now
+        self.sinks = sinks or []
         self.results = Results()
+        self.offline = set()
         self.include_unprotected = include_unprotected
+        self.workers = workers or getattr(config, 'MAX_WORKERS', 8)
+        self.batch = batch or getattr(config, 'BATCH_CHECKS', False)
+        self.batch_checker = None
+        self.telemetry = self.api.telemetry
+        self.devices = 0
+        self.complete = False
+        self.unchecked = []
+        self.screenshots = None
+        self.state = None
+        cache = cache_dir()
+        # a replay neither reads nor overwrites the state of real runs
+        if incremental and not self.api.replaying:
+            self.state = State(self.run_path(getattr(config, 'STATE_FILE', cache / 'state.json')))
+        self.metrics = None
+        metrics_path = getattr(config, 'METRICS_FILE', cache / 'metrics.sqlite')
+        if metrics_path:
+            self.metrics = MetricsStore(self.run_path(metrics_path))
+        self.breakers = None
+        breakers_path = getattr(config, 'BREAKER_FILE', cache / 'breakers.json')
+        # nothing to protect while replaying
+        if breakers_path and not self.api.replaying:
+            self.breakers = CircuitBreakers(self.run_path(breakers_path))
+        self.stop_at = None
+        self.skipped = []
+
+    def run(self, agent_checks=True, report=True, deadline=None, checkpoint=True):
+        """Run device and agent checks
+
+        agent_checks - when False, only the device checks are run
+        report - send the email report once the checks are done; with
+                 config.SCREENSHOT_EMBED set, failed-screenshot images are
+                 downloaded for it while the checks run
+        deadline - time (datetime) by which the report must be sent: the
+                   checks stop config.DEADLINE_RESERVE seconds before it,
+                   devices are checked in order of priority (see
+                   priority()), and the devices not reached are listed
+                   in a partial report
+        checkpoint - checkpoint the fetched API data, and resume from the
+                     checkpoint of a failed run (agent checks only)
+
+        The run's telemetry is written when it ends (see write_telemetry).
+        The API session stays open between runs; call close() when done."""
+
+        self.telemetry.reset()
+        self.devices = 0
+        self.complete = False
+        recipients = (self.tenant or {}).get('email_to', config.EMAIL_TO) or getattr(config, 'EMAIL_GROUPS', [])
+        if (report and recipients and self.screenshots is None and not self.api.replaying
+                and getattr(config, 'SCREENSHOT_EMBED', False)):
+            from datto.screenshots import ScreenshotPrefetcher
+            self.screenshots = ScreenshotPrefetcher(self.telemetry)
+        self.stop_at = None
+        if deadline:
+            budget = deadline.timestamp() - time.time() - getattr(config, 'DEADLINE_RESERVE', 60 * 2)
+            self.stop_at = time.monotonic() + budget
+            logger.info('Run deadline %s; checks stop in %.0f seconds', deadline.strftime('%H:%M'), budget)
+        self.api.scheduler.deadline = self.stop_at
+        try:
+            self.run_checks(agent_checks, checkpoint)
+            if report:
+                self.send_report()
+        finally:
+            self.api.scheduler.deadline = None
+            self.write_telemetry(agent_checks)
+
+    def run_checks(self, agent_checks=True, checkpoint=True):
+        """Run device and, unless 'agent_checks' is False, agent checks;
+        with 'checkpoint', a failed run's checkpoint is resumed
+
+        The run is a pipeline of generator stages: device listing pages
+        are decoded as they stream in (Api.iter_devices), each device is
+        checked as soon as it is decoded (check_devices), its agent data
+        is fetched and reduced to what the checks read (fetch_agent_data),
+        and agents are built and checked one at a time (run_agent_checks).
+        Each finding reaches the result sinks as it is appended. Apart
+        from the results, memory is bounded by the pages and agent data
+        in flight, not by the size of the fleet."""
+
+        self.results = Results(self.sinks + ([self.screenshots] if self.screenshots else []))
+        self.offline = set()
+        # a long-lived DattoCheck (daemon mode) looks screenshots up in
+        # the current feed, and retries a feed that failed last run
+        self.api.reset_screenshot_index()
 
-    def run(self):
-        """Run device and agent checks"""
+        # one 'now' for every check in the run
+        self.now = self.pinned_now or datetime.now(timezone.utc)
+        if self.batch:
+            # only batched runs need (and load) numpy
+            from datto.batch import BatchChecker
+            self.batch_checker = BatchChecker(self.api, self.results, self.include_unprotected, self.now)
 
-        # Main loop
-        devices = self.api.get_devices()
-        for device in devices:
+        # Fetched pages & agent data are checkpointed; a failed run resumes.
+        # A device-only run needs current listing pages, never resumed ones.
+        if checkpoint and agent_checks:
+            self.api.open_checkpoint()
+        self.unchecked = []
+        self.skipped = []
+        self.storage = {}
+        if self.state:
+            self.state.start()
 
-            # Begin
-            device = Device(device, self.results)
+        devices = self.check_devices(self.list_devices())
+        if agent_checks:
+            for device, agent_data in self.fetch_agent_data(devices):
+                self.run_agent_checks(device, agent_data)
+        else:
+            for _ in devices:
+                pass
+
+        if self.batch_checker:
+            with self.telemetry.phase('checks'):
+                self.batch_checker.flush()
+        if self.metrics:
+            with self.telemetry.phase('metrics'):
+                # a replayed run adds nothing to the history
+                if not self.api.replaying:
+                    self.metrics.commit(self.now.timestamp())
+                self.check_disk_forecast()
+        if self.skipped:
+            logger.warning('Run deadline reached; %s devices were not checked', len(self.skipped))
+        self.complete = not self.unchecked
+        self.api.close_checkpoint(self.complete)
+        if self.state:
+            self.state.save()
+        if self.breakers:
+            self.breakers.save()
+        self.results.sort()
+        logger.info('All checks complete')
+
+    def list_devices(self):
+        """Generator stage: the device listing (Api.iter_devices); in a run
+        with a deadline, it ends early if the deadline is reached"""
+
+        try:
+            yield from self.api.iter_devices(self.workers)
+        except DeadlineExceeded as e:
+            # report what was listed; the rest of the fleet is unknown
+            logger.error('Device listing incomplete: %s', e)
+            self.skipped.append('Device Listing')
+            self.unchecked.append('Device Listing')
+            self.results.append_error(['critical', 'Device Listing', 'Not Checked',
+                                       'Run deadline reached before every device was listed; '
+                                       'unlisted devices were not checked'])
+
+    def check_devices(self, devices):
+        """Generator stage: run the device checks on each device in the
+        listing as it arrives; yields (Device, device listing data) for
+        the active, online devices whose agents are to be checked"""
+
+        for device_data in devices:
+            if self.shard and not in_shard(device_data['serialNumber'], self.shard):
+                continue
+            device = Device(device_data)
+            self.devices += 1
             logger.debug('---- Device: %s ----', device.name)
 
-            # Device checks
             if device.is_inactive():
                 logger.debug('    Device is archived or paused')
                 continue
-            device.run_device_checks()
+            with self.telemetry.phase('checks'):
+                device.run_device_checks(self.results, self.now)
             if device.is_offline:
                 logger.debug('    Device is offline; skipping remaining checks')
+                self.offline.add(device.name)
                 continue
+            if self.metrics:
+                self.record_storage(device)
+            yield device, device_data
 
-            # Agent checks
-            asset_details = self.api.get_asset_details(device.serial_number)
-            for agent in asset_details:
-                agent = Agent(self.api,
-                              agent,
-                              device,
-                              self.results,
-                              self.include_unprotected)
-                logger.debug('    ---- Agent: %s ----', agent.name)
-                if agent.is_inactive():
-                    logger.debug(' ' * 8 + 'Agent is archived or paused')
+    def fetch_agent_data(self, devices):
+        """Generator stage: yields (Device, agent data) for each device
+
+        Agent data is fetched in the background (up to 'workers' requests
+        at a time) while the listing is read on; no more devices are taken
+        from 'devices' than there are requests in flight, and each
+        device's agent data is yielded as soon as it arrives. Devices
+        whose request fails are retried once more at the end.
+
+        In a run with a deadline, the whole listing is read first and the
+        devices are fetched in order of priority(); devices not reached
+        by the deadline are skipped (see skip())."""
+
+        failed = []
+        if self.stop_at is not None:
+            devices = sorted(devices, key=lambda item: self.priority(item[0]), reverse=True)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = {}
+            for device, device_data in devices:
+
+                # Incremental run: reuse saved agent data if nothing changed
+                if self.state:
+                    agent_data = self.state.cached_assets(device_data)
+                    if agent_data is not None:
+                        logger.debug('    Device unchanged since last run; using saved agent data')
+                        if self.breakers:
+                            self.breakers.success(device.serial_number)
+                        yield device, agent_data
+                        continue
+
+                if self.out_of_time():
+                    self.skip(device)
                     continue
-                agent.run_agent_checks()
-        self.api.session_close()
-        logger.info('All checks complete')
+                if self.breaker_open(device):
+                    continue
+                pending[executor.submit(self.api.get_agent_data, device.serial_number)] = (device, device_data)
+                if len(pending) < self.workers * 2:
+                    continue
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from self._agent_data(future, *pending.pop(future), failed)
+
+            for future in as_completed(pending):
+                yield from self._agent_data(future, *pending[future], failed)
+
+        # second pass; only the devices whose agent data failed
+        for device, device_data in failed:
+            if self.out_of_time():
+                self.skip(device)
+                continue
+            try:
+                agent_data, payload_hash = self.api.get_agent_data(device.serial_number)
+            except DeadlineExceeded:
+                self.skip(device)
+                continue
+            except DattoApiError as e:
+                logger.error('Unable to get asset details for %s: %s', device.name, e)
+                self.results.append_error(['critical', device.name, 'API Error',
+                                           'Unable to retrieve agent details; agents were not checked'])
+                self.unchecked.append(device.name)
+                if self.breakers and self.breakers.failure(device.serial_number):
+                    logger.warning('Circuit breaker opened for %s after %s failures in a row',
+                                   device.name, self.breakers.entry(device.serial_number)['failures'])
+                continue
+            self._fetched(device, device_data, agent_data, payload_hash)
+            yield device, agent_data
+
+    def _agent_data(self, future, device, device_data, failed):
+        "Yields (Device, agent data) for a finished request; failures are queued in 'failed'"
 
-        # Main loop done; send report
-        if config.EMAIL_TO:
-            mailer = Email()
+        try:
+            agent_data, payload_hash = future.result()
+        except DeadlineExceeded:
+            self.skip(device)
+            return
+        except DattoApiError as e:
+            logger.warning('Asset details for %s failed (%s); retrying after the remaining devices',
+                           device.name, e)
+            failed.append((device, device_data))
+            return
+        self._fetched(device, device_data, agent_data, payload_hash)
+        yield device, agent_data
 
+    def _fetched(self, device, device_data, agent_data, payload_hash):
+        "Record a device's freshly fetched agent data in the state and breakers"
+
+        if self.state:
+            self.state.update(device_data, agent_data, payload_hash)
+        if self.breakers:
+            self.breakers.success(device.serial_number)
+
+    def priority(self, device):
+        """Scheduling priority of a device in a run with a deadline (higher
+        first): devices whose asset details failed or were skipped last
+        time come first, then by the sum of their checkin gap (relative
+        to config.CHECKIN_LIMIT), their storage use (relative to
+        config.STORAGE_PCT_THRESHOLD) and the time since their agents were
+        last checked (relative to a day), each capped at 1"""
+
+        entry = self.breakers.entry(device.serial_number) if self.breakers else None
+        failed = bool(entry and (entry['failures'] or entry['skipped']))
+        checkin = (self.now - device.last_checkin).total_seconds() / config.CHECKIN_LIMIT
+        total_space = device.storage_used + device.storage_available
+        storage = device.storage_used * 100 / total_space / config.STORAGE_PCT_THRESHOLD if total_space else 0
+        stale = (time.time() - entry['checked']) / (24 * 60 * 60) if entry else 1
+        return failed, sum(min(1, max(0, value)) for value in (checkin, storage, stale))
+
+    def out_of_time(self):
+        "True once a run with a deadline has used up its time for checks"
+
+        return self.stop_at is not None and time.monotonic() >= self.stop_at
+
+    def skip(self, device):
+        "List a device not checked before the run deadline in the report"
+
+        logger.debug('    Run deadline reached; skipping %s', device.name)
+        self.skipped.append(device.name)
+        self.unchecked.append(device.name)
+        if self.breakers:
+            self.breakers.skipped(device.serial_number)
+        self.results.append_error(['critical', device.name, 'Not Checked',
+                                   'Run deadline reached before the agents were checked'])
+
+    def breaker_open(self, device):
+        "True if the device's circuit breaker is open (its agents are then listed as not checked)"
+
+        open_until = self.breakers.open_until(device.serial_number) if self.breakers else None
+        if open_until is None:
+            return False
+        failures = self.breakers.entry(device.serial_number)['failures']
+        logger.debug('    Circuit breaker open; skipping %s', device.name)
+        self.results.append_error(['critical', device.name, 'API Error',
+                                   'Asset details failed on {} runs in a row; not retried until {}'.format(
+                                       failures, datetime.fromtimestamp(open_until).strftime('%m/%d/%Y %H:%M'))])
+        self.unchecked.append(device.name)
+        return True
+
+    def record_storage(self, device):
+        "Add a device's local storage to the metrics history"
+
+        used_pct = device.storage_used_pct()
+        if used_pct is None:
+            return
+        # as check_disk_usage reads it, so a device is flagged by one or the other
+        self.storage[device.serial_number] = (device.name, used_pct)
+        if not self.api.replaying:
+            self.metrics.add_device(self.now.timestamp(), device)
+
+    def check_disk_forecast(self):
+        """Flag the online devices checked this run whose local storage
+        is projected to exceed config.STORAGE_PCT_THRESHOLD within
+        config.FORECAST_DAYS days, from the metrics history"""
+
+        horizon = getattr(config, 'FORECAST_DAYS', 14)
+        if not horizon:
+            return
+        threshold = config.STORAGE_PCT_THRESHOLD
+        for forecast in self.metrics.forecast(self.now.timestamp(), threshold, horizon):
+            if forecast.serial_number not in self.storage:
+                continue
+            name, used_pct = self.storage[forecast.serial_number]
+            # devices over the threshold already have a 'Low Disk Space' error
+            if used_pct > threshold:
+                continue
+            error_text = 'Local storage projected to exceed {}% in {:.1f} days.  Current Usage: {:.2f}% (+{:.2f}% per day)'.\
+                        format(threshold, forecast.days_left, used_pct, forecast.growth_per_day)
+            self.results.append_error(['critical', name, 'Disk Filling Up', error_text])
+            logger.debug('    %s: %s', name, error_text)
+
+    def send_report(self, results=None, subject=None):
+        """Email the report for 'results' (defaults to the last run's results)"""
+
+        tenant = self.tenant or {}
+        if not subject and self.tenant:
             d = datetime.today()
-            subject = 'Daily Datto Check: {}'.format(d.strftime('%m/%d/%Y'))
-
-            report = mailer.build_html_report(self.results.results)
-            mailer.send_email(config.EMAIL_TO, config.EMAIL_FROM, subject, report, config.EMAIL_CC)
-
-
-class Results():
-
-    def __init__(self):
-        "Constructor"
-        # initialize results_data, used for generating html report
-        self.results = {'critical':
-                            {
-                            'name': "CRITICAL ERRORS",
-                            'columns': ['Appliance', 'Error Type', 'Error Details'],
-                            'errors': []
-                            },
-                        'backup_error':
-                            {
-                            'name': "Backup Errors",
-                            'columns': ['Appliance', 'Agent/Share', 'Last Backup', 'Error Details'],
-                            'errors': []
-                            },
-                        'offsite_error':
-                            {
-                            'name': 'Off-site Sync Issues',
-                            'columns': ['Appliance', 'Agent/Share', 'Error Details'],
-                            'errors': []
-                            },
-                        'screenshot_error':
-                            {
-                            'name': 'Screenshot Failures',
-                            'columns': ['Appliance', 'Agent', 'Screenshot/Details'],
-                            'errors': []
-                            },
-                        'verification_error':
-                            {
-                            'name': 'Local Verification Issues',
-                            'columns': ['Appliance', 'Agent', 'Error', 'Details'],
-                            'errors': []
-                            },
-                        'informational':
-                            {
-                            'name': 'Informational',
-                            'columns': ['Appliance', 'Agent/Share', 'Details'],
-                            'errors': []
-                            }
-                        }
-
-    def append_error(self, error_detail, color=None):
-        """Append an error to the results_data list.
-
-            error_detail - List of error data.
-                First and second items are error level, and device name
-        """
-
-        if color:
-            error_detail.append(color)
-
-        self.results[error_detail[0]]['errors'].append(error_detail)
+            subject = 'Daily Datto Check: {} ({})'.format(d.strftime('%m/%d/%Y'), tenant['name'])
+        if results is None and self.skipped:
+            d = datetime.today()
+            subject = '{} - PARTIAL: {} devices not checked'.format(
+                subject or 'Daily Datto Check: {}'.format(d.strftime('%m/%d/%Y')), len(self.skipped))
+        Email(self.telemetry).send_report(results or self.results, subject,
+                                          tenant.get('email_to'), tenant.get('email_cc'),
+                                          # no downloads while replaying
+                                          False if self.api.replaying else self.screenshots)
+
+    def write_report(self, output, report_format='html'):
+        """Write the last run's results to a file ('-' for stdout) as
+        html, json, ndjson or csv"""
+
+        write_report(self.results.results, output, report_format)
+
+    def write_telemetry(self, agent_checks=True):
+        """Write the run's telemetry summary to config.TELEMETRY_FILE (JSON)
+        and config.TELEMETRY_PROM_FILE (Prometheus textfile collector);
+        a replay only logs it. Device-only runs (the daemon's device
+        rounds) write '-devices' variants of both files, so they never
+        replace the figures of the last full run."""
+
+        cache = cache_dir()
+        variant = None if agent_checks else 'devices'
+        json_path = self.run_path(getattr(config, 'TELEMETRY_FILE', cache / 'telemetry.json'), variant)
+        prometheus_path = getattr(config, 'TELEMETRY_PROM_FILE', None)
+        prometheus_path = prometheus_path and self.run_path(prometheus_path, variant)
+        if self.api.replaying:
+            # only logged: the files describe the last real run
+            json_path = prometheus_path = None
+        extra = {'tenant': self.tenant['name']} if self.tenant else {}
+        if self.shard:
+            extra['shard'] = '{}/{}'.format(*self.shard)
+        summary = self.telemetry.write(json_path, prometheus_path,
+                                       agent_checks=agent_checks,
+                                       complete=self.complete,
+                                       devices=self.devices,
+                                       offline=len(self.offline),
+                                       skipped=len(self.skipped),
+                                       errors=dict(self.results.counts),
+                                       **extra)
+        endpoints = summary['endpoints'].values()
+        logger.info('Run took %.1fs; %s API requests (%s retries), %.1f MiB received (%.1f MiB decompressed)',
+                    summary['duration'],
+                    sum(endpoint['requests'] for endpoint in endpoints),
+                    sum(endpoint['retries'] for endpoint in endpoints),
+                    sum(endpoint['wire_bytes'] for endpoint in endpoints) / 1024 / 1024,
+                    sum(endpoint['bytes'] for endpoint in endpoints) / 1024 / 1024)
+        return summary
+
+    def run_path(self, path, variant=None):
+        """Per tenant/shard variant of a state/telemetry file path
+        ('state.json' -> 'state-partner-a-shard-1-of-4.json'); 'variant'
+        is added last ('telemetry.prom' -> 'telemetry-devices.prom')"""
+
+        parts = []
+        if self.tenant:
+            parts.append(re.sub(r'[^a-z0-9]+', '-', self.tenant['name'].lower()).strip('-'))
+        if self.shard:
+            parts.append('shard-{}-of-{}'.format(*self.shard))
+        if variant:
+            parts.append(variant)
+        if not parts:
+            return path
+        path = Path(path)
+        return path.with_name('{}-{}{}'.format(path.stem, '-'.join(parts), path.suffix))
+
+    def close(self):
+        """Close the API session (and the screenshot downloads)"""
 
+        if self.screenshots:
+            self.screenshots.close()
+        if self.metrics:
+            self.metrics.close()
+        self.api.session_close()
+
+    def run_agent_checks(self, device, agent_data):
+        """Run agent checks for each agent in a device's agent data;
+        each Agent is built just before it is checked"""
+
+        logger.debug('---- Agents: %s ----', device.name)
+        with self.telemetry.phase('checks'):
+            for agent in agent_data:
+                agent = Agent(agent, device.name)
+                logger.debug('    ---- Agent: %s ----', agent.name)
+                if self.metrics and not self.api.replaying:
+                    self.metrics.add_agent(self.now.timestamp(), device.serial_number, agent)
+                if self.batch_checker:
+                    self.batch_checker.add(agent)
+                    continue
+                agent.check_local_backups(self.results)
+                if agent.is_inactive():
+                    logger.debug(' ' * 8 + 'Agent is archived or paused')
+                    continue
+                agent.run_agent_checks(self.api, self.results, self.include_unprotected, self.now)
@@ -6,21 +6,27 @@
 # Import: standard
 import logging
 from datetime import datetime, timezone
-from datto.base import Base
 
 # Import: local
 import config
+from datto.base import Base
 
 logger = logging.getLogger("Datto Check")
 
 
 class Device(Base):
-    "Datto Device"
+    """Datto Device
+
+    Only the fields read by the checks are kept; the checkin time is
+    parsed on first use."""
 
-    def __init__(self, device, results):
+    __slots__ = ('name', 'hidden', 'active_tickets', 'last_seen_date',
+                 'is_offline', 'storage_available', 'storage_used',
+                 'serial_number', '_last_checkin')
+
+    def __init__(self, device):
         """Constructor"""
         super()
-        self.results = results
         self.name = device['name']
         self.hidden = bool(device['hidden'])
         self.active_tickets = device['activeTickets']
@@ -29,51 +35,67 @@ class Device(Base):
         self.storage_available = int(device['localStorageAvailable']['size'])
         self.storage_used = int(device['localStorageUsed']['size'])
         self.serial_number = device['serialNumber']
+        self._last_checkin = None
+
+    @property
+    def last_checkin(self):
+        "Time of the last checkin (timezone aware datetime)"
+
+        if self._last_checkin is None:
+            time_string = self.last_seen_date[:22] + self.last_seen_date[23:] # remove the colon from time zone
+            self._last_checkin = datetime.strptime(time_string,
+                                                   "%Y-%m-%dT%H:%M:%S%z")
+        return self._last_checkin
 
     def is_inactive(self):
         return bool(self.hidden or self.name == 'backupDevice')
 
-    def check_active_tickets(self):
+    def check_active_tickets(self, results):
         "Check whether the device has any active tickets open."
 
         if self.active_tickets:
             error_text = 'Device has {} active {}'.format(\
                 self.active_tickets, 'ticket' if self.active_tickets < 2 else 'tickets')
-            self.results.append_error(['informational', self.name, 'N/A', error_text])
+            results.append_error(['informational', self.name, 'N/A', error_text])
             logger.debug('    %s', error_text)
 
-    def check_last_checkin(self):
+    def check_last_checkin(self, results, now=None):
         "Checks the last time the device checked in to the Datto Portal."
 
-        time_string = self.last_seen_date[:22] + self.last_seen_date[23:] # remove the colon from time zone
-        device_checkin = datetime.strptime(time_string,
-                                           "%Y-%m-%dT%H:%M:%S%z")
-        now = datetime.now(timezone.utc) # make 'now' timezone aware
-        time_diff = (now - device_checkin).total_seconds()
+        now = now or datetime.now(timezone.utc) # make 'now' timezone aware
+        time_diff = (now - self.last_checkin).total_seconds()
 
         if time_diff >= config.CHECKIN_LIMIT:
             error_text = "Last checkin was {} ago.".format(self.display_time(time_diff))
-            self.results.append_error(['critical', self.name, 'Appliance Offline', error_text])
+            results.append_error(['critical', self.name, 'Appliance Offline', error_text])
             logger.debug('    Appliance Offline')
             self.is_offline = True
 
-    def check_disk_usage(self):
-        "Check disk usage reported by the API and calculate percentages"
+    def storage_used_pct(self):
+        """Percentage of local storage used (from the used fraction rounded
+        to 2 places), or None if the API reported no storage"""
 
         total_space = self.storage_available + self.storage_used
         try:
-            available_pct = float("{0:.2f}".format(self.storage_used / total_space)) * 100
+            return float("{0:.2f}".format(self.storage_used / total_space)) * 100
         except ZeroDivisionError:
+            return None
+
+    def check_disk_usage(self, results):
+        "Check disk usage reported by the API and calculate percentages"
+
+        available_pct = self.storage_used_pct()
+        if available_pct is None:
             logger.error('    Failure calculating free space (API returned null value')
             return
 
         if available_pct > config.STORAGE_PCT_THRESHOLD:
             error_text = 'Local storage exceeds {}%.  Current Usage: {}%'.\
                         format(str(config.STORAGE_PCT_THRESHOLD), str(available_pct))
-            self.results.append_error(['critical', self.name, 'Low Disk Space', error_text])
+            results.append_error(['critical', self.name, 'Low Disk Space', error_text])
             logger.debug('    %s', error_text)
 
-    def run_device_checks(self):
-        self.check_active_tickets()
-        self.check_last_checkin()
-        self.check_disk_usage()
+    def run_device_checks(self, results, now=None):
+        self.check_active_tickets(results)
+        self.check_last_checkin(results, now)
+        self.check_disk_usage(results)
@@ -0,0 +1,40 @@
+# Files
+#
+# File helpers shared by the state, cache and report modules: the cache
+# directory, and atomic writes, so a crash or a concurrent reader never
+# sees a partial file.
+
+# Import: standard
+import os
+import threading
+from pathlib import Path
+
+# Import: local
+import config
+
+
+def cache_dir():
+    "Returns the cache directory: config.CACHE_DIR, by default ~/.cache/datto_check"
+
+    return Path(getattr(config, 'CACHE_DIR', None) or Path.home() / '.cache' / 'datto_check')
+
+
+def temp_path(path):
+    "Returns a temporary file path beside 'path', unique per writer"
+
+    path = Path(path)
+    return path.with_name('{}.{}.{}.tmp'.format(path.name, os.getpid(), threading.get_ident()))
+
+
+def atomic_write(path, data):
+    """Write 'data' (text or bytes) to 'path' atomically: into a temporary
+    file beside it, which then replaces it. Missing directories are
+    created."""
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # unique per writer, so concurrent writers never share a temporary file
+    temp = temp_path(path)
+    with open(temp, 'wb' if isinstance(data, bytes) else 'w') as temp_file:
+        temp_file.write(data)
+    os.replace(temp, path)
@@ -0,0 +1,141 @@
+# JSON Stream
+#
+# Incremental decoding of JSON arrays from a stream of chunks, so each
+# element can be used (and dropped) before the rest of the document
+# has arrived.
+
+# Import: standard
+import codecs
+import json
+import re
+
+_decoder = json.JSONDecoder()
+_whitespace = ' \t\n\r'
+# number characters running to the end of the buffer
+_number_tail = re.compile(r'[0-9.eE+-]*\Z')
+
+
+class _Reader():
+    "Buffered reader over an iterable of text or bytes (UTF-8) chunks"
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size=0):
+        """Read another chunk into the buffer, and more until it holds at
+        least 'size' unconsumed characters; returns False at the end of
+        the stream"""
+
+        if self.eof:
+            return False
+        # drop everything already consumed, so the buffer stays small
+        parts = [self.buffer[self.pos:]]
+        length = len(parts[0])
+        while True:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self.eof = True
+                chunk = self.text_decoder.decode(b'', final=True)
+            if isinstance(chunk, bytes):
+                chunk = self.text_decoder.decode(chunk)
+            parts.append(chunk)
+            length += len(chunk)
+            if self.eof or length >= size:
+                break
+        self.buffer = ''.join(parts)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        "Returns the next non-whitespace character"
+
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _whitespace:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise ValueError('Unexpected end of JSON stream')
+
+    def expect(self, char):
+        "Consume the next non-whitespace character, which must be 'char'"
+
+        if self.peek() != char:
+            raise ValueError('Expected {!r} at position {} of JSON stream'.format(char, self.pos))
+        self.pos += 1
+
+    def value(self):
+        """Decode the next complete JSON value
+
+        An incomplete value is decoded again once the unconsumed buffer
+        has doubled, so a large value costs linear, not quadratic, time."""
+
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+                # a number running to the end of the buffer ('1.', '1e')
+                # may continue in the next chunk
+                if self.eof or not (isinstance(value, (int, float)) and not isinstance(value, bool)
+                                    and _number_tail.match(self.buffer, end)):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill(2 * (len(self.buffer) - self.pos))
+
+
+def _iter_elements(reader):
+    "Generator: yield the elements of the array at the reader's position"
+
+    reader.expect('[')
+    if reader.peek() == ']':
+        reader.pos += 1
+        return
+    while True:
+        yield reader.value()
+        separator = reader.peek()
+        reader.pos += 1
+        if separator == ']':
+            return
+        if separator != ',':
+            raise ValueError('Expected "," or "]" in JSON array')
+
+
+def iter_array(chunks, key=None, members=None):
+    """Generator: incrementally decode a JSON array from an iterable of
+    text or bytes chunks, yielding each element as soon as it is complete.
+
+    key - when set, the document is an object and the array is its 'key'
+          member; the object's other members are decoded into the
+          'members' dict (if given) as they are read"""
+
+    reader = _Reader(chunks)
+    if key is None:
+        yield from _iter_elements(reader)
+        return
+
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        name = reader.value()
+        reader.expect(':')
+        if name == key:
+            yield from _iter_elements(reader)
+        else:
+            value = reader.value()
+            if members is not None:
+                members[name] = value
+        separator = reader.peek()
+        reader.pos += 1
+        if separator == '}':
+            return
+        if separator != ',':
+            raise ValueError('Expected "," or "}" in JSON object')
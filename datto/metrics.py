@@ -0,0 +1,167 @@
+# Metrics
+#
+# History of per-device storage and per-agent backup/off-site times,
+# appended to by every run, and the disk-fill forecast computed from it.
+
+# Import: standard
+import logging
+import threading
+from collections import namedtuple
+from pathlib import Path
+
+# sqlite3 is imported when the store is opened
+
+# Import: local
+import config
+
+logger = logging.getLogger("Datto Check")
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+# a device projected to run out of local storage: percent used now (as
+# fitted) and growth in percentage points per day
+Forecast = namedtuple('Forecast', ['serial_number', 'used_pct', 'growth_per_day', 'days_left'])
+
+
+class MetricsStore():
+    """Time series of device & agent metrics (SQLite)
+
+    Samples are appended once per run; samples older than
+    config.METRICS_RAW_DAYS are downsampled to hourly averages, older than
+    config.METRICS_HOURLY_DAYS to daily averages, and dropped after
+    config.METRICS_MAX_DAYS. A year of hourly samples for hundreds of
+    devices stays in the low millions of rows; the forecast reads only the
+    recent samples, through an index on time.
+    """
+
+    def __init__(self, path):
+        "Constructor - open (or create) the metrics database"
+
+        import sqlite3
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.raw_days = getattr(config, 'METRICS_RAW_DAYS', 7)
+        self.hourly_days = getattr(config, 'METRICS_HOURLY_DAYS', 90)
+        self.max_days = getattr(config, 'METRICS_MAX_DAYS', 400)
+        self.devices = []
+        self.agents = []
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), timeout=60, check_same_thread=False)
+        with self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS device_samples (
+                                   serial TEXT,
+                                   ts INTEGER,
+                                   used REAL,
+                                   available REAL,
+                                   resolution INTEGER,
+                                   PRIMARY KEY (serial, ts)) WITHOUT ROWID''')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS agent_samples (
+                                   serial TEXT,
+                                   agent TEXT,
+                                   ts INTEGER,
+                                   last_snapshot REAL,
+                                   latest_offsite REAL,
+                                   resolution INTEGER,
+                                   PRIMARY KEY (serial, agent, ts)) WITHOUT ROWID''')
+            # downsampling & expiry work on old samples across devices, the
+            # forecast on recent ones (covering, so the table is not read)
+            self.db.execute('CREATE INDEX IF NOT EXISTS device_samples_age ON device_samples (resolution, ts)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS agent_samples_age ON agent_samples (resolution, ts)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS device_samples_time ON device_samples (ts, used, available)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS agent_samples_time ON agent_samples (ts)')
+
+    def add_device(self, timestamp, device):
+        "Queue a storage sample for a Device (written by commit())"
+
+        with self.lock:
+            self.devices.append((device.serial_number, int(timestamp),
+                                 device.storage_used, device.storage_available))
+
+    def add_agent(self, timestamp, serial_number, agent):
+        "Queue a backup/off-site time sample for an Agent (written by commit())"
+
+        with self.lock:
+            self.agents.append((serial_number, agent.name, int(timestamp),
+                                agent.last_snapshot, agent.latest_offsite))
+
+    def commit(self, now):
+        """Write the queued samples in one transaction, then downsample
+        and expire old samples ('now': epoch seconds)"""
+
+        with self.lock:
+            devices, self.devices = self.devices, []
+            agents, self.agents = self.agents, []
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO device_samples VALUES (?, ?, ?, ?, 0)', devices)
+            self.db.executemany('INSERT OR REPLACE INTO agent_samples VALUES (?, ?, ?, ?, ?, 0)', agents)
+            self.downsample(now)
+        logger.debug('Recorded metrics for %s devices and %s agents', len(devices), len(agents))
+
+    def downsample(self, now):
+        """Replace samples past each age limit by one sample per hour/day
+        (storage averaged, the latest backup & off-site times kept)"""
+
+        for resolution, days in ((HOUR, self.raw_days), (DAY, self.hourly_days)):
+            # only whole buckets, so a bucket is never averaged twice
+            cutoff = (int(now) - days * DAY) // resolution * resolution
+            self.db.execute('''INSERT OR REPLACE INTO device_samples
+                               SELECT serial, ts / :resolution * :resolution, AVG(used), AVG(available), :resolution
+                               FROM device_samples WHERE resolution < :resolution AND ts < :cutoff
+                               GROUP BY serial, ts / :resolution''',
+                            {'resolution': resolution, 'cutoff': cutoff})
+            self.db.execute('DELETE FROM device_samples WHERE resolution < ? AND ts < ?', (resolution, cutoff))
+            self.db.execute('''INSERT OR REPLACE INTO agent_samples
+                               SELECT serial, agent, ts / :resolution * :resolution,
+                                      MAX(last_snapshot), MAX(latest_offsite), :resolution
+                               FROM agent_samples WHERE resolution < :resolution AND ts < :cutoff
+                               GROUP BY serial, agent, ts / :resolution''',
+                            {'resolution': resolution, 'cutoff': cutoff})
+            self.db.execute('DELETE FROM agent_samples WHERE resolution < ? AND ts < ?', (resolution, cutoff))
+
+        expired = int(now) - self.max_days * DAY
+        self.db.execute('DELETE FROM device_samples WHERE ts < ?', (expired,))
+        self.db.execute('DELETE FROM agent_samples WHERE ts < ?', (expired,))
+
+    def forecast(self, now, threshold, horizon_days, window_days=None, min_samples=None):
+        """Devices whose local storage use is projected to exceed
+        'threshold' percent within 'horizon_days' days
+
+        A least-squares line of percent used over time is fitted to each
+        device's samples from the last 'window_days' days, all devices in
+        one aggregate query. Devices with fewer than 'min_samples' samples,
+        less than a day of history, or no growth are skipped.
+
+        Returns a list of Forecast"""
+
+        window_days = window_days or getattr(config, 'FORECAST_WINDOW_DAYS', 30)
+        min_samples = min_samples or getattr(config, 'FORECAST_MIN_SAMPLES', 6)
+
+        # x: days relative to now, so the intercept is the fitted usage now
+        rows = self.db.execute('''SELECT serial, COUNT(*), SUM(x), SUM(y), SUM(x * x), SUM(x * y),
+                                         MIN(x), MAX(x)
+                                  FROM (SELECT serial, (ts - :now) / 86400.0 AS x,
+                                               used * 100.0 / (used + available) AS y
+                                        FROM device_samples
+                                        WHERE ts > :start AND ts <= :now AND used + available > 0)
+                                  GROUP BY serial''',
+                               {'now': int(now), 'start': int(now) - window_days * DAY}).fetchall()
+
+        forecasts = []
+        for serial, n, sum_x, sum_y, sum_xx, sum_xy, first, last in rows:
+            denominator = n * sum_xx - sum_x * sum_x
+            if n < min_samples or last - first < 1 or denominator <= 0:
+                continue
+            slope = (n * sum_xy - sum_x * sum_y) / denominator
+            intercept = (sum_y - slope * sum_x) / n
+            if slope <= 0:
+                continue
+            days_left = max(0.0, (threshold - intercept) / slope)
+            if days_left <= horizon_days:
+                forecasts.append(Forecast(serial, intercept, slope, days_left))
+        return forecasts
+
+    def close(self):
+        "Close the metrics database"
+
+        self.db.close()
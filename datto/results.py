@@ -0,0 +1,157 @@
+# Results
+#
+# Typed result records for each error category, and the indexed
+# 'Results' store the checks append them to.
+
+# Import: standard
+import threading
+from collections import Counter, defaultdict, namedtuple
+
+# One record type per category. The leading fields are the report
+# columns; 'color' is the row color ('red' for actionable errors).
+Critical = namedtuple('Critical',
+                      ['appliance', 'error_type', 'error_details', 'color'],
+                      defaults=[None])
+BackupError = namedtuple('BackupError',
+                         ['appliance', 'agent', 'last_backup', 'error_details', 'color'],
+                         defaults=[None])
+OffsiteError = namedtuple('OffsiteError',
+                          ['appliance', 'agent', 'error_details', 'color'],
+                          defaults=[None])
+ScreenshotError = namedtuple('ScreenshotError',
+                             ['appliance', 'agent', 'details', 'screenshot_url',
+                              'screenshot_error', 'color'],
+                             defaults=[None, None, None])
+VerificationError = namedtuple('VerificationError',
+                               ['appliance', 'agent', 'error', 'details', 'color'],
+                               defaults=[None])
+Informational = namedtuple('Informational',
+                           ['appliance', 'agent', 'details', 'color'],
+                           defaults=[None])
+
+# category -> (report heading, report columns, record type); in report order
+CATEGORIES = {
+    'critical': ("CRITICAL ERRORS", ['Appliance', 'Error Type', 'Error Details'], Critical),
+    'backup_error': ("Backup Errors", ['Appliance', 'Agent/Share', 'Last Backup', 'Error Details'], BackupError),
+    'offsite_error': ('Off-site Sync Issues', ['Appliance', 'Agent/Share', 'Error Details'], OffsiteError),
+    'screenshot_error': ('Screenshot Failures', ['Appliance', 'Agent', 'Screenshot/Details'], ScreenshotError),
+    'verification_error': ('Local Verification Issues', ['Appliance', 'Agent', 'Error', 'Details'], VerificationError),
+    'informational': ('Informational', ['Appliance', 'Agent/Share', 'Details'], Informational),
+}
+
+
+class Results():
+    """Datto check results
+
+    'results' maps each category to its report heading, columns, record
+    fields and list of error records. Secondary indexes by appliance, by
+    agent and by row color (severity) hold (category, record) pairs, and
+    per category counts are kept as errors are appended.
+
+    sinks - callables given each (category, record) as it is appended, so
+            findings can be streamed out (see report.NdjsonSink) before
+            the run ends
+    """
+
+    def __init__(self, sinks=None):
+        "Constructor"
+
+        # initialize results_data, used for generating reports
+        self.results = {}
+        for category, (name, columns, record_type) in CATEGORIES.items():
+            self.results[category] = {'name': name,
+                                      'columns': columns,
+                                      'fields': record_type._fields,
+                                      'errors': []}
+        self.by_device = defaultdict(list)
+        self.by_agent = defaultdict(list)
+        self.by_severity = defaultdict(list)
+        self.counts = Counter()
+        self.sinks = list(sinks or [])
+        self.lock = threading.Lock()
+
+    def append_error(self, error_detail, color=None):
+        """Append an error to the results.
+
+            error_detail - List of error data: the category, followed by
+                the fields of the category's record type (appliance first)
+            color - optional row color
+        """
+
+        category = error_detail[0]
+        record = CATEGORIES[category][2](*error_detail[1:], color=color)
+        self.append_record(category, record)
+
+    def append_record(self, category, record):
+        "Append an error record to the results and its indexes"
+
+        with self.lock:
+            self.results[category]['errors'].append(record)
+            self.by_device[record.appliance].append((category, record))
+            if category != 'critical':
+                self.by_agent[(record.appliance, record.agent)].append((category, record))
+            self.by_severity[record.color].append((category, record))
+            self.counts[category] += 1
+            for sink in self.sinks:
+                sink(category, record)
+
+    def for_device(self, appliance):
+        "Returns all (category, record) errors for an appliance"
+
+        return self.by_device.get(appliance, [])
+
+    def for_agent(self, appliance, agent):
+        "Returns all (category, record) errors for an appliance's agent"
+
+        return self.by_agent.get((appliance, agent), [])
+
+    def with_severity(self, color):
+        "Returns all (category, record) errors with the given row color"
+
+        return self.by_severity.get(color, [])
+
+    def count(self, category=None):
+        "Number of errors in a category, or in total"
+
+        if category:
+            return self.counts[category]
+        return sum(self.counts.values())
+
+    def to_dict(self):
+        "Returns the error records as plain data: category -> list of record dicts"
+
+        with self.lock:
+            return {category: [record._asdict() for record in entry['errors']]
+                    for category, entry in self.results.items()}
+
+    @classmethod
+    def from_dict(cls, data):
+        "Returns Results built from to_dict() data"
+
+        results = cls()
+        for category, records in data.items():
+            record_type = CATEGORIES[category][2]
+            for record in records:
+                results.append_record(category, record_type(**record))
+        return results
+
+    def merge(self, other, prefix=''):
+        """Append all of another Results' errors to these results; 'prefix'
+        is prepended to each appliance name (e.g. the partner account)"""
+
+        for category, entry in other.results.items():
+            for record in list(entry['errors']):
+                self.append_record(category, record._replace(appliance=prefix + record.appliance))
+
+    def sort(self):
+        """Sort errors in each category by appliance name.
+
+        Agent checks complete in whatever order the asset details
+        arrive; the sort is stable, so errors for the same appliance
+        keep the order they were appended in."""
+
+        with self.lock:
+            for category in self.results.values():
+                category['errors'].sort(key=lambda error: error.appliance.upper())
+            for errors in self.by_severity.values():
+                errors.sort(key=lambda error: error[1].appliance.upper())
@@ -0,0 +1,259 @@
+# Screenshots
+#
+# Failed-screenshot thumbnails for the email report: the images are
+# downloaded concurrently into an on-disk cache and attached to the report
+# as inline parts, so mail clients do not have to load them from Datto
+# (many block remote images, and the links expire).
+
+# Import: standard
+import hashlib
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+
+# sqlite3 and requests are imported when first used
+
+# Import: local
+import config
+from datto.files import atomic_write, cache_dir
+
+logger = logging.getLogger("Datto Check")
+
+# a downloaded screenshot: inline content id, image file and MIME type
+Screenshot = namedtuple('Screenshot', ['content_id', 'path', 'content_type'])
+
+
+class ScreenshotCache():
+    """On-disk screenshot cache
+
+    An SQLite index maps each screenshot URL to the SHA-256 of its image,
+    and the 'ETag'/'Last-Modified' headers used to revalidate it. Images
+    are stored once per content hash ('<sha256>.img'), however many URLs
+    share them. Least recently used URLs are evicted once the images grow
+    past 'max_bytes', and image files no URL refers to are removed.
+    """
+
+    def __init__(self, directory, max_bytes):
+        "Constructor - open (or create) the cache index"
+
+        import sqlite3
+
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.directory / 'index.sqlite'), check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS screenshots (
+                                   url TEXT PRIMARY KEY,
+                                   sha256 TEXT,
+                                   content_type TEXT,
+                                   etag TEXT,
+                                   last_modified TEXT,
+                                   fetched REAL,
+                                   accessed REAL,
+                                   size INTEGER)''')
+
+    def image_path(self, sha256):
+        "Returns the path of the image file for a content hash"
+
+        return self.directory / (sha256 + '.img')
+
+    def get(self, url):
+        """Returns the cached entry for a URL as a dict, or None (also if
+        its image file has gone missing)"""
+
+        with self.lock, self.db:
+            row = self.db.execute('''SELECT sha256, content_type, etag, last_modified, fetched
+                                     FROM screenshots WHERE url = ?''', (url,)).fetchone()
+            if row is None or not self.image_path(row[0]).exists():
+                return None
+            self.db.execute('UPDATE screenshots SET accessed = ? WHERE url = ?', (time.time(), url))
+        return {'sha256': row[0], 'content_type': row[1], 'etag': row[2],
+                'last_modified': row[3], 'fetched': row[4]}
+
+    def put(self, url, body, content_type, etag=None, last_modified=None):
+        """Store a downloaded image, then evict old entries if over the
+        size limit; returns its content hash"""
+
+        sha256 = hashlib.sha256(body).hexdigest()
+        path = self.image_path(sha256)
+        if not path.exists():
+            atomic_write(path, body)
+
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute('''INSERT OR REPLACE INTO screenshots
+                               (url, sha256, content_type, etag, last_modified, fetched, accessed, size)
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                            (url, sha256, content_type, etag, last_modified, now, now, len(body)))
+            self._evict()
+        return sha256
+
+    def touch(self, url):
+        "Mark an entry as freshly fetched (after a '304 Not Modified')"
+
+        with self.lock, self.db:
+            self.db.execute('UPDATE screenshots SET fetched = ? WHERE url = ?', (time.time(), url))
+
+    def _evict(self):
+        "Remove least recently used URLs until the images fit in max_bytes"
+
+        def total():
+            return self.db.execute('''SELECT COALESCE(SUM(size), 0) FROM
+                                      (SELECT DISTINCT sha256, size FROM screenshots)''').fetchone()[0]
+
+        if total() <= self.max_bytes:
+            return
+        rows = self.db.execute('SELECT url, sha256 FROM screenshots ORDER BY accessed').fetchall()
+        for url, sha256 in rows:
+            if total() <= self.max_bytes:
+                break
+            self.db.execute('DELETE FROM screenshots WHERE url = ?', (url,))
+            if not self.db.execute('SELECT 1 FROM screenshots WHERE sha256 = ?', (sha256,)).fetchone():
+                self.image_path(sha256).unlink(missing_ok=True)
+            logger.debug('Evicted %s from screenshot cache', url)
+
+    def close(self):
+        "Close the cache index"
+
+        with self.lock:
+            self.db.close()
+
+
+class ScreenshotPrefetcher():
+    """Downloads failed-screenshot images in the background
+
+    Downloads run in a bounded thread pool (config.SCREENSHOT_WORKERS)
+    with connect/read timeouts (config.SCREENSHOT_TIMEOUT). Images are
+    served from the cache without a request for config.SCREENSHOT_CACHE_TTL
+    seconds, then revalidated, so unchanged screenshots are not
+    downloaded again on the next run.
+
+    A prefetcher is also a result sink (see datto.results.Results): each
+    screenshot error's image is queued for download as soon as it is
+    found, while the rest of the checks run.
+    """
+
+    def __init__(self, telemetry=None):
+        "Constructor"
+
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.telemetry = telemetry
+        self.workers = getattr(config, 'SCREENSHOT_WORKERS', 4)
+        self.timeout = getattr(config, 'SCREENSHOT_TIMEOUT', (5, 15))
+        self.ttl = getattr(config, 'SCREENSHOT_CACHE_TTL', 60 * 60)
+        self.cache = ScreenshotCache(cache_dir() / 'screenshots',
+                                     getattr(config, 'SCREENSHOT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, category, record):
+        if category == 'screenshot_error' and record.screenshot_url:
+            self.prefetch([record.screenshot_url])
+
+    def prefetch(self, urls):
+        "Queue screenshot downloads; each URL is fetched once per prefetcher"
+
+        with self.lock:
+            for url in urls:
+                if url not in self.futures:
+                    self.futures[url] = self.executor.submit(self.fetch, url)
+
+    def images(self, urls):
+        """Wait for the given screenshots (queued if need be); returns
+        {url: Screenshot} for those that could be downloaded"""
+
+        urls = set(urls)
+        self.prefetch(urls)
+        with self.lock:
+            futures = {url: self.futures[url] for url in urls}
+        if self.telemetry:
+            with self.telemetry.phase('screenshot_fetch'):
+                wait(futures.values())
+        else:
+            wait(futures.values())
+
+        images = {}
+        for url, future in futures.items():
+            try:
+                screenshot = future.result()
+            except Exception as e:
+                # e.g. an unwritable cache, or its index locked by another
+                # tenant's process: the screenshot is linked to instead
+                logger.warning('Unable to cache screenshot %s: %s', url, e)
+                continue
+            if screenshot:
+                images[url] = screenshot
+        return images
+
+    def fetch(self, url):
+        """Download a screenshot through the cache; returns a Screenshot,
+        or None if it cannot be downloaded (it is linked to instead)"""
+
+        import requests
+
+        cached = self.cache.get(url)
+        if cached and time.time() - cached['fetched'] < self.ttl:
+            logger.debug('Screenshot cache hit: %s', url)
+            if self.telemetry:
+                self.telemetry.cache('screenshot')
+            return self._screenshot(cached['sha256'], cached['content_type'])
+
+        headers = {}
+        if cached:
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        start = time.monotonic()
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            self._record(start, True)
+            logger.warning('Unable to download screenshot %s: %s', url, e)
+            return None
+        self._record(start, response.status_code >= 400)
+
+        if cached and response.status_code == 304:
+            logger.debug('Screenshot cache revalidated: %s', url)
+            if self.telemetry:
+                self.telemetry.cache('screenshot', revalidated=True)
+            self.cache.touch(url)
+            return self._screenshot(cached['sha256'], cached['content_type'])
+
+        content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+        if response.status_code != 200 or not content_type.startswith('image/'):
+            logger.warning('Unable to download screenshot %s: HTTP %s (%s)',
+                           url, response.status_code, content_type or 'no content type')
+            return None
+        if self.telemetry:
+            self.telemetry.received('screenshot', len(response.content))
+        sha256 = self.cache.put(url, response.content, content_type,
+                                response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return self._screenshot(sha256, content_type)
+
+    def _screenshot(self, sha256, content_type):
+        return Screenshot('{}@datto-check'.format(sha256[:32]), self.cache.image_path(sha256), content_type)
+
+    def _record(self, start, failed):
+        if self.telemetry:
+            self.telemetry.request('screenshot', time.monotonic() - start, failed)
+
+    def close(self):
+        "Stop the download threads; close the session and the cache"
+
+        self.executor.shutdown(wait=True)
+        self.session.close()
+        self.cache.close()
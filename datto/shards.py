@@ -0,0 +1,97 @@
+# Shards
+#
+# Sharded runs: '--shard i/N' checks only the devices whose serial number
+# hashes to shard i of N, and writes its results to a shard file; the
+# 'merge' command combines the shard files into one report.
+
+# Import: standard
+import json
+import logging
+import time
+import zlib
+
+# Import: local
+from datto.files import atomic_write
+from datto.results import Results
+
+logger = logging.getLogger("Datto Check")
+
+
+def parse_shard(value):
+    """Parse an 'i/N' shard argument (1 <= i <= N); returns (i, N).
+    Raises ValueError if it is not valid."""
+
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise ValueError('shard must be given as i/N, e.g. 1/4')
+    if not 1 <= index <= count:
+        raise ValueError('shard i/N needs 1 <= i <= N')
+    return index, count
+
+
+def in_shard(serial_number, shard):
+    """True if a device belongs to 'shard' ((i, N)); the partition is a
+    stable hash of the serial number, the same on every host and run"""
+
+    index, count = shard
+    return zlib.crc32(serial_number.encode()) % count == index - 1
+
+
+def write_shard(path, shard, results, complete=True, devices=0):
+    "Write a shard's results to a shard file (JSON, written atomically)"
+
+    atomic_write(path, json.dumps({'shard': list(shard),
+                                   'finished': time.time(),
+                                   'complete': complete,
+                                   'devices': devices,
+                                   'results': results.to_dict()}))
+    logger.info('Wrote shard %s/%s results to %s', shard[0], shard[1], path)
+
+
+def merge_shards(paths):
+    """Combine shard files into one Results
+
+    Missing, duplicate, unreadable and incomplete shards are listed as
+    critical errors, as their devices were not (all) checked."""
+
+    merged = Results()
+    seen = {}
+    count = None
+    for path in paths:
+        try:
+            with open(path) as shard_file:
+                data = json.load(shard_file)
+            index, shard_count = data['shard']
+            results = Results.from_dict(data['results'])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error('Unable to read shard file %s: %s', path, e)
+            merged.append_error(['critical', str(path), 'Shard Error',
+                                 'Unreadable shard file; its devices are not in this report'], color='red')
+            continue
+
+        label = '{}/{}'.format(index, shard_count)
+        if count is None:
+            count = shard_count
+        elif shard_count != count:
+            logger.error('Shard %s (%s) is not one of %s shards; skipped', label, path, count)
+            merged.append_error(['critical', 'Shard ' + label, 'Shard Error',
+                                 'Shard count does not match the other shards; skipped'], color='red')
+            continue
+        if index in seen:
+            logger.error('Shard %s given twice (%s, %s); skipped', label, seen[index], path)
+            continue
+        seen[index] = path
+
+        if not data['complete']:
+            merged.append_error(['critical', 'Shard ' + label, 'Shard Incomplete',
+                                 'Not every device in this shard could be checked'], color='red')
+        logger.info('Merging shard %s: %s devices, %s errors', label, data['devices'], results.count())
+        merged.merge(results)
+
+    for index in range(1, (count or 0) + 1):
+        if index not in seen:
+            merged.append_error(['critical', 'Shard {}/{}'.format(index, count), 'Shard Missing',
+                                 'No results for this shard; its devices are not in this report'], color='red')
+    merged.sort()
+    return merged
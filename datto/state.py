@@ -0,0 +1,134 @@
+# State
+#
+# Saved per-device state between runs, used for incremental runs:
+# devices whose listing fingerprint is unchanged, and whose saved agent
+# data cannot have crossed an alert threshold, reuse that agent data
+# instead of querying the API for their asset details.
+
+# Import: standard
+import json
+import logging
+import time
+from pathlib import Path
+
+# Import: local
+import config
+from datto.files import atomic_write
+
+logger = logging.getLogger("Datto Check")
+
+
+class State():
+    """Per-device state saved between runs
+
+    Each device entry holds the device listing fingerprint, a hash of
+    the last asset details payload, the agent data the checks read
+    (Agent.slim), and the time at which that agent data could first
+    trip a time-based alert threshold.
+    """
+
+    def __init__(self, path, max_age=None):
+        """Constructor - load any saved state
+
+        path - state file (JSON)
+        max_age - seconds before saved agent data is always refetched
+                  (defaults to config.INCREMENTAL_MAX_AGE)"""
+
+        self.path = Path(path)
+        self.max_age = max_age or getattr(config, 'INCREMENTAL_MAX_AGE', 60 * 60 * 6)
+        self.saved = {}
+        self.devices = {}
+        try:
+            with open(self.path) as state_file:
+                self.saved = json.load(state_file)['devices']
+            logger.debug('Loaded saved state for %s devices', len(self.saved))
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError) as e:
+            logger.error('Ignoring unreadable state file %s: %s', self.path, e)
+
+    def start(self):
+        "Start a run: only the devices seen in it are recorded"
+
+        self.devices = {}
+
+    @staticmethod
+    def fingerprint(device):
+        """Fingerprint of the device listing fields that change when
+        the appliance's agents do (storage moves with every snapshot).
+
+        'lastSeenDate' is left out as it changes on every checkin; the
+        checkin check always runs from the live listing anyway."""
+
+        return [device['activeTickets'],
+                device['localStorageUsed']['size'],
+                device['localStorageAvailable']['size']]
+
+    @staticmethod
+    def next_deadline(assets):
+        """Earliest time at which the agent checks could raise a new
+        alert from this agent data alone.
+
+        Returns 0 if any active agent already has an error (its status
+        can only change with fresh data), None if no threshold applies."""
+
+        deadline = None
+        for agent in assets:
+            if agent['isPaused'] or agent['isArchived'] or not agent['backups']:
+                continue
+            last_backup = agent['backups'][0]
+            if (last_backup['backup']['status'] != 'success'
+                    or last_backup['localVerification']['errors']
+                    or (agent['type'] == 'agent' and not agent['lastScreenshotAttemptStatus'])):
+                return 0
+
+            times = []
+            if agent['lastSnapshot']:
+                times.append(agent['lastSnapshot'] + config.LAST_BACKUP_THRESHOLD)
+            if agent['latestOffsite']:
+                times.append(agent['latestOffsite'] + config.LAST_OFFSITE_THRESHOLD)
+            if agent['type'] == 'agent' and agent['lastScreenshotAttempt']:
+                times.append(agent['lastScreenshotAttempt'] + config.LAST_SCREENSHOT_THRESHOLD)
+            for crossing in times:
+                if deadline is None or crossing < deadline:
+                    deadline = crossing
+        return deadline
+
+    def cached_assets(self, device):
+        """Returns the saved agent data for a device if it can be reused
+        this run, otherwise None (the asset details must be fetched)."""
+
+        serial = device['serialNumber']
+        entry = self.saved.get(serial)
+        now = time.time()
+        if (entry is None
+                or entry['fingerprint'] != self.fingerprint(device)
+                or now - entry['fetched'] > self.max_age
+                or (entry['deadline'] is not None and entry['deadline'] <= now)):
+            return None
+
+        self.devices[serial] = entry
+        return entry['assets']
+
+    def update(self, device, assets, payload_hash):
+        """Record freshly fetched agent data (Agent.slim records) for a
+        device; 'payload_hash' identifies the asset details response"""
+
+        serial = device['serialNumber']
+        previous = self.saved.get(serial)
+        if previous and previous['hash'] == payload_hash:
+            logger.debug('    Asset details unchanged since last run')
+
+        self.devices[serial] = {'fingerprint': self.fingerprint(device),
+                                'hash': payload_hash,
+                                'fetched': time.time(),
+                                'deadline': self.next_deadline(assets),
+                                'assets': assets}
+
+    def save(self):
+        """Write the state of every device seen this run to the state
+        file; the next run (of this process, too) starts from it"""
+
+        atomic_write(self.path, json.dumps({'devices': self.devices}))
+        self.saved = self.devices
+        logger.debug('Saved state for %s devices', len(self.devices))
@@ -0,0 +1,229 @@
+# Telemetry
+#
+# Per-run timing and API request statistics, written at the end of each
+# run as a JSON summary and, optionally, a Prometheus textfile-collector
+# file.
+
+# Import: standard
+import json
+import logging
+import math
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Import: local
+from datto.files import atomic_write
+
+logger = logging.getLogger("Datto Check")
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def _percentile(values, quantile):
+    "Nearest-rank percentile of a sorted list"
+
+    if not values:
+        return None
+    return values[max(0, math.ceil(quantile * len(values)) - 1)]
+
+
+def _label(quantile):
+    "Summary key of a latency quantile (0.9 -> 'p90')"
+
+    return 'p{:g}'.format(quantile * 100)
+
+
+def _new_endpoint():
+    return {'requests': 0, 'errors': 0, 'retries': 0, 'bytes': 0, 'wire_bytes': 0,
+            'cache_hits': 0, 'revalidated': 0, 'latencies': [], 'transfers': []}
+
+
+def _distribution(values):
+    "Percentiles and maximum of a list of timings"
+
+    values = sorted(values)
+    distribution = {_label(quantile): _percentile(values, quantile) for quantile in QUANTILES}
+    distribution['max'] = values[-1] if values else None
+    return distribution
+
+
+class Telemetry():
+    """Timing and request statistics for one run
+
+    Phase times are cumulative seconds spent in each phase; phases that
+    run on worker threads (device listing, asset fetches) can add up to
+    more than the run's wall time. Time spent in a nested phase (the XML
+    download during the checks) only counts towards the nested phase.
+    """
+
+    def __init__(self):
+        "Constructor"
+
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        "Start a new run"
+
+        with self.lock:
+            self.started = time.time()
+            self.start = time.perf_counter()
+            self.phases = defaultdict(float)
+            self.endpoints = defaultdict(_new_endpoint)
+
+    @contextmanager
+    def phase(self, name):
+        "Context manager: time the enclosed block as part of phase 'name'"
+
+        # per thread stack of time spent in nested phases
+        nested = self.local.__dict__.setdefault('nested', [])
+        nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            exclusive = elapsed - nested.pop()
+            if nested:
+                nested[-1] += elapsed
+            with self.lock:
+                self.phases[name] += exclusive
+
+    def request(self, endpoint, seconds, failed=False):
+        "Record an API request attempt and its latency (until the response headers)"
+
+        with self.lock:
+            stats = self.endpoints[endpoint or 'other']
+            stats['requests'] += 1
+            stats['latencies'].append(seconds)
+            if failed:
+                stats['errors'] += 1
+
+    def retry(self, endpoint):
+        "Record a retried API request"
+
+        with self.lock:
+            self.endpoints[endpoint or 'other']['retries'] += 1
+
+    def received(self, endpoint, size, wire_size=None):
+        """Record bytes received from the API: 'size' once decompressed,
+        'wire_size' as transferred (the same if not given)"""
+
+        with self.lock:
+            stats = self.endpoints[endpoint or 'other']
+            stats['bytes'] += size
+            stats['wire_bytes'] += size if wire_size is None else wire_size
+
+    def transfer(self, endpoint, seconds):
+        "Record the time taken to read a response body"
+
+        with self.lock:
+            self.endpoints[endpoint or 'other']['transfers'].append(seconds)
+
+    def cache(self, endpoint, revalidated=False):
+        "Record an API response answered from the response cache"
+
+        with self.lock:
+            stats = self.endpoints[endpoint or 'other']
+            stats['revalidated' if revalidated else 'cache_hits'] += 1
+
+    def summary(self, **extra):
+        """Returns the run summary as a dict; 'extra' items (device
+        counts, error counts, ...) are added as they are"""
+
+        with self.lock:
+            endpoints = {}
+            for endpoint, stats in self.endpoints.items():
+                summary = {key: value for key, value in stats.items()
+                           if key not in ('latencies', 'transfers')}
+                summary['latency'] = _distribution(stats['latencies'])
+                summary['transfer'] = _distribution(stats['transfers'])
+                endpoints[endpoint] = summary
+            summary = {'started': self.started,
+                       'duration': time.perf_counter() - self.start,
+                       'phases': dict(self.phases),
+                       'endpoints': endpoints}
+        summary.update(extra)
+        return summary
+
+    @staticmethod
+    def prometheus(summary, prefix='datto_check'):
+        """Render a run summary in the Prometheus text exposition format;
+        a 'tenant' or 'shard' in the summary is added as a label to every
+        sample, as is 'checks' ('all', or 'devices' for a device-only run)
+        when the summary has 'agent_checks'"""
+
+        lines = []
+        common = tuple((label, summary[label]) for label in ('tenant', 'shard') if summary.get(label))
+        if 'agent_checks' in summary:
+            common += (('checks', 'all' if summary['agent_checks'] else 'devices'),)
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP {}_{} {}'.format(prefix, name, help_text))
+            lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+            for labels, value in samples:
+                if value is None:
+                    continue
+                labels = common + tuple(labels)
+                label_text = ','.join('{}="{}"'.format(key, str(label).replace('\\', '\\\\').replace('"', '\\"'))
+                                      for key, label in labels)
+                lines.append('{}_{}{} {}'.format(prefix, name, '{' + label_text + '}' if label_text else '',
+                                                 float(value)))
+
+        endpoints = summary['endpoints']
+        metric('last_run_timestamp_seconds', 'gauge', 'Start time of the last run.',
+               [((), summary['started'])])
+        metric('run_duration_seconds', 'gauge', 'Wall time of the last run.',
+               [((), summary['duration'])])
+        metric('phase_seconds', 'gauge', 'Time spent in each phase of the last run.',
+               [((('phase', phase),), seconds) for phase, seconds in sorted(summary['phases'].items())])
+        for key, name, help_text in (('requests', 'requests', 'API request attempts'),
+                                     ('errors', 'request_errors', 'Failed API request attempts'),
+                                     ('retries', 'request_retries', 'Retried API requests'),
+                                     ('bytes', 'response_bytes', 'Bytes received from the API'),
+                                     ('wire_bytes', 'response_wire_bytes',
+                                      'Bytes received from the API before decompression'),
+                                     ('cache_hits', 'cache_hits', 'API responses served from the response cache'),
+                                     ('revalidated', 'cache_revalidated', 'Cached API responses revalidated')):
+            metric(name, 'gauge', help_text + ' (last run).',
+                   [((('endpoint', endpoint),), stats[key]) for endpoint, stats in sorted(endpoints.items())])
+        metric('request_latency_seconds', 'gauge', 'API request latency percentiles (last run).',
+               [((('endpoint', endpoint), ('quantile', quantile)), stats['latency'][_label(quantile)])
+                for endpoint, stats in sorted(endpoints.items())
+                for quantile in QUANTILES])
+        metric('response_transfer_seconds', 'gauge', 'API response body read time percentiles (last run).',
+               [((('endpoint', endpoint), ('quantile', quantile)), stats['transfer'][_label(quantile)])
+                for endpoint, stats in sorted(endpoints.items())
+                for quantile in QUANTILES])
+        if 'devices' in summary:
+            metric('devices', 'gauge', 'Devices listed by the API.', [((), summary['devices'])])
+        if 'offline' in summary:
+            metric('devices_offline', 'gauge', 'Offline devices.', [((), summary['offline'])])
+        if 'skipped' in summary:
+            metric('devices_skipped', 'gauge', 'Devices not checked before the run deadline.',
+                   [((), summary['skipped'])])
+        if 'errors' in summary:
+            metric('errors', 'gauge', 'Errors in the report, by category.',
+                   [((('category', category),), count) for category, count in sorted(summary['errors'].items())])
+        if 'complete' in summary:
+            metric('run_complete', 'gauge', '1 if every device was checked.',
+                   [((), int(summary['complete']))])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_path=None, prometheus_path=None, **extra):
+        """Write the run summary as JSON and/or a Prometheus textfile;
+        returns the summary"""
+
+        summary = self.summary(**extra)
+        # written atomically: textfile collectors may read at any time
+        try:
+            if json_path:
+                atomic_write(json_path, json.dumps(summary, indent=2))
+            if prometheus_path:
+                atomic_write(prometheus_path, self.prometheus(summary))
+        except OSError as e:
+            logger.error('Unable to write run telemetry: %s', e)
+        return summary
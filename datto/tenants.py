@@ -0,0 +1,96 @@
+# Tenants
+#
+# Multi-tenant runs: each partner account in config.TENANTS is checked
+# in its own worker process, with its own API session, rate limit, cache
+# key and state, so a run takes about as long as the slowest account.
+
+# Import: standard
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Import: local
+import config
+from mail import Email
+from datto.datto import DattoCheck
+from datto.results import Results
+
+logger = logging.getLogger("Datto Check")
+
+
+def check_tenant(tenant, options, report, deadline=None):
+    """Worker process: run the checks for one partner account
+
+    Returns (tenant name, results as plain data, error message or None)"""
+
+    logger.info('Checking partner account: %s', tenant['name'])
+    datto_check = DattoCheck(tenant=tenant, **options)
+    try:
+        datto_check.run(report=report, deadline=deadline)
+        return tenant['name'], datto_check.results.to_dict(), None
+    except Exception as e:
+        logger.exception('Checks failed for partner account %s', tenant['name'])
+        return tenant['name'], datto_check.results.to_dict(), str(e) or type(e).__name__
+    finally:
+        datto_check.close()
+
+
+class TenantRunner():
+    """Runs the checks for several partner accounts in parallel processes
+
+    tenants - list of partner account dicts (see config.TENANTS)
+    options - DattoCheck keyword arguments shared by every account
+    merged - send one report for all accounts (appliance names prefixed
+             with the account name) instead of one report per account
+    """
+
+    def __init__(self, tenants, options, merged=None):
+        "Constructor"
+
+        self.tenants = tenants
+        self.options = options
+        self.merged = merged if merged is not None else getattr(config, 'TENANT_REPORT', 'merged') == 'merged'
+        self.results = {}
+        self.errors = {}
+
+    def run(self, report=True, deadline=None):
+        """Check every account; returns the merged Results
+
+        deadline - see DattoCheck.run; applies to every account
+
+        A failed account is listed as a critical error in the merged
+        results, and its partial results are kept."""
+
+        with ProcessPoolExecutor(max_workers=len(self.tenants)) as executor:
+            futures = {executor.submit(check_tenant, tenant, self.options, report and not self.merged,
+                                       deadline):
+                       tenant['name'] for tenant in self.tenants}
+            for future in as_completed(futures):
+                try:
+                    name, results, error = future.result()
+                except Exception as e:
+                    # the worker process itself failed
+                    logger.error('Checks failed for partner account %s: %s', futures[future], e)
+                    self.errors[futures[future]] = str(e) or type(e).__name__
+                    continue
+                self.results[name] = Results.from_dict(results)
+                if error:
+                    self.errors[name] = error
+
+        merged = self.merge()
+        if report and self.merged:
+            Email().send_report(merged)
+        return merged
+
+    def merge(self):
+        "Returns the results of every account in one Results"
+
+        merged = Results()
+        for tenant in self.tenants:
+            name = tenant['name']
+            if name in self.errors:
+                merged.append_error(['critical', name, 'Account Check Failed', self.errors[name]],
+                                    color='red')
+            if name in self.results:
+                merged.merge(self.results[name], '{}: '.format(name))
+        merged.sort()
+        return merged
@@ -1,106 +1,254 @@
 # Import: standard
 
+import io
 import logging
-import smtplib
-import sys
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+import time
+from contextlib import nullcontext
+from datetime import datetime
+from fnmatch import fnmatchcase
+
+# smtplib and email.mime are imported when a message is sent
 
 # Import: local
 import config
+from report import HtmlReport
 
 logger = logging.getLogger("Datto Check")
 
 
+class EmailError(Exception):
+    """Raised when an email message cannot be sent."""
+    pass
+
+
 class Email():
+    """Email delivery
+
+    All messages sent through one Email object share a single SMTP
+    connection (STARTTLS & login once), opened on the first message and
+    closed by close() (or at the end of a 'with' block). Transient
+    failures (dropped connections, timeouts, 4xx replies) are retried
+    per message on a fresh connection.
+    """
 
-    def __init__(self):
+    def __init__(self, telemetry=None):
+        "Constructor - report build & send times are recorded in 'telemetry', if given"
+
+        self.telemetry = telemetry
         self.mx_endpoint = config.EMAIL_MX
         self.port = config.EMAIL_PORT
         self.starttls = config.EMAIL_SSL
         self.user = config.EMAIL_LOGIN
         self.password = config.EMAIL_PW
+        self.timeout = getattr(config, 'EMAIL_TIMEOUT', 30)
+        self.tries = getattr(config, 'EMAIL_RETRIES', 3)
+        self.debug = getattr(config, 'EMAIL_DEBUG', False)
+        self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def connect(self):
+        "Open the SMTP connection (STARTTLS and login as configured)"
+
+        import smtplib
+
+        logger.debug('Connecting to SMTP server %s:%s', self.mx_endpoint, self.port)
+        connection = smtplib.SMTP(host=self.mx_endpoint, port=int(self.port), timeout=self.timeout)
+        try:
+            if self.debug:
+                connection.set_debuglevel(1)
+            if  self.starttls:
+                connection.starttls()
+            if  self.password:
+                connection.login(self.user, self.password)
+        except Exception:
+            connection.close()
+            raise
+        self.connection = connection
+
+    def close(self):
+        "Close the SMTP connection, if open"
+
+        if self.connection is None:
+            return
+        import smtplib
+        try:
+            self.connection.quit()
+        except (smtplib.SMTPException, OSError):
+            self.connection.close()
+        self.connection = None
+
+    @staticmethod
+    def transient(error):
+        "True if sending may succeed on a retry"
+
+        import smtplib
+
+        if isinstance(error, smtplib.SMTPNotSupportedError):
+            return False
+        if isinstance(error, smtplib.SMTPResponseException):
+            return 400 <= error.smtp_code < 500
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return all(400 <= code < 500 for code, _ in error.recipients.values())
+        return isinstance(error, (smtplib.SMTPServerDisconnected, OSError))
+
+    def send_email(self, email_to, email_from, subject, body, email_cc=None, images=None):
+        """Send an HTML email message over the shared connection.
+
+        images - Screenshots (see datto.screenshots) to attach as inline
+                 parts, referred to from the body by content id
+
+        Raises EmailError if it cannot be sent."""
 
-    def send_email(self, email_to, email_from, subject, body, email_cc=None):
+        import smtplib
+        from email.mime.image import MIMEImage
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
 
         try:
-            msg = MIMEMultipart()
+            msg = MIMEMultipart('related' if images else 'mixed')
             msg['Subject'] = subject
             msg['From'] = email_from
             msg['To'] = ', '.join(email_to)
             if email_cc:
                 msg['Cc'] = ', '.join(email_cc)
         except TypeError:
-            logger.fatal('[!] Unable to add email recipients. Ensure to/from are iterable types')
-            sys.exit(-1)
+            raise EmailError('Unable to add email recipients. Ensure to/from are iterable types')
 
         msg.attach(MIMEText(body, 'html'))
+        for image in images or []:
+            try:
+                part = MIMEImage(image.path.read_bytes(), image.content_type.split('/')[-1])
+            except OSError as e:
+                logger.warning('Unable to attach screenshot %s: %s', image.path, e)
+                continue
+            part.add_header('Content-ID', '<{}>'.format(image.content_id))
+            part.add_header('Content-Disposition', 'inline', filename=image.path.name)
+            msg.attach(part)
 
         # Send email
-        s = smtplib.SMTP(host=self.mx_endpoint, port=int(self.port))
-
+        with self._phase('smtp_send'):
+            for attempt in range(1, self.tries + 1):
+                try:
+                    if self.connection is None:
+                        self.connect()
+                    self.connection.send_message(msg)
+                    logger.info("Email sent: %s", subject)
+                    return
+                except (smtplib.SMTPException, OSError) as e:
+                    error = e
+
+                # the connection may be unusable; reconnect for the next message
+                self._drop()
+                if not self.transient(error) or attempt == self.tries:
+                    logger.error("Failed to send email message:\n  %s", str(error))
+                    raise EmailError('Failed to send "{}": {}'.format(subject, error))
+                logger.warning('Sending email failed (%s); retrying', error)
+                time.sleep(2 ** (attempt - 1))
+
+    def _drop(self):
+        "Discard a broken connection without the QUIT exchange"
+
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def send_report(self, results, subject=None, email_to=None, email_cc=None, screenshots=None):
+        """Build and send the HTML report for 'results' (a Results), and
+        the report of each recipient group (config.EMAIL_GROUPS) that
+        has errors to report.
+
+        The full report goes to email_to/email_cc (defaulting to
+        config.EMAIL_TO/EMAIL_CC); nothing is sent without recipients.
+        With config.SCREENSHOT_EMBED set, failed-screenshot images are
+        downloaded ('screenshots', a ScreenshotPrefetcher that may already
+        hold them, or a new one) and attached inline.
+        Raises EmailError if any message cannot be sent, after trying
+        every message."""
+
+        if not subject:
+            d = datetime.today()
+            subject = 'Daily Datto Check: {}'.format(d.strftime('%m/%d/%Y'))
+        email_to = email_to if email_to is not None else config.EMAIL_TO
+        email_cc = email_cc if email_cc is not None else config.EMAIL_CC
+
+        messages = []
+        if email_to:
+            messages.append((subject, results, email_to, email_cc))
+        for group in getattr(config, 'EMAIL_GROUPS', []):
+            group_results = self.group_results(results, group)
+            if group_results.count() or group.get('send_empty'):
+                messages.append(('{} - {}'.format(subject, group['name']), group_results,
+                                 group['email_to'], group.get('email_cc', [])))
+
+        prefetcher = None
+        if screenshots is None and messages and getattr(config, 'SCREENSHOT_EMBED', False):
+            from datto.screenshots import ScreenshotPrefetcher
+            screenshots = prefetcher = ScreenshotPrefetcher(self.telemetry)
+
+        failed = []
         try:
-            if  self.starttls:
-                s.starttls()
-            if  self.password:
-                s.login(self.user, self.password)
-            s.send_message(msg)
-            s.quit()
-            logger.info("Email report sent.")
-        except Exception as e:
-            logger.fatal("Failed to send email message:\n  %s", str(e))
-            sys.exit(-1)
-
-    def build_html_report(self, results_data):
-        "Compile our Datto Check results into an HTML report for emailing"
+            for message_subject, message_results, message_to, message_cc in messages:
+                images = {}
+                if screenshots:
+                    images = screenshots.images(self.screenshot_urls(message_results))
+                report = self.build_html_report(message_results.results, images)
+                try:
+                    self.send_email(message_to, config.EMAIL_FROM, message_subject, report, message_cc,
+                                    list({image.content_id: image for image in images.values()}.values()))
+                except EmailError as e:
+                    failed.append(str(e))
+        finally:
+            self.close()
+            if prefetcher:
+                prefetcher.close()
+        if failed:
+            raise EmailError('; '.join(failed))
+
+    @staticmethod
+    def group_results(results, group):
+        """Returns the slice of 'results' for a recipient group: errors for
+        appliances matching any of the group's 'appliances' patterns
+        (shell-style, e.g. 'ACME-*'; all appliances if not set) and in
+        the group's 'categories' (all categories if not set)"""
+
+        patterns = group.get('appliances') or ['*']
+        categories = group.get('categories')
+        group_results = type(results)()
+        for appliance in list(results.by_device):
+            if not any(fnmatchcase(appliance, pattern) for pattern in patterns):
+                continue
+            for category, record in results.for_device(appliance):
+                if categories is None or category in categories:
+                    group_results.append_record(category, record)
+        group_results.sort()
+        return group_results
+
+    @staticmethod
+    def screenshot_urls(results):
+        "Returns the screenshot URLs of the failed screenshots in 'results'"
+
+        return [record.screenshot_url for record in results.results['screenshot_error']['errors']
+                if record.screenshot_url]
+
+    def build_html_report(self, results_data, images=None):
+        """Compile our Datto Check results into an HTML report for emailing
+
+        images - {screenshot url: Screenshot} attached to the email"""
 
         logger.info("Building datto check html report")
 
-        report = '''<html>
-    <head>
-        <style>
-            table,th,td {border: 1px solid black;border-collapse: collapse;text-align: left;}
-            th {text-align: center;}
-        </style>
-    </head>
-    <body>'''
-
-        for category in results_data:
-            category_name = category
-            category = results_data[category]
-            if category['errors']:
-                report += f"<h1>{category['name']}</h1>"
-                report += self.build_report_table(category, category_name)
-        report += '</body></html>'
-        return report.replace('\n', '')
-
-    def build_report_table(self, category, category_name):
-        "Builds and returns an html table with results data"
-
-        colors = ['red', 'yellow']
-        table = "<table><tr>"
-
-        # Table headers
-        for column in category['columns']:
-            table += f"<th>{column}</th>"
-        table += "</tr>"
-
-        # Table body
-        for error in category['errors']:
-
-            # row color is always the last item if set
-            if error[-1] in colors:
-                table += '<tr style="background-color: {0};">'.format(error[-1])
-            else:
-                table += '<tr>'
-
-            for col in range(1, len(category['columns']) + 1):
-
-                if category_name == 'screenshot_error' and col == 3 and 'http' in error[-1]:
-                    table += f'<td width="160">{error[col]}</td>'
-                else:
-                    table += f"<td>{error[col]}</td>"
-            table += '</tr>'
-        table += '</table>'
-
-        return table
+        with self._phase('report_build'):
+            report = io.StringIO()
+            HtmlReport({url: image.content_id for url, image in (images or {}).items()}).render(
+                results_data, report)
+            return report.getvalue()
+
+    def _phase(self, name):
+        "Telemetry timer for phase 'name' (a no-op without telemetry)"
+
+        return self.telemetry.phase(name) if self.telemetry else nullcontext()
@@ -2,14 +2,46 @@
 
 # Import: standard
 import sys
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError, SUPPRESS
+from datetime import datetime, timedelta
 import logging
 from logging import StreamHandler, DEBUG, INFO, Formatter
 from logging.handlers import RotatingFileHandler
 
 # Import: local
 import config
+from report import LogSink, NdjsonSink, write_report
 from datto import DattoCheck
+from datto.api import DattoApiError
+from datto.archive import ApiArchive, ArchiveError
+from datto.daemon import Daemon
+from datto.shards import parse_shard, write_shard, merge_shards
+from mail import Email, EmailError
+
+
+def shard_argument(value):
+    "argparse type for '--shard i/N'"
+
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise ArgumentTypeError(str(e))
+
+
+def deadline_argument(value):
+    "argparse type for '--deadline HH:MM' (the next such local time) or minutes from now"
+
+    now = datetime.now().astimezone()
+    try:
+        if ':' not in value:
+            return now + timedelta(minutes=float(value))
+        hour, minute = (int(part) for part in value.split(':'))
+        deadline = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    except ValueError:
+        raise ArgumentTypeError('expected HH:MM or a number of minutes: {}'.format(value))
+    if deadline <= now:
+        deadline += timedelta(days=1)
+    return deadline
 
 
 def main():
@@ -33,6 +65,59 @@ def main():
     parser.add_argument('-u', '--unprotected-volumes', help='Include \
         any unprotected volumes in the final report',
                         action='store_true')
+    parser.add_argument('-w', '--workers', help='Maximum number of \
+        concurrent asset detail requests (default: config.MAX_WORKERS)',
+                        type=int)
+    parser.add_argument('--no-cache', help='Do not use the on-disk \
+        API response cache', action='store_true')
+    parser.add_argument('-i', '--incremental', help='Reuse agent data \
+        saved by the last run for devices that have not changed',
+                        action='store_true')
+    parser.add_argument('-b', '--batch', help='Evaluate agent checks \
+        in batches', action='store_true')
+    parser.add_argument('-d', '--daemon', help='Keep running: device \
+        checks, agent checks and the email report run on the config.DAEMON_* \
+        schedule', action='store_true')
+    parser.add_argument('-t', '--tenant', help='Only check this partner \
+        account from config.TENANTS (may be repeated)', action='append')
+    parser.add_argument('-s', '--shard', help='Only check shard I of N \
+        of the devices (by serial number) and write the results to \
+        --shard-output, for the \'merge\' command', metavar='I/N',
+                        type=shard_argument)
+    parser.add_argument('--shard-output', help='Shard results file \
+        (default: shard-I-of-N.json)')
+    parser.add_argument('-o', '--output', help='Also write the report \
+        to this file (\'-\' for stdout)')
+    parser.add_argument('-f', '--format', help='Format of the --output \
+        report (default: html)', choices=['html', 'json', 'ndjson', 'csv'],
+                        default='html')
+    parser.add_argument('--stream', help='Write each error to this file \
+        as newline-delimited JSON as soon as it is found (\'-\' for stdout)',
+                        metavar='FILE')
+    parser.add_argument('--log-findings', help='Log each error as soon \
+        as it is found', action='store_true')
+    archive_group = parser.add_mutually_exclusive_group()
+    archive_group.add_argument('--record', help='Record the API responses \
+        read by the checks into an archive in this directory', metavar='DIR')
+    archive_group.add_argument('--replay', help='Run the checks from an \
+        archive made by --record, without the network; no report is \
+        emailed (use -o)', metavar='DIR')
+    parser.add_argument('--pin-time', help='With --replay, run the checks \
+        as of the time the archive was captured', action='store_true')
+    parser.add_argument('--deadline', help='Send the report by this time \
+        (HH:MM, local time) or this many minutes from now: devices are \
+        checked most urgent first, and those not reached are listed as not \
+        checked', metavar='TIME', type=deadline_argument)
+
+    # 'merge' command; its options may also follow the shard files
+    subparsers = parser.add_subparsers(dest='command', metavar='{merge}')
+    merge_parser = subparsers.add_parser('merge', help='Combine --shard \
+        results files into one report, emailed as usual')
+    merge_parser.add_argument('shard_files', nargs='+', metavar='SHARD_FILE')
+    merge_parser.add_argument('-v', '--verbose', action='store_true', default=SUPPRESS)
+    merge_parser.add_argument('-o', '--output', default=SUPPRESS)
+    merge_parser.add_argument('-f', '--format', choices=['html', 'json', 'ndjson', 'csv'],
+                              default=SUPPRESS)
 
     args = parser.parse_args()
 
@@ -53,9 +138,114 @@ def main():
         handler.setFormatter(formatter)
         logger.addHandler(handler)
 
+    if args.command == 'merge':
+        logger.info('Merging %s shard results files', len(args.shard_files))
+        results = merge_shards(args.shard_files)
+        if args.output:
+            write_report(results.results, args.output, args.format)
+        try:
+            Email().send_report(results)
+        except EmailError as e:
+            logger.fatal('Sending the report failed: %s', e)
+            return -1
+        return 0
+
     logger.info('Starting Datto check')
-    datto_check = DattoCheck(args.unprotected_volumes)
-    datto_check.run()
+    tenants = getattr(config, 'TENANTS', [])
+    if args.shard and (tenants or args.daemon):
+        logger.fatal('--shard cannot be combined with config.TENANTS or --daemon')
+        return -1
+    if tenants and (args.stream or args.log_findings) and not args.daemon:
+        logger.fatal('--stream and --log-findings cannot be combined with config.TENANTS')
+        return -1
+    if (args.record or args.replay) and (tenants or args.daemon):
+        logger.fatal('--record and --replay cannot be combined with config.TENANTS or --daemon')
+        return -1
+    if args.record and args.incremental:
+        # unchanged devices would be missing from the archive
+        logger.fatal('--record cannot be combined with --incremental')
+        return -1
+    if args.pin_time and not args.replay:
+        logger.fatal('--pin-time needs --replay')
+        return -1
+    if args.deadline and args.daemon:
+        logger.fatal('--deadline cannot be combined with --daemon')
+        return -1
+    if args.tenant:
+        selected = [tenant for tenant in tenants if tenant['name'] in args.tenant]
+        if len(selected) != len(set(args.tenant)):
+            logger.fatal('Unknown partner account; choose from: %s',
+                         ', '.join(tenant['name'] for tenant in tenants) or '(none in config.TENANTS)')
+            return -1
+        tenants = selected
+    if tenants and args.daemon:
+        logger.warning('Daemon mode only checks the config.AUTH_* account, not config.TENANTS')
+    elif tenants:
+        from datto.tenants import TenantRunner
+        runner = TenantRunner(tenants, {'include_unprotected': args.unprotected_volumes,
+                                        'workers': args.workers,
+                                        'use_cache': not args.no_cache,
+                                        'incremental': args.incremental,
+                                        'batch': args.batch})
+        try:
+            results = runner.run(deadline=args.deadline)
+        except EmailError as e:
+            logger.fatal('Sending the report failed: %s', e)
+            return -1
+        if args.output:
+            write_report(results.results, args.output, args.format)
+        return -1 if runner.errors else 0
+
+    archive = None
+    if args.record or args.replay:
+        try:
+            archive = ApiArchive(args.record or args.replay, record=bool(args.record))
+        except (ArchiveError, OSError) as e:
+            logger.fatal('%s', e)
+            return -1
+
+    sinks = []
+    if args.stream:
+        sinks.append(NdjsonSink(args.stream))
+    if args.log_findings:
+        sinks.append(LogSink())
+    datto_check = DattoCheck(args.unprotected_volumes,
+                             args.workers,
+                             not args.no_cache,
+                             args.incremental,
+                             args.batch,
+                             shard=args.shard,
+                             sinks=sinks,
+                             archive=archive,
+                             now=archive.captured if args.pin_time else None)
+    if args.daemon:
+        try:
+            Daemon(datto_check).run()
+        finally:
+            for sink in sinks:
+                sink.close()
+        return 0
+
+    try:
+        # shards are reported by the 'merge' command; replays only by -o
+        datto_check.run(report=not (args.shard or args.replay), deadline=args.deadline)
+        if args.shard:
+            write_shard(args.shard_output or 'shard-{}-of-{}.json'.format(*args.shard),
+                        args.shard, datto_check.results, datto_check.complete, datto_check.devices)
+        if args.output:
+            datto_check.write_report(args.output, args.format)
+    except DattoApiError as e:
+        logger.fatal('Datto check failed: %s', e)
+        return -1
+    except EmailError as e:
+        logger.fatal('Sending the report failed: %s', e)
+        return -1
+    finally:
+        datto_check.close()
+        for sink in sinks:
+            sink.close()
+        if archive:
+            archive.close()
     return 0
 
 
@@ -0,0 +1,198 @@
+# Import: standard
+
+import csv
+import json
+import logging
+import sys
+from datetime import datetime
+from html import escape
+
+logger = logging.getLogger("Datto Check")
+
+
+def error_records(results_data):
+    """Generator: yield every error in the results as a dict of
+    'category' and the record's fields, in report order"""
+
+    for category_name, category in results_data.items():
+        for error in category['errors']:
+            record = {'category': category_name}
+            record.update(error._asdict())
+            yield record
+
+
+class HtmlReport():
+    """HTML report, as emailed
+
+    images - {screenshot url: content id} of screenshots attached to the
+             email; those thumbnails refer to the attachment ('cid:')
+             instead of loading the image from Datto"""
+
+    def __init__(self, images=None):
+        "Constructor"
+
+        self.images = images or {}
+
+    def render(self, results_data, stream):
+        "Write the report to a text stream in a single pass"
+
+        def write(text):
+            stream.write(text.replace('\n', ''))
+
+        write('''<html>
+    <head>
+        <style>
+            table,th,td {border: 1px solid black;border-collapse: collapse;text-align: left;}
+            th {text-align: center;}
+        </style>
+    </head>
+    <body>''')
+
+        for category in results_data.values():
+            if category['errors']:
+                write(f"<h1>{category['name']}</h1>")
+                self.render_table(category, write)
+        write('</body></html>')
+
+    def render_table(self, category, write):
+        "Write an html table with results data"
+
+        write("<table><tr>")
+
+        # Table headers
+        for column in category['columns']:
+            write(f"<th>{column}</th>")
+        write("</tr>")
+
+        # Table body
+        for error in category['errors']:
+
+            if error.color:
+                write('<tr style="background-color: {0};">'.format(error.color))
+            else:
+                write('<tr>')
+
+            cells = error[:len(category['columns'])]
+            if getattr(error, 'screenshot_url', None):
+                cells = cells[:-1]
+            for value in cells:
+                write(f"<td>{value}</td>")
+            if len(cells) < len(category['columns']):
+                write(self.screenshot_cell(error))
+            write('</tr>')
+        write('</table>')
+
+    def screenshot_cell(self, error):
+        "Returns the screenshot thumbnail cell for a failed screenshot"
+
+        uri = escape(error.screenshot_url)
+        src = escape('cid:' + self.images[error.screenshot_url]) if error.screenshot_url in self.images else uri
+        title = escape(error.screenshot_error or '')
+        return f'<td width="160"><a href="{uri}"><img src="{src}" alt="" width="160" title="{title}"></img></a></td>'
+
+
+class JsonReport():
+    "JSON report: a single document with the errors grouped by category"
+
+    def render(self, results_data, stream):
+        "Write the report to a text stream in a single pass"
+
+        stream.write('{"generated": %s, "categories": {' % json.dumps(datetime.now().isoformat()))
+        for index, (category_name, category) in enumerate(results_data.items()):
+            if index:
+                stream.write(', ')
+            stream.write('%s: {"name": %s, "errors": [' % (json.dumps(category_name),
+                                                          json.dumps(category['name'])))
+            for row, error in enumerate(category['errors']):
+                if row:
+                    stream.write(', ')
+                stream.write(json.dumps(error._asdict()))
+            stream.write(']}')
+        stream.write('}}\n')
+
+
+class NdjsonReport():
+    "Newline-delimited JSON report: one error per line"
+
+    def render(self, results_data, stream):
+        "Write the report to a text stream in a single pass"
+
+        for record in error_records(results_data):
+            stream.write(json.dumps(record))
+            stream.write('\n')
+
+
+class CsvReport():
+    "CSV report: one error per row, with the fields of every category"
+
+    def render(self, results_data, stream):
+        "Write the report to a text stream in a single pass"
+
+        fields = ['category']
+        for category in results_data.values():
+            for field in category['fields']:
+                if field not in fields and field != 'color':
+                    fields.append(field)
+        fields.append('color')
+
+        writer = csv.DictWriter(stream, fieldnames=fields, restval='')
+        writer.writeheader()
+        for record in error_records(results_data):
+            writer.writerow(record)
+
+
+RENDERERS = {'html': HtmlReport,
+             'json': JsonReport,
+             'ndjson': NdjsonReport,
+             'csv': CsvReport}
+
+
+class NdjsonSink():
+    """Result sink: writes each error as a line of newline-delimited JSON
+    as soon as it is found (see Results); output '-' is stdout"""
+
+    def __init__(self, output):
+        "Constructor"
+
+        self.output = output
+        self.stream = sys.stdout if output == '-' else open(output, 'w')
+
+    def __call__(self, category, record):
+        self.stream.write(json.dumps({'category': category, **record._asdict()}))
+        self.stream.write('\n')
+        self.stream.flush()
+
+    def close(self):
+        "Close the output file"
+
+        if self.stream is not sys.stdout:
+            self.stream.close()
+
+
+class LogSink():
+    "Result sink: logs each error as soon as it is found"
+
+    def __init__(self, level=logging.INFO):
+        "Constructor"
+
+        self.level = level
+
+    def __call__(self, category, record):
+        details = ', '.join(str(value) for field, value in record._asdict().items()
+                            if value is not None and field not in ('appliance', 'color'))
+        logger.log(self.level, 'Found %s: %s: %s', category, record.appliance, details)
+
+    def close(self):
+        pass
+
+
+def write_report(results_data, output, report_format='html'):
+    """Write a report of the results to a file; output '-' is stdout"""
+
+    logger.info("Writing %s report to %s", report_format, output)
+    renderer = RENDERERS[report_format]()
+    if output == '-':
+        renderer.render(results_data, sys.stdout)
+    else:
+        with open(output, 'w', newline='') as stream:
+            renderer.render(results_data, stream)
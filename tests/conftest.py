@@ -0,0 +1,17 @@
+# Test setup: the program's config (config.py, else config-mk.py) is
+# importable as 'config', as in bench/benchmark.py
+
+# Import: standard
+import importlib.util
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+try:
+    import config
+except ImportError:
+    spec = importlib.util.spec_from_file_location('config', ROOT / 'config-mk.py')
+    config = importlib.util.module_from_spec(spec)
+    sys.modules['config'] = config
+    spec.loader.exec_module(config)
@@ -0,0 +1,97 @@
+# Tests: datto.batch - batched checks find exactly what per-agent checks do
+
+# Import: standard
+import itertools
+from datetime import datetime, timezone
+
+import pytest
+
+# Import: local
+import config
+from datto import batch
+from datto.agent import Agent
+from datto.batch import BatchChecker
+from datto.results import Results
+
+NOW = datetime(2026, 10, 17, 12, 0, 0, 500000, tzinfo=timezone.utc)
+
+
+class Api():
+    "Answers screenshot lookups as the XML API would"
+
+    def get_screenshot(self, device, agent, screenshot_url=None):
+        return (screenshot_url or 'https://example.com/{}.png'.format(agent), 'error')
+
+
+def around(threshold):
+    "Timestamps just inside, at and just past a threshold, and actionable"
+
+    now = int(NOW.timestamp())
+    return [now - threshold + 1, now - threshold, now - threshold - 1,
+            now - config.ACTIONABLE_THRESHOLD - 1]
+
+
+def agents():
+    "Asset details agent records covering every branch of the agent checks"
+
+    now = int(NOW.timestamp())
+    backups = [('success', None, []),
+               ('failed', 'VSS error', []),
+               ('failed', None, []),
+               ('success', None, [{'errorType': 'boot', 'errorMessage': 'no boot'}]),
+               None]
+    states = [(False, False), (True, False), (False, True)]
+    combinations = itertools.product([now, 0] + around(config.LAST_BACKUP_THRESHOLD),
+                                     backups,
+                                     [None, 0, now] + around(config.LAST_OFFSITE_THRESHOLD),
+                                     [None, 0, now] + around(config.LAST_SCREENSHOT_THRESHOLD),
+                                     [True, False],
+                                     ['agent', 'share'],
+                                     states)
+    for i, (snapshot, backup, offsite, screenshot, status, kind, state) in enumerate(combinations):
+        record = {'name': 'agent-{}'.format(i), 'unprotectedVolumeNames': ['D:'] if i % 3 == 0 else [],
+                  'isPaused': state[0], 'isArchived': state[1], 'latestOffsite': offsite,
+                  'lastSnapshot': snapshot, 'lastScreenshotAttempt': screenshot,
+                  'lastScreenshotAttemptStatus': status,
+                  'lastScreenshotUrl': 'https://example.com/rest-{}.png'.format(i) if i % 2 else None,
+                  'type': kind, 'backups': []}
+        if backup:
+            record['backups'].append({'backup': {'status': backup[0], 'errorMessage': backup[1]},
+                                      'localVerification': {'errors': backup[2]}})
+        yield record
+
+
+def per_agent(records, include_unprotected):
+    "The checks as DattoCheck.run_agent_checks runs them without batching"
+
+    results = Results()
+    for record in records:
+        agent = Agent(record, 'device')
+        agent.check_local_backups(results)
+        if agent.is_inactive():
+            continue
+        agent.run_agent_checks(Api(), results, include_unprotected, NOW)
+    return results
+
+
+def batched(records, include_unprotected):
+    results = Results()
+    checker = BatchChecker(Api(), results, include_unprotected, NOW, batch_size=500)
+    for record in records:
+        checker.add(Agent(record, 'device'))
+    checker.flush()
+    return results
+
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+@pytest.mark.parametrize('include_unprotected', [True, False])
+def test_batched_matches_per_agent(monkeypatch, use_numpy, include_unprotected):
+    if use_numpy and batch.numpy is None:
+        pytest.skip('numpy is not installed')
+    if not use_numpy:
+        monkeypatch.setattr(batch, 'numpy', None)
+
+    records = list(agents())
+    expected = per_agent(records, include_unprotected)
+    assert sum(len(category['errors']) for category in expected.results.values()) > 0
+    assert batched(records, include_unprotected).results == expected.results
@@ -0,0 +1,52 @@
+# Tests: datto.api.ResponseCache
+
+# Import: local
+from datto.api import ResponseCache
+
+
+def store(cache, url, body, etag=None):
+    "Write a body through a cache writer, in chunks"
+
+    body_file = cache.writer(url)
+    for i in range(0, len(body), 4):
+        body_file.write(body[i:i + 4])
+    cache.put(url, body_file, etag)
+
+
+def read(cache, url):
+    entry = cache.get(url)
+    if entry is None:
+        return None
+    with entry['body'] as body_file:
+        return body_file.read(), entry['etag']
+
+
+def test_put_and_get(tmp_path):
+    cache = ResponseCache(tmp_path, 1024)
+    assert cache.get('a') is None
+    store(cache, 'a', b'<Devices>...</Devices>', '"v1"')
+    assert read(cache, 'a') == (b'<Devices>...</Devices>', '"v1"')
+    store(cache, 'a', b'[]', '"v2"')
+    assert read(cache, 'a') == (b'[]', '"v2"')
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+def test_discard(tmp_path):
+    cache = ResponseCache(tmp_path, 1024)
+    body_file = cache.writer('a')
+    body_file.write(b'partial')
+    cache.discard(body_file)
+    assert cache.get('a') is None
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(tmp_path, 25)
+    store(cache, 'a', b'a' * 10)
+    store(cache, 'b', b'b' * 10)
+    read(cache, 'a')
+    store(cache, 'c', b'c' * 10)
+    assert read(cache, 'b') is None
+    assert not cache.body_path('b').exists()
+    assert read(cache, 'a') == (b'a' * 10, None)
+    assert read(cache, 'c') == (b'c' * 10, None)
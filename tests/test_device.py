@@ -0,0 +1,31 @@
+# Tests: datto.device
+
+# Import: local
+import config
+from datto.device import Device
+from datto.results import Results
+
+
+def device(used, available):
+    return Device({'name': 'siris', 'hidden': False, 'activeTickets': 0,
+                   'lastSeenDate': '2026-10-17T12:00:00+00:00', 'serialNumber': 'A',
+                   'localStorageUsed': {'size': used}, 'localStorageAvailable': {'size': available}})
+
+
+def low_disk(device):
+    results = Results()
+    device.check_disk_usage(results)
+    return [error for _, error in results.for_device('siris') if error.error_type == 'Low Disk Space']
+
+
+def test_storage_used_pct_is_what_the_disk_check_reads():
+    # 0.004% over the threshold rounds down to it, so is not over it
+    used = int(config.STORAGE_PCT_THRESHOLD * 1000) + 4
+    nearly_full = device(used, 100000 - used)
+    assert nearly_full.storage_used_pct() == float('{:.2f}'.format(config.STORAGE_PCT_THRESHOLD / 100)) * 100
+    assert not low_disk(nearly_full)
+
+    used = int(config.STORAGE_PCT_THRESHOLD * 1000) + 1000
+    assert low_disk(device(used, 100000 - used))
+
+    assert device(0, 0).storage_used_pct() is None
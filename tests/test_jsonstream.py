@@ -0,0 +1,69 @@
+# Tests: datto.jsonstream
+
+# Import: standard
+import json
+
+import pytest
+
+# Import: local
+from datto.jsonstream import iter_array
+
+DOCUMENTS = [
+    '[]',
+    '[1.5, -2, 0, 3e10, -1.25E-3, 12345678901234567890, 1e+2]',
+    '["", "plain", "esc\\"aped\\\\", "\\u00e9\\ud83d\\ude00\\n\\t\\/", "café ☃ \U0001f600"]',
+    '[true, false, null, {"a": [1, {"b": null}], "c": "d"}, [[], {}], {"": ""}]',
+    ' [ {"name": "agent", "backups": [{"status": "ok", "size": 10.5}]} , 7 ] ',
+]
+
+
+def splits(data):
+    "Every way to split 'data' into two chunks, and into three for short data"
+
+    for i in range(len(data) + 1):
+        yield [data[:i], data[i:]]
+    if len(data) <= 80:
+        for i in range(len(data) + 1):
+            for j in range(i, len(data) + 1):
+                yield [data[:i], data[i:j], data[j:]]
+
+
+@pytest.mark.parametrize('document', DOCUMENTS)
+def test_split_bytes(document):
+    expected = json.loads(document)
+    for chunks in splits(document.encode()):
+        assert list(iter_array(chunks)) == expected, chunks
+
+
+@pytest.mark.parametrize('document', DOCUMENTS)
+def test_split_text(document):
+    expected = json.loads(document)
+    for chunks in splits(document):
+        assert list(iter_array(chunks)) == expected, chunks
+
+
+def test_one_byte_chunks():
+    document = '[' + ', '.join(DOCUMENTS) + ']'
+    chunks = [bytes([byte]) for byte in document.encode()]
+    assert list(iter_array(chunks)) == json.loads(document)
+
+
+def test_object_member():
+    document = '{"pagination": {"count": 2.5e1}, "items": [{"a": 1}, 2.0], "tail": [true]}'
+    for chunks in splits(document.encode()):
+        members = {}
+        assert list(iter_array(chunks, 'items', members)) == [{'a': 1}, 2.0]
+        assert members == {'pagination': {'count': 25.0}, 'tail': [True]}
+
+
+def test_large_element():
+    element = {'backups': [{'status': 'success', 'id': i, 'text': 'x' * 40} for i in range(20000)]}
+    data = json.dumps([element, element]).encode()
+    chunks = [data[i:i + 4096] for i in range(0, len(data), 4096)]
+    assert list(iter_array(chunks)) == [element, element]
+
+
+@pytest.mark.parametrize('document', ['[1, 2', '[1 2]', '[1.x]', '["abc', '{"items": [1]'])
+def test_invalid(document):
+    with pytest.raises(ValueError):
+        list(iter_array([document[:3], document[3:]], 'items' if document[0] == '{' else None))
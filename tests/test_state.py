@@ -0,0 +1,79 @@
+# Tests: datto.state
+
+# Import: standard
+import time
+
+# Import: local
+import config
+from datto.state import State
+
+
+def agent(**fields):
+    "Slim agent data (Agent.slim) with a successful, verified last backup"
+
+    data = {'name': 'agent', 'unprotectedVolumeNames': [], 'isPaused': False, 'isArchived': False,
+            'latestOffsite': None, 'lastSnapshot': None, 'lastScreenshotAttempt': None,
+            'lastScreenshotAttemptStatus': True, 'lastScreenshotUrl': None, 'type': 'agent',
+            'backups': [{'backup': {'status': 'success', 'errorMessage': None},
+                         'localVerification': {'errors': []}}]}
+    data.update(fields)
+    return data
+
+
+def test_deadline_is_nearest_threshold():
+    now = time.time()
+    snapshot = now - config.LAST_BACKUP_THRESHOLD + 30 * 60
+    offsite = now - config.LAST_OFFSITE_THRESHOLD + 2 * 60 * 60
+    screenshot = now - config.LAST_SCREENSHOT_THRESHOLD + 60 * 60
+    assets = [agent(lastSnapshot=snapshot, latestOffsite=offsite, lastScreenshotAttempt=screenshot)]
+    assert State.next_deadline(assets) == snapshot + config.LAST_BACKUP_THRESHOLD
+
+    assets = [agent(lastSnapshot=now, latestOffsite=offsite, lastScreenshotAttempt=screenshot)]
+    assert State.next_deadline(assets) == screenshot + config.LAST_SCREENSHOT_THRESHOLD
+
+
+def test_deadline_across_agents():
+    now = time.time()
+    assets = [agent(lastSnapshot=now), agent(lastSnapshot=now - 60 * 60)]
+    assert State.next_deadline(assets) == now - 60 * 60 + config.LAST_BACKUP_THRESHOLD
+
+
+def test_deadline_without_thresholds():
+    assert State.next_deadline([agent()]) is None
+    assert State.next_deadline([agent(lastSnapshot=time.time(), isPaused=True)]) is None
+
+
+def test_deadline_with_errors():
+    failed = agent(lastSnapshot=time.time())
+    failed['backups'][0]['backup']['status'] = 'failed'
+    assert State.next_deadline([failed]) == 0
+    assert State.next_deadline([agent(lastScreenshotAttemptStatus=False)]) == 0
+
+
+def device(serial, used):
+    "Device listing data, as far as State reads it"
+
+    return {'serialNumber': serial, 'activeTickets': 0,
+            'localStorageUsed': {'size': used}, 'localStorageAvailable': {'size': 100}}
+
+
+def test_runs_in_one_process(tmp_path):
+    state = State(tmp_path / 'state.json')
+    assets = [agent(lastSnapshot=time.time())]
+
+    state.start()
+    state.update(device('A', 1), assets, 'a1')
+    state.update(device('B', 1), assets, 'b1')
+    state.save()
+
+    # the next run reuses what the last run saved, not the state loaded at startup
+    state.start()
+    assert state.cached_assets(device('A', 1)) == assets
+    assert state.cached_assets(device('B', 2)) is None
+    state.update(device('B', 2), assets, 'b2')
+    state.save()
+
+    state.start()
+    assert state.cached_assets(device('B', 2)) == assets
+    assert state.cached_assets(device('B', 1)) is None
+    assert State(tmp_path / 'state.json').saved == state.saved